@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+#
+# Times what a shell script looping over emp pays per command. Runs the same
+# command through a new emp process each time, then again with a control 
+# master running for them to share, and then all of them through a single
+# 'emp --batch'. Needs a running daemon.
+#
+# By: Alexander Dean
+#
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+EMP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "emp.py")
+
+def emp(env, *args, stdin=None):
+    return subprocess.run([sys.executable, EMP] + list(args), env=env, 
+                          input=stdin, stdout=subprocess.PIPE, 
+                          stderr=subprocess.DEVNULL, universal_newlines=True)
+
+def timeloop(env, count, command):
+    start = time.perf_counter()
+    for _ in range(count):
+        if emp(env, command).returncode != 0: 
+            raise Exception("emp failed, is the daemon running?")
+    return time.perf_counter()-start
+
+def report(name, count, seconds):
+    print("%-10s %7.2fs total  %7.2fms per command" % (name, seconds, seconds*1000/count))
+
+if __name__ == "__main__":
+    count   = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    command = sys.argv[2] if len(sys.argv) > 2 else "status"
+    
+    tmpdir = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env["EMP_CONTROL"] = os.path.join(tmpdir, "master.sock") # nobody there yet.
+    
+    print("%d '%s' commands:" % (count, command))
+    report("separate", count, timeloop(env, count, command))
+    
+    master = subprocess.Popen([sys.executable, EMP, "--master"], env=env, 
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while not os.path.exists(env["EMP_CONTROL"]): 
+            if master.poll() is not None: raise Exception("The master didn't start.")
+            time.sleep(0.05)
+        report("master", count, timeloop(env, count, command))
+    finally:
+        master.terminate()
+        master.wait()
+        os.rmdir(tmpdir)
+    
+    start = time.perf_counter()
+    out = emp(env, "--batch", stdin=(command+"\n")*count)
+    seconds = time.perf_counter()-start
+    if len(out.stdout.splitlines()) != count: raise Exception("--batch lost replies.")
+    report("--batch", count, seconds)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+#
+# Measures how many messages a second each of EMP's message codecs can push
+# through an encode and decode. The decode side goes through a FrameBuffer, 
+# just like the daemon's interface connections do.
+#
+# By: Alexander Dean
+#
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+from empbase.comm.codec import FrameBuffer, CODECS
+from empbase.comm.messages import makeCommandMsg, makeMsg, makeAlertMsg, MSG_TYPES
+
+# a few typical messages, small commands up to a fat help reply.
+SAMPLES = {
+    "command" : makeCommandMsg("status", "2dvhl", dest="daemon", args=[]),
+    "alert"   : makeAlertMsg("File '/var/log/syslog' changed at 1318204732.0!", 
+                             "tx63p", title="filechange"),
+    "reply"   : makeMsg({"mhdwu": ["log", "Log Watcher"], 
+                         "2bep6": ["file", "File Watcher"],
+                         "aa2me": ["execman", "Execution Alarm"]}, None, "3i37l"),
+    "help"    : makeMsg(dict(("command%d"%i, "this is the help string for command %d."%i)
+                             for i in range(20)), "daemon", "3i37l"),
+}
+
+def bench(msg, codec, seconds):
+    """ Returns the number of encode+decode round trips per second. """
+    frames = FrameBuffer(MSG_TYPES)
+    count, start = 0, time.perf_counter()
+    end = start+seconds
+    while time.perf_counter() < end:
+        for _ in range(1000):
+            frames.feed(msg.encode(codec))
+        count += 1000
+    return count/(time.perf_counter()-start), len(msg.encode(codec))
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    print("%-8s %-5s %12s %8s" % ("message", "codec", "msgs/sec", "bytes"))
+    for name, msg in SAMPLES.items():
+        for codec in CODECS:
+            rate, size = bench(msg, codec, seconds)
+            print("%-8s %-5s %12.0f %8d" % (name, codec, rate, size))
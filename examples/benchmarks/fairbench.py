@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+#
+# Measures how much one busy interface slows everyone else down. A "noisy"
+# connection keeps a big window of commands in flight, while a second, quiet
+# connection sends one command at a time and times each of its replies. The
+# quiet connection's latencies are printed with and without the noise.
+#
+# By: Alexander Dean
+#
+
+import os
+import sys
+import time
+from threading import Thread, Event
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+from empbase.daemon.EmpDaemon import EmpDaemon
+from empbase.daemon.daemonipc import DaemonClientSocket, DaemonPipeline
+from empbase.comm.messages import makeCommandMsg, strToMessage, MSG_TYPES
+
+def connect(port, path):
+    sock = DaemonClientSocket(port=port, msgtypes=MSG_TYPES, path=path, bufferSize=65536)
+    sock.connect()
+    msg = strToMessage(sock.recvframe())
+    if msg is None or msg.getValue() != "proceed":
+        raise Exception("Daemon didn't let us connect.")
+    return sock, msg.getDestination()
+
+def noise(port, path, command, window, stop, counter):
+    """ Keeps the window full of commands until told to stop. """
+    sock, myID = connect(port, path)
+    pipe = DaemonPipeline(sock, window)
+    while not stop.is_set():
+        while pipe.pending() < window: pipe.send(makeCommandMsg(command, myID))
+        if pipe.recv(blockout=10.0) is None: break
+        counter[0] += 1
+    sock.close()
+
+def quiet(port, path, command, count):
+    sock, myID = connect(port, path)
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        sock.send(makeCommandMsg(command, myID))
+        if sock.recvframe(10.0) is None: raise Exception("No reply.")
+        times.append(time.perf_counter()-start)
+        time.sleep(0.01)
+    sock.close()
+    return times
+
+def report(name, times):
+    times = sorted(times)
+    print("%-14s median %7.2fms  p90 %7.2fms  max %7.2fms" % 
+          (name, times[len(times)//2]*1000, times[int(len(times)*0.9)]*1000, 
+           times[-1]*1000))
+
+if __name__ == "__main__":
+    count   = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    window  = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    command = sys.argv[3] if len(sys.argv) > 3 else "status"
+    daemon = EmpDaemon()
+    port, path = daemon.getComPort(), daemon.getComPath()
+    if port is None: 
+        print("Error: Daemon isn't running!")
+        sys.exit(1)
+    
+    print("%d '%s' commands from a quiet interface:" % (count, command))
+    report("alone", quiet(port, path, command, count))
+    
+    stop, counter = Event(), [0]
+    noisy = Thread(target=noise, args=(port, path, command, window, stop, counter))
+    noisy.start()
+    time.sleep(0.5)
+    start = time.time()
+    times = quiet(port, path, command, count)
+    seconds = time.time()-start
+    stop.set()
+    noisy.join()
+    report("with noise", times)
+    print("(the noisy interface got %d replies a second)" % (counter[0]/seconds))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+#
+# Measures the round trip time of a 'status' command against a running EMP
+# daemon, the same way emp does it. Each command is sent after the connection
+# has sat idle for a bit, since thats what a person typing at emp looks like.
+#
+# By: Alexander Dean
+#
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+from empbase.daemon.EmpDaemon import EmpDaemon
+from empbase.daemon.daemonipc import DaemonClientSocket
+from empbase.comm.messages import makeCommandMsg, strToMessage, MSG_TYPES
+
+def connect(port):
+    """ Connects and waits for the daemon to say proceed, returns the socket
+    and the id the daemon gave us.
+    """
+    sock = DaemonClientSocket(port=port, msgtypes=MSG_TYPES)
+    sock.connect()
+    msg = strToMessage(sock.recvframe())
+    if msg is None or msg.getValue() != "proceed":
+        raise Exception("Daemon didn't let us connect.")
+    return sock, msg.getDestination()
+
+def report(name, times):
+    times = sorted(times)
+    print("%-24s min %7.1fms  median %7.1fms  max %7.1fms" % 
+          (name, times[0]*1000, times[len(times)//2]*1000, times[-1]*1000))
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    idle  = float(sys.argv[2]) if len(sys.argv) > 2 else 1.5
+    port = EmpDaemon().getComPort()
+    if port is None: 
+        print("Error: Daemon isn't running!")
+        sys.exit(1)
+
+    # a whole emp invocation: connect, handshake, command, reply.
+    fresh = []
+    for _ in range(count):
+        time.sleep(idle)
+        start = time.perf_counter()
+        sock, myid = connect(port)
+        sock.send(makeCommandMsg("status", myid))
+        strToMessage(sock.recvframe())
+        fresh.append(time.perf_counter()-start)
+        sock.close()
+    report("connect+status", fresh)
+
+    # just the command on a connection thats already open.
+    sock, myid = connect(port)
+    reuse = []
+    for _ in range(count):
+        time.sleep(idle)
+        start = time.perf_counter()
+        sock.send(makeCommandMsg("status", myid))
+        strToMessage(sock.recvframe())
+        reuse.append(time.perf_counter()-start)
+    sock.close()
+    report("status after idle", reuse)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+#
+# Sends a batch of commands down a single connection to a running daemon, 
+# first one at a time (send, wait for the reply, send the next) and then 
+# pipelined with request ids, and prints how many commands a second each 
+# gets through.
+#
+# By: Alexander Dean
+#
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+from empbase.daemon.EmpDaemon import EmpDaemon
+from empbase.daemon.daemonipc import DaemonClientSocket, DaemonPipeline
+from empbase.comm.messages import makeCommandMsg, strToMessage, MSG_TYPES
+
+def connect(daemon):
+    sock = DaemonClientSocket(port=daemon.getComPort(), msgtypes=MSG_TYPES,
+                              path=daemon.getComPath())
+    sock.connect()
+    msg = strToMessage(sock.recvframe())
+    if msg is None or msg.getValue() != "proceed":
+        raise Exception("Daemon didn't let us connect.")
+    return sock, msg.getDestination()
+
+if __name__ == "__main__":
+    count   = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    window  = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    command = sys.argv[3] if len(sys.argv) > 3 else "status"
+    daemon = EmpDaemon()
+    if daemon.getComPort() is None: 
+        print("Error: Daemon isn't running!")
+        sys.exit(1)
+    
+    sock, myid = connect(daemon)
+    start = time.perf_counter()
+    for _ in range(count):
+        sock.send(makeCommandMsg(command, myid))
+        if sock.recvframe() is None: raise Exception("Lost a reply!")
+    took = time.perf_counter()-start
+    print("one at a time:  %8.0f cmds/sec" % (count/took))
+    sock.close()
+    
+    sock, myid = connect(daemon)
+    pipe = DaemonPipeline(sock, window=window)
+    start = time.perf_counter()
+    replies = pipe.run([makeCommandMsg(command, myid) for _ in range(count)])
+    took = time.perf_counter()-start
+    if None in replies: raise Exception("Lost a reply!")
+    print("pipelined (%3d): %7.0f cmds/sec" % (window, count/took))
+    sock.close()
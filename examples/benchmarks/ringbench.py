@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+#
+# Compares the two ways a local process can get a lot of events triggered:
+# pipelined 'trigger' commands over a connection, and pushing them into the
+# daemon's event ring. The daemon has to be sharing one, set the Daemon 
+# section's event-ring option to its size in bytes (eg. 1048576). 
+#
+# By: Alexander Dean
+#
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+from empbase.daemon.EmpDaemon import EmpDaemon
+from empbase.daemon.daemonipc import DaemonClientSocket, DaemonPipeline
+from empbase.event.ringbuffer import connectRing
+from empbase.comm.messages import makeCommandMsg, strToMessage, MSG_TYPES
+
+def connect(daemon):
+    sock = DaemonClientSocket(port=daemon.getComPort(), msgtypes=MSG_TYPES,
+                              path=daemon.getComPath(), bufferSize=65536)
+    sock.connect()
+    msg = strToMessage(sock.recvframe())
+    if msg is None or msg.getValue() != "proceed":
+        raise Exception("Daemon didn't let us connect.")
+    return sock, msg.getDestination()
+
+def received(sock, myid):
+    sock.send(makeCommandMsg("stats", myid))
+    return strToMessage(sock.recvframe(10.0)).getValue()["ring"]["received"]
+
+if __name__ == "__main__":
+    count  = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    target = sys.argv[2] if len(sys.argv) > 2 else "file.filechange"
+    daemon = EmpDaemon()
+    if daemon.getComPort() is None: 
+        print("Error: Daemon isn't running!")
+        sys.exit(1)
+    ring = connectRing(daemon.getRingPath())
+    if ring is None:
+        print("Error: Daemon isn't sharing an event ring!")
+        sys.exit(1)
+    
+    sock, myid = connect(daemon)
+    pipe = DaemonPipeline(sock, window=64)
+    start = time.perf_counter()
+    replies = pipe.run([makeCommandMsg("trigger", myid, args=[target]) for _ in range(count)])
+    took = time.perf_counter()-start
+    if None in replies: raise Exception("Lost a reply!")
+    print("trigger commands: %9.0f events/sec" % (count/took))
+    
+    before = received(sock, myid)
+    start = time.perf_counter()
+    pushed = 0
+    while pushed < count:
+        if ring.push(target): pushed += 1
+    took = time.perf_counter()-start
+    while received(sock, myid)-before < count: time.sleep(0.001)
+    seen = time.perf_counter()-start
+    print("event ring:       %9.0f events/sec pushed, %9.0f events/sec read" % 
+          (count/took, count/seen))
+    ring.close()
+    sock.close()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+#
+# Times how long the router takes to work out where a message goes. The
+# daemon's registry and attachments are loaded like they would be at start
+# up (but nothing is listened on), padded out with extra interfaces, and
+# then commands for a plug are routed over and over. The routing table can
+# be thrown away before every message to see what a lookup costs without it.
+#
+# By: Alexander Dean
+#
+
+import os
+import sys
+import time
+import logging
+from types import SimpleNamespace
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+from empbase.daemon.EmpDaemon import EmpDaemon
+from empbase.comm.messages import makeCommandMsg
+
+def bench(router, msgs, uncached=False):
+    queue = router._msg_queue
+    start = time.perf_counter()
+    for msg in msgs:
+        if uncached: router.invalidate()
+        router.route(msg)
+    seconds = time.perf_counter()-start
+    while not queue.empty(): queue.get_nowait() # the error replies.
+    return len(msgs)/seconds
+
+if __name__ == "__main__":
+    count   = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    targets = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    logging.disable(logging.WARNING)
+    
+    daemon = EmpDaemon()
+    daemon._setup(threaded=False)
+    router, registry = daemon.router, daemon.registry
+    for _ in range(targets): registry.registerInterface(SimpleNamespace(ID=None))
+    
+    plugs = daemon.aman.getPlugs()
+    if not plugs:
+        print("Error: No plugs were loaded to send commands to!")
+        sys.exit(1)
+    plug = plugs[0].plugname
+    # a command that doesn't exist, so its only the lookup being timed and 
+    # not the plug's command too.
+    msgs = [makeCommandMsg("nosuchcommand", daemon.ID, dest=plug) for _ in range(count)]
+    
+    print("%d commands to '%s', %d targets registered:" % 
+          (count, plug, len(list(registry.getAttachIds()))))
+    print("routing table  %9.0f msg/s" % bench(router, msgs))
+    if hasattr(router, "invalidate"):
+        print("no table       %9.0f msg/s" % bench(router, msgs, uncached=True))
+    
+    for signal in daemon.aman.getSignalPlugs():
+        signal.plugin_object.deactivate()
+    router.flush()
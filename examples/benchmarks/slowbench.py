@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+#
+# Checks that an interface which stops reading can't hold up the daemon. A
+# "stalled" connection sends a flood of commands and never reads a reply,
+# while a second connection times its own commands the whole time. Once its
+# done, the daemon's output stats show how many messages were dropped or
+# connections closed because of the stalled one (see the Daemon section's
+# output-buffer and slow-consumer options).
+#
+# By: Alexander Dean
+#
+
+import os
+import sys
+import time
+import json
+from socket import SOL_SOCKET, SO_RCVBUF
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+from empbase.daemon.EmpDaemon import EmpDaemon
+from empbase.daemon.daemonipc import DaemonClientSocket
+from empbase.comm.messages import makeCommandMsg, strToMessage, MSG_TYPES
+
+def connect(port, path, rcvbuf=None):
+    sock = DaemonClientSocket(port=port, msgtypes=MSG_TYPES, path=path, bufferSize=65536)
+    sock.connect()
+    if rcvbuf is not None: sock.socket.setsockopt(SOL_SOCKET, SO_RCVBUF, rcvbuf)
+    msg = strToMessage(sock.recvframe())
+    if msg is None or msg.getValue() != "proceed":
+        raise Exception("Daemon didn't let us connect.")
+    return sock, msg.getDestination()
+
+def stats(port, path):
+    sock, myID = connect(port, path)
+    sock.send(makeCommandMsg("stats", myID))
+    reply = strToMessage(sock.recvframe(10.0))
+    sock.close()
+    return reply.getValue()
+
+def report(name, times):
+    times = sorted(times)
+    print("%-14s median %7.2fms  p90 %7.2fms  max %7.2fms" % 
+          (name, times[len(times)//2]*1000, times[int(len(times)*0.9)]*1000, 
+           times[-1]*1000))
+
+if __name__ == "__main__":
+    count   = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    command = sys.argv[2] if len(sys.argv) > 2 else "cmds"
+    daemon = EmpDaemon()
+    port, path = daemon.getComPort(), daemon.getComPath()
+    if port is None: 
+        print("Error: Daemon isn't running!")
+        sys.exit(1)
+    before = stats(port, path)["output"]
+    
+    stalled, stalledID = connect(port, path, rcvbuf=4096)
+    quiet, quietID = connect(port, path)
+    times = []
+    for i in range(count):
+        try: stalled.send(makeCommandMsg(command, stalledID))
+        except Exception: pass # we were hung up on.
+        if i % 10 == 0:
+            start = time.perf_counter()
+            quiet.send(makeCommandMsg("status", quietID))
+            if quiet.recvframe(10.0) is None: raise Exception("No reply.")
+            times.append(time.perf_counter()-start)
+    time.sleep(0.5)
+    stalled.close()
+    quiet.close()
+    
+    print("%d '%s' commands that were never read, and %d timed 'status':" % 
+          (count, command, len(times)))
+    report("quiet", times)
+    after = stats(port, path)["output"]
+    print(json.dumps(dict((k, after[k]-before.get(k, 0)) if k != "peak-buffer" 
+                          else (k, after[k]) for k in after), sort_keys=True))
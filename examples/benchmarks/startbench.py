@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+#
+# Times how long finding and loading the attachments takes at start up, with
+# a cold plugin manifest (the first start, or everything changed) and a warm
+# one (nothing changed since last time), and then with lazy-load on. A 
+# directory is filled with made up LoopPlugs, each with its EMP file, spread 
+# over a few sub-directories, and then an attachment manager looks through it
+# like the daemon's would. Only the first few of them are made active, the 
+# rest are left for lazy-load to leave alone. The memory is what's still
+# allocated once they're loaded.
+#
+# By: Alexander Dean
+#
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+from empbase.attach.VariablePluginManager import VariablePluginManager
+from empbase.attach.management import ATTACH_CAT, ATTACH_EXT
+from empbase.config.empconfigparser import EmpConfigParser
+from empbase.registration.registry import Registry
+
+EMP_FILE = """[Core]
+Name = Bench Plug %(n)d
+Module = benchplug%(n)d
+Cmd = benchplug%(n)d
+
+[Documentation]
+Author = Alexander Dean
+Version = 0.1
+Description = A plug that does nothing, for startbench.py.
+
+[Defaults]
+makeactive = %(active)s
+importance = %(n)d
+"""
+
+PY_FILE = """from empbase.attach.attachments import LoopPlug
+class BenchPlug%(n)d(LoopPlug):
+    def __init__(self, config): LoopPlug.__init__(self, config)
+    def get_events(self): return []
+    def get_commands(self): return []
+    def update(self): pass
+"""
+
+def fill(directory, count, subdirs, active):
+    for n in range(count):
+        where = os.path.join(directory, "dir%d" % (n % subdirs))
+        os.makedirs(where, exist_ok=True)
+        with open(os.path.join(where, "benchplug%d.emp" % n), "w") as f: 
+            f.write(EMP_FILE % {"n":n, "active":n < active})
+        with open(os.path.join(where, "benchplug%d.py" % n), "w") as f: f.write(PY_FILE % {"n":n})
+    # the manifest doesn't trust anything changed in the last few seconds.
+    old = time.time()-60
+    for dirpath, dirs, files in os.walk(directory):
+        for name in files+dirs: os.utime(os.path.join(dirpath, name), (old, old))
+    os.utime(directory, (old, old))
+
+def start(config, registry, directory, manifest, lazy):
+    aman = VariablePluginManager(config, registry, categories_filter=ATTACH_CAT,
+                                 directories_list=[directory], plugin_info_ext=ATTACH_EXT,
+                                 manifest_file=manifest, lazy=lazy)
+    begin = time.perf_counter()
+    aman.locatePlugins()
+    found = time.perf_counter()
+    aman.loadPlugins()
+    loaded = time.perf_counter()
+    return found-begin, loaded-begin, aman
+
+def run(name, rounds, config, registry, directory, manifest, cold, lazy=False):
+    finds, totals = [], []
+    for _ in range(rounds+1):
+        if cold and os.path.exists(manifest): os.remove(manifest)
+        if len(finds) == rounds: # one more, to see what it holds on to.
+            tracemalloc.start()
+            aman = start(config, registry, directory, manifest, lazy)[2]
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            break
+        find, total, aman = start(config, registry, directory, manifest, lazy)
+        finds.append(find)
+        totals.append(total)
+    print("%-12s %3d attachments  discovery %8.2fms  discovery+load %8.2fms  memory %7.1fKB" %
+          (name, len(aman.getAllPlugins()), min(finds)*1000, min(totals)*1000, memory/1024))
+
+if __name__ == "__main__":
+    count  = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    active = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    logging.disable(logging.WARNING)
+
+    tmp = tempfile.mkdtemp(prefix="startbench")
+    try:
+        directory, manifest = os.path.join(tmp, "plugs"), os.path.join(tmp, "manifest.json")
+        fill(directory, count, max(count//20, 1), active)
+        config = EmpConfigParser()
+        registry = Registry(os.path.join(tmp, "registry.xml"))
+
+        run("no manifest", rounds, config, registry, directory, "", True)
+        run("cold", rounds, config, registry, directory, manifest, True)
+        run("warm", rounds, config, registry, directory, manifest, False)
+        run("lazy", rounds, config, registry, directory, manifest, False, lazy=True)
+    finally: shutil.rmtree(tmp)
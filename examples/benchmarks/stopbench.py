@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+#
+# Restarts a running daemon a few times and prints how long each restart 
+# took, counting from the restart until the new daemon answers a 'status' 
+# command, and then how long stopping it took.
+#
+# By: Alexander Dean
+#
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+from empbase.daemon.EmpDaemon import EmpDaemon
+from empbase.daemon.daemonipc import DaemonClientSocket
+from empbase.comm.messages import makeCommandMsg, strToMessage, MSG_TYPES
+
+def answers(daemon):
+    """ Checks that the daemon takes a connection and a command. """
+    try:
+        sock = DaemonClientSocket(port=daemon.getComPort(), msgtypes=MSG_TYPES,
+                                  path=daemon.getComPath())
+        sock.connect()
+        msg = strToMessage(sock.recvframe(1.0))
+        sock.send(makeCommandMsg("status", msg.getDestination()))
+        strToMessage(sock.recvframe(1.0))
+        sock.close()
+        return True
+    except Exception: return False
+
+def waitFor(daemon, timeout=30.0):
+    deadline = time.monotonic()+timeout
+    while not answers(daemon):
+        if time.monotonic() > deadline: raise Exception("Daemon never came up!")
+        time.sleep(0.01)
+
+if __name__ == "__main__":
+    count  = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    daemon = EmpDaemon()
+    if daemon.getComPort() is None: 
+        print("Error: Daemon isn't running!")
+        sys.exit(1)
+    
+    # the daemon is started from the src directory, like empd.py does it.
+    os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+    for i in range(count):
+        start = time.perf_counter()
+        daemon.restart()
+        stopped = time.perf_counter()-start
+        waitFor(daemon)
+        print("restart %d: %6.3fs to stop the old one, %6.3fs until the new one answers" %
+              (i+1, stopped, time.perf_counter()-start))
+    start = time.perf_counter()
+    daemon.stop()
+    print("stop:      %6.3fs" % (time.perf_counter()-start))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+#
+# Compares the daemon's two local transports, TCP on localhost and the unix
+# socket next to the pid-file. Each round is a whole emp style invocation:
+# connect, wait for proceed, send a command and read the reply. The port and
+# path are looked up once up front, so its just the transport being timed.
+#
+# By: Alexander Dean
+#
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+from empbase.daemon.EmpDaemon import EmpDaemon
+from empbase.daemon.daemonipc import DaemonClientSocket
+from empbase.comm.messages import makeCommandMsg, strToMessage, MSG_TYPES
+
+def roundtrip(port, path, command):
+    """ Connect, handshake, one command, hang up. """
+    sock = DaemonClientSocket(port=port, msgtypes=MSG_TYPES, path=path)
+    sock.connect()
+    msg = strToMessage(sock.recvframe())
+    if msg is None or msg.getValue() != "proceed":
+        raise Exception("Daemon didn't let us connect.")
+    sock.send(makeCommandMsg(command, msg.getDestination()))
+    strToMessage(sock.recvframe())
+    sock.close()
+
+def report(name, times):
+    times = sorted(times)
+    print("%-8s min %6.2fms  median %6.2fms  p90 %6.2fms  max %6.2fms" % 
+          (name, times[0]*1000, times[len(times)//2]*1000, 
+           times[int(len(times)*0.9)]*1000, times[-1]*1000))
+
+if __name__ == "__main__":
+    count   = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    command = sys.argv[2] if len(sys.argv) > 2 else "status"
+    daemon = EmpDaemon()
+    port, path = daemon.getComPort(), daemon.getComPath()
+    if port is None: 
+        print("Error: Daemon isn't running!")
+        sys.exit(1)
+    
+    transports = [("tcp", None)]
+    if path is not None: transports.append(("unix", path))
+    else: print("The daemon isn't listening on a unix socket, TCP only.")
+    
+    print("%d rounds of connect+%s:" % (count, command))
+    for name, p in transports:
+        for _ in range(10): roundtrip(port, p, command) # warm up
+        times = []
+        for _ in range(count):
+            start = time.perf_counter()
+            roundtrip(port, p, command)
+            times.append(time.perf_counter()-start)
+        report(name, times)
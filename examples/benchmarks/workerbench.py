@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+#
+# Shows what a busy LoopPlug costs the rest of the daemon, with and without
+# worker processes. A few plugs whose updates keep the CPU busy in python are
+# updated side by side, while a thread standing in for the router times how
+# late it wakes up from a 1ms sleep. In the daemon's process the plugs hold
+# the GIL and the router waits on them, in worker processes (worker-process
+# in their sections) they have a core each.
+#
+# By: Alexander Dean
+#
+
+import os
+import sys
+import time
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src"))
+
+from empbase.attach.attachments import LoopPlug
+from empbase.attach.workers import makeAttachment, stopWorkers
+from empbase.config.empconfigparser import TinyCfgPrsr
+
+class BusyPlug(LoopPlug):
+    """ Counts to a million every update, like a plug parsing a log would."""
+    def __init__(self, config):
+        LoopPlug.__init__(self, config)
+    def get_events(self): return []
+    def get_commands(self): return []
+    def update(self, *args):
+        total = 0
+        for i in range(1000000): total += i
+        return total
+
+def lateness(done, lates):
+    while not done:
+        start = time.perf_counter()
+        time.sleep(0.001)
+        lates.append(time.perf_counter()-start-0.001)
+
+def run(name, plugs, rounds):
+    done, lates = [], []
+    ticker = Thread(target=lateness, args=(done, lates))
+    ticker.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(plugs)) as pool:
+        for future in [pool.submit(plug.update) for plug in plugs for _ in range(rounds)]:
+            future.result()
+    seconds = time.perf_counter()-start
+    done.append(True)
+    ticker.join()
+    print("%-10s %7.2fs for %d updates  router late by %6.2fms mean, %7.2fms max" %
+          (name, seconds, len(plugs)*rounds, sum(lates)*1000/len(lates), max(lates)*1000))
+
+if __name__ == "__main__":
+    count  = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    run("in-daemon", [makeAttachment(BusyPlug, TinyCfgPrsr({}), __file__)
+                      for _ in range(count)], rounds)
+    try:
+        plugs = [makeAttachment(BusyPlug, TinyCfgPrsr({"worker-process":"true"}), __file__)
+                 for _ in range(count)]
+        run("workers", plugs, rounds)
+    finally: stopWorkers()
@@ -23,7 +23,7 @@ limitations under the License.
 """
 
 __simple__ = "emp [options] [command [args ...]]"
-__usage__ = "emp [-h | -a | -i | -l | -t T [ -g | -? C ]] [-n | -p | -r] [cmd [args ...]]"
+__usage__ = "emp [-h | -a | -i | -l | --master | --batch | -f F [--atomic] | -t T [ -g | -? C ]] [-n | -p | -r] [-c C] [-S S] [cmd [args ...]]"
 __desc__ = '''
 Emp is the interface for the EMP Daemon. This is a full "general case"  
 interface for handling most (if not all) commands for every plug-in, alarm, 
@@ -31,12 +31,19 @@ and the daemon itself. The interactive mode is a simple Curses interface for
 looking cool while monitoring the hell out of your plug-ins. 
 '''
 import sys
+import shlex
+import signal
 import argparse
-from empbase.daemon.EmpDaemon import EmpDaemon
-from empbase.comm.messages import makeCommandMsg,strToMessage
+from empbase.comm.messages import makeCommandMsg,makeBatchMsg,strToMessage,MSG_TYPES, \
+                                  ERROR_MSG_TYPE, ALERT_MSG_TYPE
+from empbase.comm.codec import JSON_CODEC, CODECS
 from empbase.daemon.daemonipc import DaemonClientSocket
 
 from interface.printhelper import fancyprint, checkMsg
+from interface.controlmaster import ControlMaster, connectMaster, controlPath
+
+# Big enough for a batch file of a few hundred commands.
+BUFFER_SIZE = 65536
 
 
 def help():
@@ -53,6 +60,24 @@ Optional arguments:
   -l, --list         List targets.
   -t T, --target T   Change the command target by name or id. (Defaults to the
                       pointing at the daemon).
+  -f F, --file F     Send every command in the file F to the daemon at once,
+                      one per line as 'command [args ...]'. A line can start
+                      with '-t T' to change its target, and '#' starts a 
+                      comment. 
+  --atomic           With -f, if any command fails the rest are skipped and
+                      any subscription changes are undone. Only works with
+                      the daemon's subscribe and unsubscribe. A file of '-'
+                      is read from stdin.
+  --batch            Read commands from stdin, one per line like in a batch 
+                      file, and run them one after another over the same 
+                      connection. Each reply is printed on its own line.
+  --master           Stay connected to the daemon and let other emp's use the
+                      connection through a control socket, so they don't have
+                      to connect on their own. Runs until stopped or the 
+                      daemon shuts down.
+  -S S, --control S  The control socket to use, or make with --master. 
+                      Defaults to $EMP_CONTROL or ~/.emp/master.sock. If no
+                      master is running there emp connects on its own.
                       
 Output arguments: 
   -n, --nowait       Don't wait for a response from the daemon for the 
@@ -60,6 +85,8 @@ Output arguments:
   -p, --pretty       Attempt to format the raw JSON that comes out of EMP.
   -r, --nopretty     Some commands will asked to be pretty, this forces
                       them to be raw JSON. Use if utilizing in a script.
+  -c C, --codec C    The message codec to talk to the daemon in, either
+                      'json' (default) or 'bin'.
    
 Target commands:
   -g, --tcmds        Get target's commands.
@@ -82,6 +109,11 @@ def setupParser():
     parser.add_argument("-i", action="store_true")
     parser.add_argument("-l","--list", action="store_true")
     parser.add_argument("-a","--all", action="store_true")
+    parser.add_argument("-f","--file", nargs=1, metavar="F")
+    parser.add_argument("--atomic", action="store_true")
+    parser.add_argument("--batch", action="store_true")
+    parser.add_argument("--master", action="store_true")
+    parser.add_argument("-S","--control", nargs=1, metavar="S")
     
     parser.add_argument("-t","--target", nargs=1, metavar="T")
     parser.add_argument("-g","--tcmds", action="store_true")
@@ -90,11 +122,92 @@ def setupParser():
     parser.add_argument("-n", "--nowait", action="store_true")
     parser.add_argument("-p", "--pretty", action="store_true")
     parser.add_argument("-r", "--nopretty", action="store_true")
+    parser.add_argument("-c", "--codec", default=JSON_CODEC, choices=CODECS)
     
     parser.add_argument("command", nargs='*')
     return parser
 
 
+def parseLine(line, target):
+    """ Parses a line of a batch file. Each line is a command just like it 
+    would be given to emp, with an optional '-t T' in front of it for a 
+    different target than the default. Returns None for blank lines.
+    """
+    words = shlex.split(line, comments=True)
+    dest = target
+    if len(words) > 2 and words[0] in ("-t", "--target"):
+        dest, words = words[1], words[2:]
+    if len(words) < 1: return None
+    return {"dest":dest, "command":words[0], "args":words[1:]}
+
+def readBatch(path, target):
+    """ Reads a batch file into the list of commands for a batch message. """
+    if path == "-": lines = sys.stdin.readlines()
+    else:
+        with open(path) as batchfile: lines = batchfile.readlines()
+    return [cmd for cmd in (parseLine(line, target) for line in lines) if cmd is not None]
+
+def runBatch(daemon, myID, args):
+    """ Runs the commands coming in on stdin one at a time over the same 
+    connection. Each reply is printed as soon as it comes back, so a script
+    can keep emp open and talk to it through a pipe.
+    """
+    for line in sys.stdin:
+        cmd = parseLine(line, args.target[0])
+        if cmd is None: continue
+        daemon.send(makeCommandMsg(cmd["command"], myID, dest=cmd["dest"], args=cmd["args"]))
+        msg = strToMessage(daemon.recvframe())
+        while msg is not None and msg.getType() == ALERT_MSG_TYPE: # not ours.
+            msg = strToMessage(daemon.recvframe())
+        
+        if msg is None: 
+            print("ERROR: Is the Daemon running?")
+            break
+        elif msg.getType() == ERROR_MSG_TYPE: print("ERROR:",msg.getValue())
+        elif args.pretty: fancyprint(msg.getValue())
+        else: print(msg.getValue())
+        sys.stdout.flush()
+
+def connect(args):
+    """ Connects to the daemon and returns the socket and its 'proceed' 
+    message, or None if it isn't running. A control master is used if there 
+    is one, which saves loading the daemon's configuration and a handshake.
+    """
+    daemon = None
+    if not args.master:
+        daemon = connectMaster(controlPath(args.control and args.control[0]), BUFFER_SIZE)
+    if daemon is None:
+        # only loaded when needed, its most of emp's start up time.
+        from empbase.daemon.EmpDaemon import EmpDaemon
+        edaemon = EmpDaemon()
+        commport = edaemon.getComPort()
+        if commport is None: return None
+        
+        # the unix socket is quicker, so use it if the daemon has one.
+        daemon = DaemonClientSocket(port=commport, msgtypes=MSG_TYPES,
+                                    path=edaemon.getComPath(),
+                                    bufferSize=BUFFER_SIZE)
+        daemon.connect()
+    return daemon, strToMessage(daemon.recvframe())
+
+def runMaster(daemon, proceed, args):
+    """ Shares the connection through the control socket until the daemon 
+    shuts down or we're interrupted.
+    """
+    path = controlPath(args.control and args.control[0])
+    other = connectMaster(path)
+    if other is not None:
+        other.close()
+        print("Error: There's already a control master at %s" % path)
+        return
+    print("Control master listening on %s" % path)
+    sys.stdout.flush()
+    # being killed cleans up the control socket just like ^C does.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try: ControlMaster(daemon, proceed, path).run()
+    except KeyboardInterrupt: pass
+
+
 #
 # MAIN 
 #  Handles the incoming command and parses it.
@@ -115,24 +228,30 @@ def main():
     else:
         try:
             # we will be communicating with the daemon
-            commport = EmpDaemon().getComPort()
-            if commport is None: print("Error: Daemon isn't running!");return
-            
-            daemon = DaemonClientSocket(port=commport)
-            daemon.connect()
-            msg = strToMessage(daemon.recv())
+            conn = connect(args)
+            if conn is None: print("Error: Daemon isn't running!");return
+            daemon, msg = conn
             if msg is None or msg.getValue() != "proceed": 
                 print("Error: Couldn't connect to the daemon.")
                 return
             
             myID = msg.getDestination()
+            if args.master: 
+                runMaster(daemon, msg, args)
+                return
+            
+            # switch codecs if both of us know the one that was asked for.
+            if args.codec != JSON_CODEC and args.codec in (msg.get("args") or []):
+                daemon.send(makeCommandMsg("codec", myID, args=[args.codec]))
+                daemon.CODEC = checkMsg(daemon.recvframe(), str) or JSON_CODEC
                 
             #what are we communicating    
-            if args.list:
+            if args.batch: runBatch(daemon, myID, args)
+            elif args.list:
                 daemon.send(makeCommandMsg("alarms",myID))
-                alerters = checkMsg(daemon.recv())
+                alerters = checkMsg(daemon.recvframe())
                 daemon.send(makeCommandMsg("plugs",myID))
-                plugs = checkMsg(daemon.recv())
+                plugs = checkMsg(daemon.recvframe())
             
                 #print the list all pretty like:
                 print("Attached targets and their temp IDs:") #TODO: make option to make it nopretty?
@@ -149,9 +268,26 @@ def main():
                 print()
                 
         
+            elif args.file:
+                cmds = readBatch(args.file[0], args.target[0])
+                daemon.send(makeBatchMsg(cmds, myID, atomic=args.atomic))
+                if not args.nowait:
+                    result = checkMsg(daemon.recvframe(), dict)
+                    if result is None: pass # it wasn't a batch reply, its been printed.
+                    elif args.pretty:
+                        for res in result["results"]:
+                            if "error" in res: print("%s: ERROR: %s" % (res["command"], res["error"]))
+                            elif isinstance(res["value"], str): print("%s: %s" % (res["command"], res["value"]))
+                            else: 
+                                print("%s:" % res["command"])
+                                fancyprint(res["value"])
+                        if result["rolledback"]: print("Changes were undone.")
+                    else: print(result)
+                else: print("success")
+                
             elif args.all: 
                 daemon.send(makeCommandMsg("help",myID, args=["all"]))
-                cmds = checkMsg(daemon.recv(), dict)
+                cmds = checkMsg(daemon.recvframe(), dict)
                 for target in cmds.keys():
                     if args.pretty: print("%s"%target)
                     if len(cmds[target].keys()) > 0:
@@ -166,14 +302,14 @@ def main():
                 # now we can start parsing targets and figuring out what to do with them
                 if args.tcmds:
                     daemon.send(makeCommandMsg("help",myID, args=args.target))
-                    cmds = checkMsg(daemon.recv(), dict)
+                    cmds = checkMsg(daemon.recvframe(), dict)
                     if args.pretty: 
                         print("%s Commands: "%args.target[0])
                         fancyprint(cmds)
                     else: print(str(cmds))
                 elif args.ask:
                     daemon.send(makeCommandMsg("help",myID, args=args.target))
-                    cmds = checkMsg(daemon.recv(), dict)
+                    cmds = checkMsg(daemon.recvframe(), dict)
                     cmdfound = False
                     for cmd in cmds.keys():
                         if args.ask[0] == cmd:
@@ -189,14 +325,14 @@ def main():
                     if len(args.command) < 1:
                         print("Usage: ",__usage__)
                         daemon.send(makeCommandMsg("help", myID, args=args.target))
-                        cmds = checkMsg(daemon.recv(), dict)
+                        cmds = checkMsg(daemon.recvframe(), dict)
                         print("\n%s Commands: "%args.target[0])
                         fancyprint(cmds)
                     else:
                         daemon.send(makeCommandMsg(args.command[0], myID, dest=args.target[0], args=args.command[1:]))
                         
                         if not args.nowait:
-                            result = checkMsg(daemon.recv())
+                            result = checkMsg(daemon.recvframe())
                             # since this is a general case interface, we don't really know 
                             # how to interpret the result of an argument. But this can
                             # be utilized in a script or a higher level interface. if you 
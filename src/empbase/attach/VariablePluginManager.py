@@ -15,16 +15,28 @@ limitations under the License.
 import os
 import sys
 import re
+import time
 import logging
+from functools import partial
+from threading import Lock
 from yapsy.IPlugin import IPlugin
 from yapsy.PluginInfo import PluginInfo
 from yapsy.PluginManager import PluginManager
 from yapsy.FilteredPluginManager import FilteredPluginManager
+from empbase.attach.workers import makeAttachment, dropAttachment
+from empbase.attach.manifest import PluginManifest
+from empbase.attach.lazy import LazyAttachment, makeStandIn
+from empbase.attach.startup import Startup, resolveDepends, DEFAULT_WORKERS, DEFAULT_TIMEOUT, DONE
+
+# what's kept of an attachment's info in the manifest.
+INFO_FIELDS = ("name", "path", "author", "version", "website", "copyright",
+               "description", "plugname", "load", "module", "defaults", "depends")
 
 
 class EmpAttachmentInfo(PluginInfo):
     def __init__(self, plugin_name, plugin_path):
         self.defaults = {}
+        self.depends = []
         self.plugname = str(plugin_name).strip().lower().replace(" ", "")
         re.sub(r'[^\w]', '', self.plugname)
         self.module=""
@@ -51,16 +63,20 @@ class VariablePluginManager(FilteredPluginManager):
     def __init__(self, cfg_p, registry, 
                  categories_filter={"Default":IPlugin}, 
                  directories_list=None, 
-                 plugin_info_ext="yapsy-plugin"):
+                 plugin_info_ext="yapsy-plugin",
+                 manifest_file=None, lazy=False,
+                 startup_workers=DEFAULT_WORKERS, startup_timeout=DEFAULT_TIMEOUT):
         """ Creates the base VariablePluginManagaer. """
         decorated_object = DefaultPluginManager(cfg_p, registry,
                                                 categories_filter,
                                                 directories_list,
-                                                plugin_info_ext)
+                                                plugin_info_ext,
+                                                manifest_file, lazy,
+                                                startup_workers, startup_timeout)
         
         FilteredPluginManager.__init__(self, decorated_manager=decorated_object)
         
-    def isPluginOK(self, info):
+    def isPluginOk(self, info):
         """ All attachments need to have the 'Cmd' variable in the 'Core' section
         of their description files. If ever there is a 'load' variable in the 
         'Core' section, then it will check if its False. This is a quick way of 
@@ -77,90 +93,280 @@ class DefaultPluginManager(PluginManager):
     each plug-in. These variables are read in and can be passed into the plug-in
     by using a dict object, or in EMPs case a TinyCfgPrsr object, see 
     empbase.config.empconfigparser.
+    
+    What's found is remembered in a manifest (see empbase.attach.manifest),
+    so the next start only has to look again at what's changed. If lazy is 
+    True, the attachments that won't be active aren't imported until they're
+    wanted. The rest are loaded side by side (see empbase.attach.startup).
     """
     def __init__(self, cfg_p, registry,
                  categories_filter={"Default":IPlugin}, 
                  directories_list=None, 
-                 plugin_info_ext="yapsy-plugin"):
+                 plugin_info_ext="yapsy-plugin",
+                 manifest_file=None, lazy=False,
+                 startup_workers=DEFAULT_WORKERS, startup_timeout=DEFAULT_TIMEOUT):
         PluginManager.__init__(self, categories_filter, directories_list, plugin_info_ext)
         self.setPluginInfoClass(EmpAttachmentInfo)
         self.config = cfg_p
         self.registry = registry
+        self.manifest = PluginManifest(manifest_file, plugin_info_ext)
+        self.lazy = lazy
+        self._wakelock = Lock()
+        self._configlock = Lock()
+        self.startupWorkers = startup_workers
+        self.startupTimeout = startup_timeout
+        self.loadTimeline = None # how long each took to load.
+    
+    def locatePlugins(self):
+        """Re-written to walk the plug-in directories and read the info files
+        through the manifest. Returns the number of plug-ins found.
+        """
+        start = time.perf_counter()
+        self._candidates = []
+        for directory in map(os.path.abspath, self.plugins_places):
+            if not os.path.isdir(directory):
+                logging.debug("%s skips %s (not a directory)" % (self.__class__.__name__, directory))
+                continue
+            for dirpath, filename in self.manifest.walk(directory):
+                candidate_infofile = os.path.join(dirpath, filename)
+                plugin_info = self.__cachedPluginInfo(dirpath, filename)
+                if plugin_info is None:
+                    logging.debug("Candidate rejected: %s" % candidate_infofile)
+                    continue
+                # the file to execute depends on whether the path given is a 
+                # directory or a file.
+                if os.path.isdir(plugin_info.path):
+                    candidate_filepath = os.path.join(plugin_info.path, "__init__")
+                elif os.path.isfile(plugin_info.path+".py"):
+                    candidate_filepath = plugin_info.path
+                else: continue
+                self._candidates.append((candidate_infofile, candidate_filepath, plugin_info))
+        logging.debug("found %d attachments in %.1fms (manifest: %d hits, %d misses)" %
+                      (len(self._candidates), (time.perf_counter()-start)*1000,
+                       self.manifest.hits, self.manifest.misses))
+        return len(self._candidates)
+    
+    def __cachedPluginInfo(self, directory, filename):
+        """ The plug-in's info from the manifest, or gathered from its info
+        file if that's changed since.
+        """
+        def parse():
+            plugin_info = self.gatherBasicPluginInfo(directory, filename)
+            if plugin_info is None: return None
+            return dict((field, getattr(plugin_info, field)) for field in INFO_FIELDS)
+        
+        fields = self.manifest.info(os.path.join(directory, filename), parse)
+        if fields is None: return None
+        plugin_info = self._plugin_info_cls(fields["name"], fields["path"])
+        for field in INFO_FIELDS[2:]:
+            if field == "version": plugin_info.setVersion(fields[field])
+            elif field == "defaults": plugin_info.setDefaults(fields[field])
+            else: setattr(plugin_info, field, fields[field])
+        return plugin_info
     
+    def __findAttachmentClass(self, candidate_globals, filename):
+        """ Finds the attachment's class in its module's globals, returns it
+        and its category, or (None, None). The manifest remembers which it was
+        so it doesn't need looking for next time.
+        """
+        cached = self.manifest.module(filename)
+        if cached is not None:
+            classname, category = cached
+            element = candidate_globals.get(classname)
+            interface = self.categories_interfaces.get(category)
+            try:
+                if interface is not None and element is not interface and \
+                   issubclass(element, interface):
+                    return element, category
+            except TypeError: pass
+        
+        for element in candidate_globals.values():
+            for category_name in self.categories_interfaces:
+                try:
+                    is_correct_subclass = issubclass(element, self.categories_interfaces[category_name])
+                except: 
+                    continue
+                
+                if is_correct_subclass:
+                    if element is not self.categories_interfaces[category_name]:
+                        self.manifest.setModule(filename, element.__name__, category_name)
+                        return element, category_name
+        return None, None
+
         
     def loadPlugins(self, callback=None):
         """Re-written to allow for passing variables to the new plug-ins and to
-        register them with the message router. 
+        register them with the message router. In lazy mode the ones that won't
+        be active get a stand-in instead (see empbase.attach.lazy).
         """
         
         if not hasattr(self, '_candidates'):
             raise ValueError("locatePlugins must be called before loadPlugins")
 
+        loading = []
         for candidate_infofile, candidate_filepath, plugin_info in self._candidates:
             if callback is not None:
                 callback(plugin_info)
-                
-            candidate_globals = {"__file__":candidate_filepath+".py"}
-            if "__init__" in  os.path.basename(candidate_filepath):
-                sys.path.append(plugin_info.path)                
-            try:
-                #logging.debug("trying to exec: %s.py" % candidate_filepath)
-                exec(open(candidate_filepath+".py","rb").read(), candidate_globals)
-            except Exception as e:
-                logging.debug("Unable to execute the code in plugin: %s" % candidate_filepath)
-                #logging.debug("\t The following problem occured: %s %s " % (os.linesep, e))
-                logging.exception(e)
-                if "__init__" in  os.path.basename(candidate_filepath):
-                    sys.path.remove(plugin_info.path)
+            
+            if self.lazy and self.__standIn(candidate_infofile, candidate_filepath, plugin_info):
                 continue
-
-            if "__init__" in  os.path.basename(candidate_filepath):
-                sys.path.remove(plugin_info.path)
-                
-            for element in candidate_globals.values():
-                current_category = None
-                for category_name in self.categories_interfaces:
-                    try:
-                        is_correct_subclass = issubclass(element, self.categories_interfaces[category_name])
-                    except: 
-                        continue
-                    
-                    if is_correct_subclass:
-                        if element is not self.categories_interfaces[category_name]:
-                            current_category = category_name
-                            break
-                if current_category is not None:
-                    if not (candidate_infofile in self._category_file_mapping[current_category]): 
-                        # we found a new plugin: initialise it and search for the next one
-                        self.config.defaultAttachmentVars(plugin_info.module, plugin_info.defaults, current_category)
-                        attachmentVars = self.config.getAttachmentVars(plugin_info.module)
-                        
-                        # check that the plug-in is actually wanting to be loaded.
-                        if plugin_info.load:
-                            try:
-                                plugin_info.plugin_object = element(attachmentVars)
-                                plugin_info.category = current_category
-                                
-                                #now we will register the plug-in with the router
-                                self.registry.register( plugin_info.plugname,
-                                                        plugin_info.module,  
-                                                        plugin_info.plugin_object )
-                                
-                                self.category_mapping[current_category].append(plugin_info)
-                                self._category_file_mapping[current_category].append(candidate_infofile)
-                                current_category = None
-                                logging.debug("Loaded attachment: %s", plugin_info.module)
-                            except Exception as e:
-                                logging.exception(e)
-                                if attachmentVars.getboolean("require", False):#killme!!
-                                    logging.exception(e)
-                                    sys.exit(1)
-                        else: logging.debug("Ignoring attachment %s, since load value is false.", plugin_info.module)
-                    break
+            loading.append((candidate_infofile, candidate_filepath, plugin_info))
+        
+        # they're imported and made side by side, those that depend on others
+        # wait for them.
+        startup = Startup("loading", self.startupWorkers)
+        depends = resolveDepends([plugin_info for _, _, plugin_info in loading])
+        for candidate_infofile, candidate_filepath, plugin_info in loading:
+            startup.add(plugin_info.name, 
+                        partial(self.__loadAttachment, candidate_filepath, plugin_info),
+                        depends=depends[plugin_info.name], timeout=self.startupTimeout,
+                        onlate=self.__dropLate)
+        startup.run()
+        
+        # a required one that failed, timed out or was skipped stops the daemon.
+        required = [plugin_info.name for _, _, plugin_info in loading
+                    if startup.state(plugin_info.name) != DONE and 
+                       self.config.getAttachmentVars(plugin_info.module).getboolean("require", False)]
+        
+        # then registered in the order they were found.
+        for candidate_infofile, candidate_filepath, plugin_info in loading:
+            made = startup.result(plugin_info.name)
+            if made is None: continue
+            element, current_category, attachment = made
+            if candidate_infofile in self._category_file_mapping[current_category]:
+                dropAttachment(attachment)
+                continue
+            plugin_info.plugin_object = attachment
+            plugin_info.attachclass = element
+            plugin_info.attachfile = candidate_filepath+".py"
+            plugin_info.category = current_category
+            
+            #now we will register the plug-in with the router
+            self.registry.register( plugin_info.plugname,
+                                    plugin_info.module,  
+                                    plugin_info.plugin_object )
+            self.category_mapping[current_category].append(plugin_info)
+            self._category_file_mapping[current_category].append(candidate_infofile)
+            logging.debug("Loaded attachment: %s", plugin_info.module)
+        
+        self.loadTimeline = startup.timeline()
+        startup.logTimeline()
+        if required:
+            logging.error("Couldn't load required attachments: %s" % ", ".join(required))
+            sys.exit(1)
 
         # Remove candidates list since we don't need them any more and
         # don't need to take up the space
-        delattr(self, '_candidates')      
+        delattr(self, '_candidates')
+        self.manifest.save()
+    
+    def wakeAttachment(self, plugin_info, candidate_filepath):
+        """ Imports and makes the attachment a stand-in is standing in for, and
+        puts it in the stand-in's place. Returns the attachment.
+        """
+        with self._wakelock:
+            if not isinstance(plugin_info.plugin_object, LazyAttachment): 
+                return plugin_info.plugin_object # someone else woke it first.
+            
+            start = time.perf_counter()
+            element, category = self.__importAttachment(candidate_filepath, plugin_info)
+            if element is None:
+                raise Exception("Couldn't import %s." % plugin_info.name)
+            if category != plugin_info.category: # its changed what it is since.
+                self.category_mapping[plugin_info.category].remove(plugin_info)
+                self.category_mapping[category].append(plugin_info)
+            self.__makeAttachment(element, self.config.getAttachmentVars(plugin_info.module),
+                                  candidate_filepath, plugin_info, category)
+            self.manifest.save()
+            logging.debug("Loaded attachment: %s, when it was first wanted (%.1fms)" % 
+                          (plugin_info.module, (time.perf_counter()-start)*1000))
+            return plugin_info.plugin_object
+    
+    def __loadAttachment(self, candidate_filepath, plugin_info):
+        """ Imports the attachment and makes it, returns its class, category
+        and the attachment, or None if its not to be loaded.
+        """
+        element, current_category = self.__importAttachment(candidate_filepath, plugin_info)
+        if current_category is None: 
+            raise Exception("Couldn't load an attachment from %s.py" % candidate_filepath)
+        with self._configlock:
+            self.config.defaultAttachmentVars(plugin_info.module, plugin_info.defaults, current_category)
+            attachmentVars = self.config.getAttachmentVars(plugin_info.module)
+        
+        # check that the plug-in is actually wanting to be loaded.
+        if not plugin_info.load:
+            logging.debug("Ignoring attachment %s, since load value is false.", plugin_info.module)
+            return None
+        # its made in a worker process if its config says so.
+        return (element, current_category, 
+                makeAttachment(element, attachmentVars, candidate_filepath+".py"))
+    
+    def __dropLate(self, made):
+        """ An attachment that was made after the daemon stopped waiting for it
+        isn't used, its worker process is stopped if it has one.
+        """
+        if made is not None: dropAttachment(made[2])
+    
+    def __importAttachment(self, candidate_filepath, plugin_info):
+        """ Executes the attachment's module and finds its class, returns it and
+        its category or (None, None).
+        """
+        candidate_globals = {"__file__":candidate_filepath+".py"}
+        if "__init__" in  os.path.basename(candidate_filepath):
+            sys.path.append(plugin_info.path)                
+        try:
+            #logging.debug("trying to exec: %s.py" % candidate_filepath)
+            exec(open(candidate_filepath+".py","rb").read(), candidate_globals)
+        except Exception as e:
+            logging.debug("Unable to execute the code in plugin: %s" % candidate_filepath)
+            #logging.debug("\t The following problem occured: %s %s " % (os.linesep, e))
+            logging.exception(e)
+            return None, None
+        finally:
+            if "__init__" in  os.path.basename(candidate_filepath):
+                sys.path.remove(plugin_info.path)
+        return self.__findAttachmentClass(candidate_globals, candidate_filepath+".py")
+    
+    def __makeAttachment(self, element, attachmentVars, candidate_filepath, plugin_info, category):
+        # its made in a worker process if its config says so.
+        plugin_info.plugin_object = makeAttachment(element, attachmentVars, 
+                                                   candidate_filepath+".py")
+        plugin_info.attachclass = element
+        plugin_info.attachfile = candidate_filepath+".py"
+        plugin_info.category = category
+        
+        #now we will register the plug-in with the router
+        self.registry.register( plugin_info.plugname,
+                                plugin_info.module,  
+                                plugin_info.plugin_object )
+    
+    def __standIn(self, candidate_infofile, candidate_filepath, plugin_info):
+        """ Registers a stand-in for the attachment if it won't be active at 
+        start up. Its category has to be known without importing it, so the
+        manifest has to have seen it already. Returns if it did.
+        """
+        if not plugin_info.load: return False
+        cached = self.manifest.module(candidate_filepath+".py")
+        if cached is None: return False
+        category = cached[1]
+        interface = self.categories_interfaces.get(category)
+        if interface is None or candidate_infofile in self._category_file_mapping[category]:
+            return False
+        
+        self.config.defaultAttachmentVars(plugin_info.module, plugin_info.defaults, category)
+        attachmentVars = self.config.getAttachmentVars(plugin_info.module)
+        if attachmentVars.getboolean("makeactive", True): return False
+        standin = makeStandIn(interface, attachmentVars, 
+                              partial(self.wakeAttachment, plugin_info, candidate_filepath))
+        if standin is None: return False
+        
+        plugin_info.plugin_object = standin
+        plugin_info.category = category
+        self.registry.register(plugin_info.plugname, plugin_info.module, standin)
+        self.category_mapping[category].append(plugin_info)
+        self._category_file_mapping[category].append(candidate_infofile)
+        logging.debug("Left attachment %s until its wanted.", plugin_info.module)
+        return True
             
     def gatherBasicPluginInfo(self, directory, filename):
         plugin_info,config_parser = self._gatherCorePluginInfo(directory, filename)
@@ -188,6 +394,9 @@ class DefaultPluginManager(PluginManager):
             else: plugin_info.load = True
             if config_parser.has_option("Core","Module"):
                 plugin_info.module = config_parser.get("Core","Module")
+            if config_parser.has_option("Core","Depends"):
+                plugin_info.depends = [name.strip() for name in 
+                                       config_parser.get("Core","Depends").split(",") if name.strip()]
         
         if config_parser.has_section("Defaults"):
             for option in config_parser.options("Defaults"):
@@ -22,6 +22,7 @@ limitations under the License.
 #
 __version__="0.9.2"
 
+import asyncio
 from threading import Thread
 from yapsy.IPlugin import IPlugin
 
@@ -139,7 +140,12 @@ class SignalPlug(EmpPlug):
         """
         if not self.is_activated:
             self.is_activated = True
-            Thread(target=self.run).start()
+            if asyncio.iscoroutinefunction(self.run):
+                # 'async def run' plugs don't need a thread of their own if
+                # the daemon is using the asyncio runtime.
+                from empbase.daemon.aioruntime import runCoroutine
+                runCoroutine(self.run)
+            else: Thread(target=self.run).start()
     
     def run(self):
         """Signal Plug-ins get their own threads! This is the function that 
@@ -0,0 +1,97 @@
+"""
+Copyright (c) 2010-2011 Alexander Dean (dstar@csh.rit.edu)
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from empbase.attach.attachments import EmpAlarm, LoopPlug, SignalPlug
+
+#
+# With 'lazy-load' on, an attachment that isn't made active at start up isn't
+# imported either. It gets a stand-in that's registered in its place, with its
+# config, so it has its ID and shows up in the lists like it always did. The
+# first time something wants more than that from it (a command for it, asking
+# for its commands, activating it or subscribing to it) the stand-in's wake()
+# imports the real one and puts it in its place.
+#
+# Whatever holds on to the stand-in can keep using it, it passes the calls on
+# to the real attachment once there is one.
+#
+
+class LazyAttachment():
+    """ Mixed in with the attachment interface the stand-in is standing in
+    for. The wake function imports the real attachment and returns it.
+    """
+    def _setWake(self, wake):
+        self.__wake = wake
+        self.__real = None
+
+    def wake(self):
+        if self.__real is None: self.__real = self.__wake()
+        return self.__real
+
+    def isAwake(self):
+        return self.__real is not None
+
+    def activate(self):
+        self.wake().activate()
+
+    def deactivate(self):
+        if self.__real is not None: self.__real.deactivate()
+
+    def save(self):
+        if self.__real is not None: self.__real.save()
+        else: self.config.set("makeactive", self.makeactive)
+
+    def get_commands(self):
+        return self.wake().get_commands()
+
+    def _getIsActivated(self):
+        return self.__real is not None and self.__real.is_activated
+    def _setIsActivated(self, value): pass
+    is_activated = property(_getIsActivated, _setIsActivated)
+
+
+class LazyLoopPlug(LazyAttachment, LoopPlug):
+    def __init__(self, config, wake):
+        LoopPlug.__init__(self, config)
+        self._setWake(wake)
+
+    def get_events(self): return []
+
+    def update(self, *args):
+        return self.wake().update(*args)
+
+
+class LazySignalPlug(LazyAttachment, SignalPlug):
+    def __init__(self, config, wake):
+        SignalPlug.__init__(self, config)
+        self._setWake(wake)
+
+    def get_events(self): return []
+
+
+class LazyAlarm(LazyAttachment, EmpAlarm):
+    def __init__(self, config, wake):
+        EmpAlarm.__init__(self, config)
+        self._setWake(wake)
+
+    def get_alerts(self): return []
+
+
+def makeStandIn(interface, config, wake):
+    """ Makes the stand-in for an attachment of the given interface, or returns
+    None if there isn't one for it.
+    """
+    if issubclass(interface, LoopPlug):     return LazyLoopPlug(config, wake)
+    elif issubclass(interface, SignalPlug): return LazySignalPlug(config, wake)
+    elif issubclass(interface, EmpAlarm):   return LazyAlarm(config, wake)
+    return None
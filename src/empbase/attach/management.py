@@ -14,8 +14,13 @@ limitations under the License.
 """
 
 import logging
+from functools import partial
 from empbase.attach.VariablePluginManager import VariablePluginManager
 from empbase.attach.attachments import EmpAlarm, EmpPlug, LoopPlug, SignalPlug
+from empbase.attach.workers import makeAttachment, dropAttachment
+from empbase.attach.lazy import LazyAttachment
+from empbase.attach.startup import Startup, resolveDepends
+from empbase.config.empconfigparser import CATEGORY_MAP
 
 # the internal categories that the attachment manager can handle.
 LOOPS = "Loops"
@@ -34,29 +39,105 @@ class AttachmentManager(VariablePluginManager):
         VariablePluginManager.__init__( self, config, registry, 
                                         categories_filter=ATTACH_CAT,
                                         directories_list=config.getAttachmentDirs(),
-                                        plugin_info_ext=ATTACH_EXT )
+                                        plugin_info_ext=ATTACH_EXT,
+                                        manifest_file=config.getManifestFile(),
+                                        lazy=config.getboolean("Daemon", "lazy-load"),
+                                        startup_workers=config.getint("Daemon", "startup-workers"),
+                                        startup_timeout=config.getfloat("Daemon", "startup-timeout") )
         # only active attachments have their events registered 
+        self._config = config
         self._registry = registry
         self.eman = eman
+        self.activateTimeline = None # how long each took to activate.
         
     def activateAttachments(self):
         """ Activates the attachments that want to be activated on
         start-up. The rest are in idle state until hand-activated by 
-        the user.
+        the user. They're activated side by side, after the ones they
+        depend on.
         """
-        for attach in self.getAllPlugins():
-            if attach.plugin_object.makeactive:
-                try:
-                    if isinstance(attach.plugin_object, EmpPlug):
-                        logging.debug("should have loaded events for: %s"%attach.name)
-                        self.eman.loadEvents(attach.plugin_object.get_events())
-                    elif isinstance(attach.plugin_object, EmpAlarm):
-                        self.eman.loadAlerts(attach.plugin_object.get_alerts())
-                    else: continue; #ignore it, how did it get here?
-                    attach.plugin_object.activate()
-                except Exception as e:
-                    logging.exception(e)
+        startup = Startup("activating", self._config.getint("Daemon", "startup-workers"))
+        timeout = self._config.getfloat("Daemon", "startup-timeout")
+        active = [attach for attach in self.getAllPlugins() if attach.plugin_object.makeactive]
+        depends = resolveDepends(active)
+        for attach in active:
+            try: mytimeout = attach.plugin_object.config.getfloat("startup-timeout", timeout)
+            except Exception: mytimeout = timeout
+            startup.add(attach.name, partial(self.__activate, attach), 
+                        depends=depends[attach.name], timeout=mytimeout)
+        startup.run()
+        self.activateTimeline = startup.timeline()
+        startup.logTimeline()
+    
+    def __activate(self, attach):
+        if isinstance(attach.plugin_object, EmpPlug):
+            logging.debug("should have loaded events for: %s"%attach.name)
+            self.eman.loadEvents(attach.plugin_object.get_events())
+        elif isinstance(attach.plugin_object, EmpAlarm):
+            self.eman.loadAlerts(attach.plugin_object.get_alerts())
+        else: return #ignore it, how did it get here?
+        attach.plugin_object.activate()
+    
+    def startupTimeline(self):
+        """ How long each attachment took to load and to activate. """
+        return {"load": self.loadTimeline, "activate": self.activateTimeline}
                 
+    def reloadAttachment(self, attach, activate=False):
+        """ Makes the attachment over again from its config, in place of the
+        old one, which is deactivated. It keeps its ID, and its events and
+        alerts keep theirs, so everything subscribed to it still is. The new
+        one is activated if the old one was, if its config says to, or if
+        activate is True. Its config can also move it into or out of a worker
+        process.
+        """
+        old = attach.plugin_object
+        if isinstance(old, LazyAttachment):
+            # it was never imported, so only its config changes, unless it
+            # should be active now.
+            config = self._config.getAttachmentVars(attach.module)
+            if not (activate or config.getboolean("makeactive", True)):
+                old.config = config
+                return old
+            new = old.wake()
+            if isinstance(new, EmpPlug): self.eman.loadEvents(new.get_events())
+            elif isinstance(new, EmpAlarm): self.eman.loadAlerts(new.get_alerts())
+            new.activate()
+            logging.debug("reloaded attachment: %s" % attach.name)
+            return new
+        
+        wasactive = old.is_activated
+        if wasactive:
+            try: old.deactivate()
+            except Exception as e: logging.exception(e)
+        
+        dropAttachment(old) # its worker process, if it had one.
+        new = makeAttachment(attach.attachclass, self._config.getAttachmentVars(attach.module),
+                             attach.attachfile)
+        attach.plugin_object = new
+        self._registry.register(attach.plugname, attach.module, new)
+        
+        # the old events and alerts are only dropped from the EventManager,
+        # unloading them from the registry would lose their subscriptions.
+        if isinstance(old, EmpPlug): 
+            for event in old.get_events(): self.eman.eventmap.pop(event.ID, None)
+        elif isinstance(old, EmpAlarm):
+            for alert in old.get_alerts(): self.eman.alertmap.pop(alert.ID, None)
+        if wasactive or activate or new.makeactive:
+            if isinstance(new, EmpPlug): self.eman.loadEvents(new.get_events())
+            elif isinstance(new, EmpAlarm): self.eman.loadAlerts(new.get_alerts())
+            new.activate()
+        logging.debug("reloaded attachment: %s" % attach.name)
+        return new
+    
+    def getAttachmentBySection(self, section):
+        """ Returns the attachment whose config is in the given section of the
+        config file, or None.
+        """
+        for attach in self.getAllPlugins():
+            if CATEGORY_MAP.get(attach.category, "")+attach.module == section:
+                return attach
+        return None
+    
     def getLoopPlugs(self):
         """ Get all the loop plug-ins that are loaded. This is used in the pull
         loop thread for updating all of them. 
@@ -114,9 +195,14 @@ class AttachmentManager(VariablePluginManager):
                 return alarm.plugin_object
     
     def getAttachment(self, cid):
+        """ Returns the attachment by id or name, its imported if it hasn't
+        been yet.
+        """
         id = self._registry.getAttachId(cid)
         for attach in self.getAllPlugins():
             if attach.plugin_object.ID == id:
+                if isinstance(attach.plugin_object, LazyAttachment):
+                    return attach.plugin_object.wake()
                 return attach.plugin_object
         return None
     
@@ -0,0 +1,169 @@
+"""
+Copyright (c) 2010-2011 Alexander Dean (dstar@csh.rit.edu)
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import json
+import time
+import logging
+
+#
+# Every start used to walk each attachment directory, parse every EMP file
+# it found with a ConfigParser and then look through each attachment's module
+# for its class. Almost always none of it has changed since last time, so the
+# manifest remembers what was found, keyed by each file's path, mtime and
+# size:
+#
+#    dirs    - what's in each directory walked (its EMP files and sub-dirs),
+#              so an unchanged directory doesn't have to be listed again.
+#    infos   - what was read out of each EMP file, or null if it was rejected.
+#    modules - the class in each attachment's module and its category.
+#
+# Anything whose stat doesn't match is read again like it always was, and
+# anything that wasn't seen this time is dropped when it's saved. Something
+# that changed in the last RACY_WINDOW seconds isn't remembered, since it
+# could change again without its mtime moving (on file systems that only
+# keep whole seconds).
+#
+
+MANIFEST_VERSION = 2
+RACY_WINDOW = 2.0 # seconds
+
+
+def _key(stat):
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class PluginManifest():
+    """ The discovery cache for a PluginManager, see above. If filename is
+    empty nothing is read or saved, and every lookup misses.
+    """
+    def __init__(self, filename, ext):
+        self.filename = filename
+        self.ext = ext
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        self._seen = {"dirs":set(), "infos":set(), "modules":set()}
+        self._data = self.__empty()
+        self.load()
+
+    def __empty(self):
+        return {"version":MANIFEST_VERSION, "ext":self.ext,
+                "dirs":{}, "infos":{}, "modules":{}}
+
+    def load(self):
+        """ Reads in the manifest saved last time, if there is one. """
+        if not self.filename: return
+        try:
+            with open(self.filename, "r") as f: data = json.load(f)
+            if data.get("version") != MANIFEST_VERSION or data.get("ext") != self.ext:
+                logging.debug("plugin manifest %s is out of date, ignoring it." % self.filename)
+                self._dirty = True
+            else: self._data = data
+        except IOError: pass # no such file? first start.
+        except Exception as e:
+            logging.warning("couldn't read the plugin manifest %s: %s" % (self.filename, e))
+            self._dirty = True
+
+    def save(self):
+        """ Writes the manifest out if anything's changed, without what wasn't
+        seen since it was loaded.
+        """
+        for part in ("dirs", "infos", "modules"):
+            entries = self._data[part]
+            for path in [p for p in entries if p not in self._seen[part]]:
+                del entries[path]
+                self._dirty = True
+        if not self.filename or not self._dirty: return
+        try:
+            directory = os.path.dirname(self.filename)
+            if directory: os.makedirs(directory, exist_ok=True)
+            tmp = self.filename+".tmp"
+            with open(tmp, "w") as f: json.dump(self._data, f)
+            os.replace(tmp, self.filename)
+            self._dirty = False
+        except Exception as e:
+            logging.warning("couldn't save the plugin manifest %s: %s" % (self.filename, e))
+
+    def walk(self, directory):
+        """ Yields (dirpath, filename) for every info file under the directory,
+        like os.walk would find them.
+        """
+        try: stat = os.stat(directory)
+        except OSError: return
+        self._seen["dirs"].add(directory)
+        entry = self._data["dirs"].get(directory)
+        if entry is not None and entry["key"] == _key(stat):
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = {"key":_key(stat), "dirs":[], "infos":[]}
+            try:
+                with os.scandir(directory) as found:
+                    for item in found:
+                        if item.is_dir(follow_symlinks=False):
+                            entry["dirs"].append(item.name)
+                        elif item.name.endswith("."+self.ext):
+                            entry["infos"].append(item.name)
+            except OSError: return
+            self.__remember("dirs", directory, stat, entry)
+
+        for filename in entry["infos"]:
+            yield (directory, filename)
+        for subdir in entry["dirs"]:
+            yield from self.walk(os.path.join(directory, subdir))
+
+    def info(self, infofile, parse):
+        """ Returns what was read out of the info file last time, or what
+        parse() reads out of it now if it's changed. None means it was rejected.
+        """
+        try: stat = os.stat(infofile)
+        except OSError: return parse()
+        self._seen["infos"].add(infofile)
+        entry = self._data["infos"].get(infofile)
+        if entry is not None and entry["key"] == _key(stat):
+            self.hits += 1
+            return entry["info"]
+        self.misses += 1
+        info = parse()
+        self.__remember("infos", infofile, stat, {"key":_key(stat), "info":info})
+        return info
+
+    def module(self, filename):
+        """ Returns the (class name, category) found in the module last time,
+        or None if it's changed since.
+        """
+        try: stat = os.stat(filename)
+        except OSError: return None
+        self._seen["modules"].add(filename)
+        entry = self._data["modules"].get(filename)
+        if entry is not None and entry["key"] == _key(stat):
+            self.hits += 1
+            return (entry["class"], entry["category"])
+        self.misses += 1
+        return None
+
+    def setModule(self, filename, classname, category):
+        """ Remembers the class that was found in the module. """
+        try: stat = os.stat(filename)
+        except OSError: return
+        self._seen["modules"].add(filename)
+        self.__remember("modules", filename, stat,
+                        {"key":_key(stat), "class":classname, "category":category})
+
+    def __remember(self, part, path, stat, entry):
+        if time.time()-stat.st_mtime < RACY_WINDOW:
+            self._data[part].pop(path, None)
+        else: self._data[part][path] = entry
+        self._dirty = True
@@ -0,0 +1,281 @@
+"""
+Copyright (c) 2010-2011 Alexander Dean (dstar@csh.rit.edu)
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import time
+import logging
+from collections import deque
+from threading import Condition
+
+from empbase.comm.pools import WorkerPool
+
+#
+# Loading the attachments and then activating them used to happen one at a
+# time, so one with a slow __init__ or activate() (parsing a big file, looking
+# at a lot of files, binding a socket) held up all of the rest. A Startup runs
+# one of those steps for each attachment on up to startup-workers threads at
+# once.
+#
+# An attachment can say it needs others to go first with 'Depends' in the
+# Core section of its EMP file, a list of their Cmd, Module or Name. It isn't
+# started until they've all finished, and if one of them failed (or wasn't
+# done in time) it's skipped. Depending on one that isn't in the same step,
+# say one that isn't active, doesn't hold it up. A dependency loop skips
+# everything waiting on it.
+#
+# Each one has startup-timeout seconds. If it isn't done by then its left to
+# finish on its own and its counted as failed, but it keeps its worker. If
+# every worker ends up stuck like that, the rest are skipped. With only one
+# worker they're run one after the other on the calling thread, like they
+# always were, and one that took too long is counted as failed once its done.
+# What happened is kept as a timeline, for 'stats' and the log.
+#
+
+DEFAULT_WORKERS = 4
+DEFAULT_TIMEOUT = 30.0 # seconds, 0 for no timeout.
+
+WAITING  = "waiting"
+RUNNING  = "running"
+DONE     = "done"
+FAILED   = "failed"
+TIMEDOUT = "timed-out"
+SKIPPED  = "skipped"
+
+
+def _nothing(result): pass
+
+def resolveDepends(infos):
+    """ Given the attachments' plugin infos, maps each one's name to the names
+    of the ones it depends on. They can be given by Cmd, Module or Name.
+    """
+    names = {}
+    for info in infos:
+        for alias in (info.plugname, info.module, info.name): names.setdefault(alias, info.name)
+    return dict((info.name, [names.get(d, d) for d in getattr(info, "depends", [])])
+                for info in infos)
+
+class _Job():
+    """ One attachment's part in a Startup. """
+    def __init__(self, name, fn, depends, timeout, onlate):
+        self.name = name
+        self.fn = fn
+        self.depends = list(depends)
+        self.timeout = float(timeout)
+        self.onlate = onlate
+        self.pending = 0 # how many it depends on aren't done yet.
+        self.state = WAITING
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.result = None
+
+    def deadline(self):
+        if self.timeout <= 0: return None
+        return self.started+self.timeout
+
+
+class Startup():
+    """ Runs a step of starting the attachments side by side, see above. The
+    step's name (what, like "loading") is only used for logging.
+    """
+    def __init__(self, what, workers=DEFAULT_WORKERS):
+        self.what = what
+        self._workers = max(int(workers), 1)
+        self._jobs = {}
+        self._cond = Condition()
+        self._busy = 0 # workers running a job, even one that's timed out.
+        self._pooled = False
+        self._ready = deque() # waiting on nothing but a worker.
+        self._running = set()
+        self._dependents = {} # name -> the jobs that depend on it.
+        self._begun = None
+        self._took = None
+
+    def add(self, name, fn, depends=(), timeout=DEFAULT_TIMEOUT, onlate=_nothing):
+        """ Adds fn to be run for the named attachment, once the ones named in
+        depends are done. If it finishes after it timed out, onlate is called
+        with what it returned so it can be cleaned up.
+        """
+        self._jobs[name] = _Job(name, fn, depends, timeout, onlate)
+
+    def result(self, name):
+        """ What the named attachment's fn returned, if it finished in time."""
+        job = self._jobs.get(name)
+        if job is None or job.state != DONE: return None
+        return job.result
+
+    def state(self, name):
+        """ How the named attachment's fn went, one of the states above. """
+        job = self._jobs.get(name)
+        return None if job is None else job.state
+
+    def run(self):
+        """ Runs them all and returns once each is done, failed, timed out or
+        skipped. Returns the names of the ones that were done, in the order
+        they were added.
+        """
+        for job in self._jobs.values():
+            for name in [n for n in job.depends if n not in self._jobs or n == job.name]:
+                logging.debug("%s won't wait for %s, its not part of %s." % (job.name, name, self.what))
+                job.depends.remove(name)
+            job.depends = list(dict.fromkeys(job.depends))
+            job.pending = len(job.depends)
+            for name in job.depends: self._dependents.setdefault(name, []).append(job)
+            if not job.pending: self._ready.append(job)
+
+        self._begun = time.monotonic()
+        if self._workers == 1: self.__runInline()
+        else: self.__runPooled()
+        self._took = time.monotonic()-self._begun
+        return [job.name for job in self._jobs.values() if job.state == DONE]
+
+    def __runInline(self):
+        """ With one worker there's no point in a thread, they're run one
+        after the other right here. One that hangs can't be left behind then,
+        but one that took too long is still counted as timed out.
+        """
+        while self._ready:
+            job = self._ready.popleft()
+            self.__start(job)
+            self.__run(job)
+        self.__skipWaiting("its dependencies wait on each other")
+
+    def __runPooled(self):
+        """ Hands them to a pool of startup-workers threads as they're ready.
+        One that times out is left to finish on its own, but it holds on to
+        its worker until it does.
+        """
+        pool, self._pooled = WorkerPool("startup", self._workers), True
+        try:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    for job in [job for job in self._running 
+                                if job.deadline() is not None and job.deadline() <= now]:
+                        self.__timedOut(job, now)
+
+                    while self._ready and self._busy < self._workers:
+                        job = self._ready.popleft()
+                        self.__start(job)
+                        pool.submit(self.__work, job)
+
+                    if not self._running:
+                        if self._ready: # every worker is stuck on one that's late.
+                            self.__skipWaiting("every worker is stuck on one that timed out")
+                        else: # nothing can start, they're waiting on each other.
+                            self.__skipWaiting("its dependencies wait on each other")
+                        break
+
+                    deadlines = [job.deadline() for job in self._running if job.deadline() is not None]
+                    self._cond.wait(max(min(deadlines)-now, 0.0) if deadlines else None)
+        finally: pool.shutdown()
+
+    def __start(self, job):
+        job.state, job.started = RUNNING, time.monotonic()
+        self._running.add(job)
+        self._busy += 1
+
+    def __timedOut(self, job, now):
+        job.state, job.finished = TIMEDOUT, now
+        job.error = "took over %.1fs" % job.timeout
+        logging.error("%s took over %.1fs %s, going on without it." %
+                      (job.name, job.timeout, self.what))
+        self.__settle(job)
+
+    def __settle(self, job):
+        """ Once the job's over, the ones waiting on it can go if it got done,
+        otherwise they're skipped (and so are the ones waiting on them).
+        """
+        self._running.discard(job)
+        for other in self._dependents.get(job.name, ()):
+            if other.state != WAITING: continue
+            if job.state == DONE:
+                other.pending -= 1
+                if not other.pending: self._ready.append(other)
+            else:
+                other.state, other.error = SKIPPED, "%s didn't finish" % job.name
+                logging.error("skipped %s %s, since %s didn't finish." % (self.what, other.name, job.name))
+                self.__settle(other)
+
+    def __skipWaiting(self, why):
+        for job in self._jobs.values():
+            if job.state != WAITING: continue
+            job.state, job.error = SKIPPED, why
+            logging.error("skipped %s %s, %s." % (self.what, job.name, why))
+
+    def __work(self, job):
+        """ A worker runs the job, then the next one that's ready, until
+        there are none left for it.
+        """
+        while job is not None:
+            job = self.__run(job)
+
+    def __run(self, job):
+        """ Runs the job and returns the next one to start, if there's a
+        worker free for it.
+        """
+        result, error, next = None, None, None
+        try: result = job.fn()
+        except Exception as e:
+            logging.exception(e)
+            error = str(e) or e.__class__.__name__
+        with self._cond:
+            self._busy -= 1
+            now = time.monotonic()
+            deadline = job.deadline()
+            if job.state == RUNNING and deadline is not None and deadline < now:
+                self.__timedOut(job, now)
+            late = job.state == TIMEDOUT
+            if not late:
+                job.finished = now
+                job.state = DONE if error is None else FAILED
+                job.result, job.error = result, error
+                self.__settle(job)
+            if self._pooled and self._ready and self._busy < self._workers:
+                next = self._ready.popleft()
+                self.__start(next)
+            self._cond.notify_all()
+        if late:
+            logging.warning("%s finally finished %s after %.1fs." %
+                            (job.name, self.what, time.monotonic()-job.started))
+            if error is None:
+                try: job.onlate(result)
+                except Exception as e: logging.exception(e)
+        return next
+
+    def timeline(self):
+        """ When each attachment started, in ms from the start of the step,
+        how long it took and how it went, in the order they started.
+        """
+        jobs = sorted(self._jobs.values(), key=lambda job: (job.started is None, job.started or 0))
+        line = []
+        for job in jobs:
+            entry = {"name": job.name, "state": job.state}
+            if job.started is not None:
+                entry["start"] = round((job.started-self._begun)*1000, 1)
+                if job.finished is not None:
+                    entry["took"] = round((job.finished-job.started)*1000, 1)
+            if job.error is not None: entry["error"] = job.error
+            line.append(entry)
+        return {"took": round((self._took or 0.0)*1000, 1), "attachments": line}
+
+    def logTimeline(self):
+        timeline = self.timeline()
+        logging.info("%s %d attachments took %.1fms:" %
+                     (self.what, len(timeline["attachments"]), timeline["took"]))
+        for entry in timeline["attachments"]:
+            logging.info("    %8s  %8s  %-20s %s%s" %
+                         ("+%.1fms" % entry["start"] if "start" in entry else "",
+                          "%.1fms" % entry["took"] if "took" in entry else "",
+                          entry["name"], entry["state"],
+                          " (%s)" % entry["error"] if "error" in entry else ""))
@@ -0,0 +1,452 @@
+"""
+Copyright (c) 2010-2011 Alexander Dean (dstar@csh.rit.edu)
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import time
+import heapq
+import random
+import logging
+import itertools
+from threading import Lock, Condition
+from empbase.comm.pools import WorkerPool
+from empbase.attach.attachments import MID_IMPORTANCE
+
+#
+# The pull loop used to update the LoopPlugs one after the other, so one slow
+# plug (like a FileWatcher on a slow mount) held up every plug after it. Now
+# their updates run side by side on a pool. A plug's update is never started
+# while its last one is still going, that's counted as an overrun and the
+# plug just misses that turn. An update that goes past its timeout is logged
+# and counted, but there's no safe way to stop a thread, so its left to
+# finish and the plug sits out until it does.
+#
+# Each plug also polls on its own schedule. A plug can say how often in its
+# 'update-interval' (seconds), otherwise its the daemon's update-speed, made
+# shorter the more important the plug is (a high importance plug polls twice
+# as often as a normal one). The plugs wait on a heap ordered by when they're
+# next due, so the pull loop can sleep right up until the first one is.
+#
+# In adaptive mode a plug's interval doubles after every update that doesn't
+# trigger anything (up to a cap), and snaps back to its minimum as soon as 
+# one does. So the quiet plugs are polled less and less, but a plug that 
+# starts firing is watched closely again straight away.
+#
+
+DEFAULT_WORKERS = 4
+DEFAULT_TIMEOUT = 60.0 # seconds, 0 for no timeout.
+DEFAULT_INTERVAL = 60.0 # seconds, the daemon's update-speed.
+DEFAULT_JITTER = 0.1 # fraction of the interval.
+DEFAULT_BACKOFF = 8.0 # how many times its interval an adaptive plug can wait.
+
+# The shortest a plug can ask to be polled, so a typo can't spin the pool.
+MIN_INTERVAL = 0.1
+
+# The upper bounds (in seconds) of the buckets in the update time histograms.
+BUCKETS = [0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0]
+
+
+class Histogram():
+    """ Counts durations into the BUCKETS, plus one for everything longer. """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0]*(len(self.buckets)+1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = None
+
+    def add(self, seconds):
+        i = 0
+        while i < len(self.buckets) and seconds > self.buckets[i]: i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max: self.max = seconds
+
+    def stats(self):
+        """ The counts by bucket (labeled by their upper bound), along with the
+        mean, max and last duration.
+        """
+        labels = ["%gs" % b for b in self.buckets] + ["more"]
+        return {"count": self.count, "last": self.last, "max": self.max,
+                "mean" : self.total/self.count if self.count else None,
+                "histogram": dict(zip(labels, self.counts))}
+
+
+class _Slot():
+    """ A plug's place in the PollSchedule. """
+    __slots__ = ("plugin", "due", "interval", "low", "high", "adaptive")
+    def __init__(self, plugin, interval, low, high, adaptive):
+        self.plugin = plugin
+        self.due = None
+        self.interval = interval
+        self.low, self.high = low, high
+        self.adaptive = adaptive
+
+
+class PollSchedule():
+    """ A heap of LoopPlugs by the time they're next due to be updated. """
+    def __init__(self, interval=DEFAULT_INTERVAL, jitter=DEFAULT_JITTER,
+                 adaptive=False, backoff=DEFAULT_BACKOFF):
+        """ If adaptive is True the plugs' intervals change with how often
+        they trigger events, up to backoff times their normal interval. A 
+        plug can have its own 'update-adaptive', 'update-min-interval' and 
+        'update-max-interval' to change this.
+        """
+        self._interval = float(interval)
+        self._jitter = float(jitter)
+        self._adaptive = adaptive
+        self._backoff = max(float(backoff), 1.0)
+        self._lock = Lock()
+        self._heap = [] # (due, tiebreaker, plugin name)
+        self._plugs = {} # plugin name -> _Slot
+        self._order = itertools.count()
+
+    def interval(self, plugin):
+        """ How many seconds the plug wants between updates. """
+        obj = plugin.plugin_object
+        interval = self.__option(obj, "update-interval", 0.0)
+        if interval <= 0:
+            importance = getattr(obj, "update_importance", MID_IMPORTANCE)
+            interval = self._interval * (1.0 + (MID_IMPORTANCE-importance)/100.0)
+        return max(interval, MIN_INTERVAL)
+
+    def __option(self, obj, option, default):
+        try: 
+            if isinstance(default, bool):
+                return str(obj.config.get(option, default)).lower() in ("true", "1", "yes", "on")
+            return obj.config.getfloat(option, default)
+        except Exception: return default
+
+    def __slot(self, plugin):
+        """ Works out the plug's bounds. """
+        obj, interval = plugin.plugin_object, self.interval(plugin)
+        adaptive = self.__option(obj, "update-adaptive", self._adaptive)
+        low = max(self.__option(obj, "update-min-interval", interval), MIN_INTERVAL)
+        high = max(self.__option(obj, "update-max-interval", interval*self._backoff), low)
+        return _Slot(plugin, low if adaptive else interval, low, high, adaptive)
+
+    def __push(self, name, due):
+        self._plugs[name].due = due
+        heapq.heappush(self._heap, (due, next(self._order), name))
+
+    def __jitter(self, interval):
+        return interval * random.uniform(-self._jitter, self._jitter)
+
+    def sync(self, plugins, now=None):
+        """ Starts scheduling any of the plugins that are new, and stops 
+        scheduling the ones that are gone. New plugs are due within a bit of
+        jitter, so a lot of them starting at once are spread out.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            names = set()
+            for plugin in plugins:
+                names.add(plugin.name)
+                slot = self._plugs.get(plugin.name)
+                if slot is None:
+                    slot = self._plugs[plugin.name] = self.__slot(plugin)
+                    self.__push(plugin.name, now + abs(self.__jitter(slot.interval)))
+                else: slot.plugin = plugin
+            for name in [name for name in self._plugs if name not in names]:
+                del self._plugs[name] # its heap entry is skipped when it comes up.
+
+    def configure(self, interval, jitter, adaptive, backoff):
+        """ Changes the schedule's defaults, and refreshes every plug. """
+        with self._lock:
+            self._interval = float(interval)
+            self._jitter = float(jitter)
+            self._adaptive = adaptive
+            self._backoff = max(float(backoff), 1.0)
+        return self.refresh()
+
+    def refresh(self, names=None, now=None):
+        """ Works out the plugs' (all of them if names is None) intervals and
+        bounds again, after their config has changed. Each keeps its next 
+        update unless its new interval says it should be sooner. Returns 
+        True if any of them are now due sooner than they were.
+        """
+        now = time.monotonic() if now is None else now
+        sooner = False
+        with self._lock:
+            for name in list(self._plugs) if names is None else names:
+                old = self._plugs.get(name)
+                if old is None: continue
+                slot = self._plugs[name] = self.__slot(old.plugin)
+                slot.due = old.due # so its heap entry still counts.
+                if now + slot.interval < old.due:
+                    self.__push(name, now + slot.interval)
+                    sooner = True
+        return sooner
+
+    def due(self, now=None):
+        """ Returns the plugins that are due now, and schedules their next
+        update an interval (give or take the jitter) after this one was due.
+        """
+        now = time.monotonic() if now is None else now
+        slots = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due, _, name = heapq.heappop(self._heap)
+                slot = self._plugs.get(name)
+                if slot is None or slot.due != due: continue # stale.
+                slots.append((name, slot))
+            for name, slot in slots:
+                # if we fell behind it doesn't get to catch up all at once.
+                self.__push(name, max(slot.due + slot.interval + self.__jitter(slot.interval), now))
+        return [slot.plugin for _, slot in slots]
+
+    def adapt(self, name, fired, now=None):
+        """ Called after each of an adaptive plug's updates. If it triggered
+        anything its interval snaps back to its minimum, otherwise it doubles
+        (up to its maximum). Returns True if that makes it due sooner than it 
+        was, so the pull loop knows to look again.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            slot = self._plugs.get(name)
+            if slot is None or not slot.adaptive: return False
+            if not fired:
+                longer = min(slot.interval*2, slot.high) - slot.interval
+                slot.interval += longer
+                # its next update was scheduled with the old interval.
+                if longer > 0: self.__push(name, slot.due + longer)
+                return False
+            slot.interval = slot.low
+            due = now + slot.low + self.__jitter(slot.low)
+            if due >= slot.due: return False
+            self.__push(name, due) # the old one is stale now.
+            return True
+
+    def wait(self, now=None):
+        """ Seconds until the next plug is due, or None if there aren't any."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            while self._heap:
+                due, _, name = self._heap[0]
+                slot = self._plugs.get(name)
+                if slot is not None and slot.due == due: return max(due-now, 0.0)
+                heapq.heappop(self._heap)
+            return None
+
+    def stats(self, now=None):
+        """ Each plug's current interval and the seconds until its next 
+        update, and its bounds if its adaptive.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            stats = {}
+            for name, slot in self._plugs.items():
+                stats[name] = {"interval": slot.interval, "next": max(slot.due-now, 0.0),
+                               "adaptive": slot.adaptive}
+                if slot.adaptive: 
+                    stats[name]["min-interval"] = slot.low
+                    stats[name]["max-interval"] = slot.high
+            return stats
+
+
+class _PlugState():
+    """ What the updater knows about a single plug. """
+    def __init__(self):
+        self.started = None # when the running update started, if there is one.
+        self.triggers = 0 # the plug's trigger count after its last update.
+        self.timedout = False
+        self.timeouts = 0
+        self.overruns = 0
+        self.failures = 0
+        self.times = Histogram()
+
+
+class LoopUpdater():
+    """ Runs the LoopPlugs' updates on a bounded pool of threads. The pull
+    loop calls update() for each plug its schedule says is due, and check() 
+    every so often to catch the ones that are taking too long.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT, run=None,
+                 interval=DEFAULT_INTERVAL, jitter=DEFAULT_JITTER, adaptive=False,
+                 backoff=DEFAULT_BACKOFF, triggers=None):
+        """ The run function is what's called with the plug to update it, it
+        defaults to calling its update(). The interval, jitter, adaptive and
+        backoff are for the plugs' PollSchedule. The triggers function is 
+        given a plug and returns how many times its events have been triggered
+        so far, its how adaptive plugs are judged.
+        """
+        self.schedule = PollSchedule(interval, jitter, adaptive, backoff)
+        self._triggers = triggers if triggers is not None else (lambda plugin: 0)
+        self.wake = None # called when a plug is due sooner than it was.
+        self.stuck = None # called with a plug and its timeout when it goes over.
+        self._pool = WorkerPool("loop-updates", workers)
+        self._timeout = float(timeout)
+        self._run = run if run is not None else (lambda plug: plug.update())
+        self._lock = Lock()
+        self._idle = Condition(self._lock) # notified as each update finishes.
+        self._plugs = {} # plugin name -> _PlugState
+
+    def configure(self, timeout, interval, jitter, adaptive, backoff):
+        """ Changes the updater's settings while its running, see __init__. """
+        self._timeout = float(timeout)
+        self.__sooner(self.schedule.configure(interval, jitter, adaptive, backoff))
+
+    def refresh(self, plugin):
+        """ Called when the plug's config has changed, so its schedule is 
+        worked out again.
+        """
+        self.__sooner(self.schedule.refresh([plugin.name]))
+
+    def __sooner(self, sooner):
+        if sooner and self.wake is not None: self.wake()
+
+    def timeout(self, plugin):
+        """ The plug's own 'update-timeout' if it has one, otherwise the
+        updater's.
+        """
+        try: return plugin.plugin_object.config.getfloat("update-timeout", self._timeout)
+        except Exception: return self._timeout
+
+    def begin(self, plugin):
+        """ Marks the plug as updating. Returns False (and counts an overrun)
+        if its last update hasn't finished yet.
+        """
+        with self._lock:
+            state = self._plugs.get(plugin.name)
+            if state is None: 
+                state = self._plugs[plugin.name] = _PlugState()
+                state.triggers = self._triggers(plugin)
+            if state.started is not None:
+                state.overruns += 1
+                logging.debug("%s is still updating, skipping it this time." % plugin.name)
+                return False
+            state.started = time.monotonic()
+            state.timedout = False
+            return True
+
+    def finish(self, plugin, failed=False):
+        """ Records how long the plug's update took. """
+        with self._lock:
+            state = self._plugs.get(plugin.name)
+            if state is None or state.started is None: return
+            took = time.monotonic()-state.started
+            state.started = None
+            self._idle.notify_all()
+            state.times.add(took)
+            if failed: state.failures += 1
+            # anything since its last update counts, however it was triggered.
+            triggers = self._triggers(plugin)
+            fired, state.triggers = triggers > state.triggers, triggers
+        if state.timedout:
+            logging.warning("%s finally finished updating after %.1fs." % (plugin.name, took))
+        self.__sooner(self.schedule.adapt(plugin.name, fired))
+
+    def update(self, plugin):
+        """ Starts the plug's update on the pool, unless its last one is still
+        running. Returns whether it was started.
+        """
+        if not self.begin(plugin): return False
+        if self._pool.submit(self.__update, plugin) is None:
+            self.finish(plugin, failed=True) # we've been shut down.
+            return False
+        return True
+
+    def __update(self, plugin):
+        failed = False
+        try: self._run(plugin.plugin_object)
+        except Exception as e:
+            failed = True
+            logging.error("%s failed to update: %s" % (plugin.name, e))
+        finally: self.finish(plugin, failed)
+
+    def check(self, plugins):
+        """ Logs and counts the plugs whose update has gone past its timeout,
+        once per update. Returns their names.
+        """
+        late, now = [], time.monotonic()
+        for plugin in plugins:
+            timeout = self.timeout(plugin)
+            if timeout <= 0: continue
+            with self._lock:
+                state = self._plugs.get(plugin.name)
+                if state is None or state.started is None or state.timedout: continue
+                if now-state.started <= timeout: continue
+                state.timedout = True
+                state.timeouts += 1
+            logging.warning("%s has been updating for over %.1fs, it won't be updated again until it finishes." %
+                            (plugin.name, timeout))
+            late.append(plugin.name)
+            if self.stuck is not None: self.stuck(plugin, timeout)
+        return late
+
+    def nextCheck(self, plugins):
+        """ Seconds until the first running update goes past its timeout, or
+        None if none of them can.
+        """
+        first, now = None, time.monotonic()
+        for plugin in plugins:
+            timeout = self.timeout(plugin)
+            if timeout <= 0: continue
+            with self._lock:
+                state = self._plugs.get(plugin.name)
+                if state is None or state.started is None or state.timedout: continue
+                left = max(state.started + timeout - now, 0.0)
+            if first is None or left < first: first = left
+        return first
+
+    def sleepTime(self, plugins, longest):
+        """ How long the pull loop can sleep before a plug is due or an update
+        might time out, but no longer than longest.
+        """
+        times = [t for t in (self.schedule.wait(), self.nextCheck(plugins)) if t is not None]
+        return min(times + [longest])
+
+    def status(self, name):
+        """ The stats for one plug, or None if it hasn't been scheduled. """
+        return self.stats()["plugs"].get(name)
+
+    def running(self):
+        """ Returns the names of the plugs that are updating right now. """
+        with self._lock:
+            return [name for name, state in self._plugs.items() if state.started is not None]
+
+    def drain(self, timeout=None):
+        """ Waits up to timeout seconds for the running updates to finish. 
+        Returns the names of the plugs that are still updating.
+        """
+        deadline = None if timeout is None else time.monotonic()+timeout
+        with self._idle:
+            while True:
+                running = [name for name, state in self._plugs.items() if state.started is not None]
+                left = None if deadline is None else deadline-time.monotonic()
+                if not running or (left is not None and left <= 0): return running
+                self._idle.wait(left)
+
+    def shutdown(self, wait=False):
+        self._pool.shutdown(wait)
+
+    def stats(self):
+        """ Each plug's update times and counts, and how busy the pool is. """
+        now, plugs = time.monotonic(), {}
+        schedule = self.schedule.stats(now)
+        with self._lock:
+            for name in set(self._plugs) | set(schedule):
+                stats = dict(schedule.get(name, {}))
+                state = self._plugs.get(name)
+                if state is None: 
+                    plugs[name] = stats
+                    continue
+                stats.update(state.times.stats())
+                stats["running"] = now-state.started if state.started is not None else None
+                stats["timeouts"] = state.timeouts
+                stats["overruns"] = state.overruns
+                stats["failures"] = state.failures
+                plugs[name] = stats
+        return {"pool": self._pool.stats(), "plugs": plugs}
@@ -0,0 +1,290 @@
+"""
+Copyright (c) 2010-2011 Alexander Dean (dstar@csh.rit.edu)
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import time
+import logging
+import itertools
+from threading import Thread, Lock
+from empbase.attach.workers import ProcessAttachment
+
+#
+# A plug's update or an alert's run that never returns holds its thread for
+# good, and used to do it quietly. The watchdog keeps track of the calls into
+# the attachments that are running and when each should be done by. The
+# LoopUpdater already times the updates and tells the watchdog about the ones
+# that go over, the alerts are timed here. An attachment in a worker process
+# whose worker has died is noticed here too.
+#
+# Every hang or crash is counted in the stats. If the 'watchdog' option is
+# 'restart' the attachment is also started over, its worker process is killed
+# and it's made again. One that runs in the daemon can't be, there's no way
+# to get its thread back, so its only counted as not restartable. The first
+# restart waits watchdog-backoff seconds, and each one after that waits twice
+# as long as the last (up to watchdog-max-backoff), so a broken attachment
+# can't have the daemon restarting it over and over. After watchdog-limit
+# restarts in a row it's deactivated and left that way, until its reloaded.
+# Going watchdog-max-backoff seconds without a restart starts the count over.
+#
+
+LOG = "log"
+RESTART = "restart"
+
+DEFAULT_ALERT_TIMEOUT = 60.0 # seconds, 0 for no timeout.
+DEFAULT_BACKOFF = 1.0
+DEFAULT_MAX_BACKOFF = 300.0
+DEFAULT_LIMIT = 5
+
+# How often watch() looks for late calls, dead workers and due restarts.
+WATCH_INTERVAL = 0.5
+
+
+def _nobody(attach): pass
+
+class _Call():
+    """ A call into an attachment that's running. """
+    def __init__(self, name, what, deadline):
+        self.name = name
+        self.what = what
+        self.started = time.monotonic()
+        self.deadline = deadline
+        self.late = False
+
+
+class _Record():
+    """ What the watchdog knows about a single attachment. """
+    def __init__(self):
+        self.hangs = 0
+        self.crashes = 0
+        self.restarts = 0
+        self.inarow = 0      # restarts since it last behaved for a while.
+        self.last = None     # when it was last restarted.
+        self.due = None      # when its next restart is, if one's coming.
+        self.restarting = False
+        self.gaveup = False
+        self.unrestartable = 0 # times it misbehaved in the daemon's process.
+        self.reason = None   # what it last did wrong.
+        self.dead = None     # the worker we've counted as crashed.
+
+
+class Watchdog():
+    """ Watches the calls into the attachments, see above. The restart
+    function is called with the attachment's plugin info to start it over,
+    and stop to deactivate it for good.
+    """
+    def __init__(self, aman, restart=_nobody, stop=_nobody, policy=LOG,
+                 alerttimeout=DEFAULT_ALERT_TIMEOUT, backoff=DEFAULT_BACKOFF,
+                 maxbackoff=DEFAULT_MAX_BACKOFF, limit=DEFAULT_LIMIT):
+        self._aman = aman
+        self._restart = restart
+        self._stop = stop
+        self._lock = Lock()
+        self._calls = {}   # token -> _Call
+        self._records = {} # attachment name -> _Record
+        self._tokens = itertools.count(1)
+        self.configure(policy, alerttimeout, backoff, maxbackoff, limit)
+
+    def configure(self, policy, alerttimeout, backoff, maxbackoff, limit):
+        """ Changes the watchdog's settings while its running. """
+        self.policy = policy
+        self._alerttimeout = float(alerttimeout)
+        self._backoff = float(backoff)
+        self._maxbackoff = float(maxbackoff)
+        self._limit = int(limit)
+
+    def begin(self, name, what, timeout):
+        """ Starts timing a call into the named attachment, what is what's
+        being called. Returns the token to give to end() when it returns.
+        """
+        deadline = time.monotonic()+timeout if timeout > 0 else None
+        with self._lock:
+            token = next(self._tokens)
+            self._calls[token] = _Call(name, what, deadline)
+        return token
+
+    def end(self, token):
+        with self._lock: call = self._calls.pop(token, None)
+        if call is not None and call.late:
+            logging.warning("%s's %s finally returned after %.1fs." %
+                            (call.name, call.what, time.monotonic()-call.started))
+
+    def runAlert(self, alert, eventobj):
+        """ Given to the EventManager, runs the alert and times it. An alarm
+        can have its own 'alert-timeout' in its section.
+        """
+        name, timeout = alert.aid, self._alerttimeout
+        attach = self.__find(alert.aid)
+        if attach is not None:
+            name = attach.name
+            try: timeout = attach.plugin_object.config.getfloat("alert-timeout", timeout)
+            except Exception: pass
+        token = self.begin(name, "alert '%s'" % alert.name, timeout)
+        try: alert.run(eventobj)
+        finally: self.end(token)
+
+    def hung(self, name, what, timeout):
+        """ Tells the watchdog the named attachment's call has been running
+        for over timeout seconds.
+        """
+        with self._lock:
+            record = self.__record(name)
+            record.hangs += 1
+        self.__misbehaved(name, "its %s hung" % what)
+
+    def forget(self, name):
+        """ Starts the named attachment's record over, its been reloaded. """
+        with self._lock:
+            record = self._records.get(name)
+            if record is None: return
+            record.inarow, record.due, record.gaveup = 0, None, False
+
+    def check(self):
+        """ Looks for late calls and dead workers, and starts the restarts
+        that are due.
+        """
+        now, late = time.monotonic(), []
+        with self._lock:
+            for call in self._calls.values():
+                if call.late or call.deadline is None or call.deadline > now: continue
+                call.late = True
+                late.append(call)
+        for call in late:
+            timeout = call.deadline-call.started
+            logging.warning("%s's %s has been running for over %.1fs." % (call.name, call.what, timeout))
+            self.hung(call.name, call.what, timeout)
+
+        for attach in self._aman.getAllPlugins():
+            obj = attach.plugin_object
+            if not isinstance(obj, ProcessAttachment): continue
+            worker = obj.worker
+            if worker.isRunning() or worker.stopping: continue
+            with self._lock:
+                record = self.__record(attach.name)
+                if record.dead is worker: continue
+                record.dead = worker
+                record.crashes += 1
+            self.__misbehaved(attach.name, "its worker process died")
+
+        due = []
+        with self._lock:
+            for name, record in self._records.items():
+                if record.due is None or record.due > now or record.restarting: continue
+                record.due, record.restarting = None, True
+                due.append(name)
+        for name in due:
+            # restarting can take a while, so it doesn't hold up watching.
+            Thread(target=self.__restartOne, args=(name,), daemon=True).start()
+
+    def watch(self, trigger=lambda:False, pause=time.sleep):
+        """ Runs check() every WATCH_INTERVAL until the trigger returns False."""
+        logging.debug("watchdog started")
+        while trigger():
+            try: self.check()
+            except Exception as e: logging.exception(e)
+            pause(WATCH_INTERVAL)
+        logging.debug("watchdog dead")
+
+    def __find(self, aid):
+        for attach in self._aman.getAllPlugins():
+            if attach.plugin_object.ID == aid: return attach
+        return None
+
+    def __findByName(self, name):
+        for attach in self._aman.getAllPlugins():
+            if attach.name == name: return attach
+        return None
+
+    def __record(self, name):
+        record = self._records.get(name)
+        if record is None: record = self._records[name] = _Record()
+        return record
+
+    def __misbehaved(self, name, reason):
+        """ Schedules the attachment's restart, if the policy says to and
+        there isn't one coming already.
+        """
+        attach = self.__findByName(name)
+        inprocess = attach is not None and not isinstance(attach.plugin_object, ProcessAttachment)
+        with self._lock:
+            record = self.__record(name)
+            record.reason = reason
+            if self.policy != RESTART or record.gaveup: return
+            if inprocess: record.unrestartable += 1
+            elif record.due is not None or record.restarting: return
+            else:
+                now = time.monotonic()
+                if record.last is not None and now-record.last > self._maxbackoff:
+                    record.inarow = 0 # its been behaving.
+                if record.inarow >= self._limit:
+                    record.gaveup = True
+                else:
+                    wait = min(self._backoff * 2**record.inarow, self._maxbackoff)
+                    record.due = now+wait
+        if inprocess:
+            logging.warning("%s can't be restarted, it runs in the daemon (%s). Give it "
+                            "'worker-process = true' so it can be." % (name, reason))
+        elif record.gaveup:
+            logging.error("%s has been restarted %d times in a row, its being left deactivated (%s)." %
+                          (name, self._limit, reason))
+            attach = self.__findByName(name)
+            if attach is not None:
+                Thread(target=self.__stopOne, args=(attach,), daemon=True).start()
+        else: logging.warning("restarting %s in %.1fs, %s." % (name, wait, reason))
+
+    def __restartOne(self, name):
+        attach = self.__findByName(name)
+        failed = attach is None
+        if not failed:
+            try: self._restart(attach)
+            except Exception as e:
+                failed = True
+                logging.error("couldn't restart %s: %s" % (name, e))
+        with self._lock:
+            record = self.__record(name)
+            record.restarting = False
+            record.inarow += 1
+            record.last = time.monotonic()
+            if not failed: record.restarts += 1
+        if failed: self.__misbehaved(name, "its restart failed")
+        else: logging.warning("restarted %s." % name)
+
+    def __stopOne(self, attach):
+        try: self._stop(attach)
+        except Exception as e: logging.exception(e)
+
+    def status(self, name):
+        """ The stats for one attachment, or None if its never misbehaved. """
+        return self.stats()["attachments"].get(name)
+
+    def stats(self):
+        """ Each misbehaving attachment's counts, and the calls that are late
+        right now.
+        """
+        now, attachments = time.monotonic(), {}
+        with self._lock:
+            running = {}
+            for call in self._calls.values():
+                if call.late: running.setdefault(call.name, []).append(
+                                  {"call": call.what, "running": now-call.started})
+            for name in set(self._records) | set(running):
+                record = self.__record(name)
+                attachments[name] = {"hangs"    : record.hangs,
+                                     "crashes"  : record.crashes,
+                                     "restarts" : record.restarts,
+                                     "not-restartable": record.unrestartable,
+                                     "in-a-row" : record.inarow,
+                                     "restart-in": max(record.due-now, 0.0) if record.due is not None else None,
+                                     "gave-up"  : record.gaveup,
+                                     "reason"   : record.reason,
+                                     "late"     : running.get(name, [])}
+        return {"policy": self.policy, "attachments": attachments}
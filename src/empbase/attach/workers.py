@@ -0,0 +1,574 @@
+"""
+Copyright (c) 2010-2011 Alexander Dean (dstar@csh.rit.edu)
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import sys
+import time
+import logging
+import itertools
+import multiprocessing
+from threading import Thread, Lock, Event as Flag
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from empbase.event import eventmanager
+from empbase.event.events import Event
+from empbase.event.alerts import Alert
+from empbase.comm.command import Command
+from empbase.config.empconfigparser import TinyCfgPrsr
+from empbase.config.logger import _LOGGING_FORMAT_, _DATE_FORMAT_
+from empbase.attach.attachments import EmpPlug, EmpAlarm, LoopPlug, SignalPlug
+
+#
+# Every attachment runs in the daemon's process, so they all share its GIL and
+# a plug that's busy with the CPU (parsing logs, hashing files) slows down the
+# routing and dispatch along with it. An attachment whose section has
+# 'worker-process = true' is instead made in a process of its own, and what
+# the daemon gets is a stand-in for it that passes everything on:
+#
+#     daemon                                  worker process
+#     ProcessLoopPlug.update()   --call-->    plug.update()
+#     Command.run()              --call-->    the plug's Command.run()
+#     ProcessAlert.run(event)    --call-->    the alarm's Alert.run(event)
+#     eventmanager.triggerEvent  <--note--    Event.trigger()
+#     eventmanager.registerEvent <--call--    Event.register()
+#
+# So the attachment is written just like any other, the worker swaps in an
+# EventManager of its own that sends its triggers and registrations back to
+# the daemon. The two ends talk over a multiprocessing Pipe (a unix socket
+# pair), either end can call the other and wait for the answer or just send
+# it a note. Calls are answered on a small pool so a slow update doesn't hold
+# up a command, notes are handled in order as they come in.
+#
+# The worker is started with 'spawn', forking a daemon with threads running
+# isn't safe. If it dies its stand-in is deactivated and everything sent to
+# it fails, until the attachment is reloaded.
+#
+
+# The option in an attachment's section that puts it in a worker process.
+WORKER_OPTION = "worker-process"
+
+# How long a new worker gets to start and make its attachment (seconds).
+START_TIMEOUT = 30.0
+
+# How long the daemon waits for its workers to exit before killing them.
+EXIT_TIMEOUT = 2.0
+
+# How many calls each end of a worker's pipe answers at once.
+SERVE_THREADS = 4
+
+# What's sent down the pipe: (kind, call id, method or ok, args or result).
+_CALL, _NOTE, _REPLY = 0, 1, 2
+
+_context = multiprocessing.get_context("spawn")
+_workers = []   # the running Workers, see stopWorkers().
+_workerLock = Lock()
+
+
+def makeAttachment(cls, config, filename):
+    """ Makes the attachment from its class and config, in a worker process if
+    its config asks for one. The filename is the plugin file the class was
+    loaded from, the worker has to load it again.
+    """
+    if not config.getboolean(WORKER_OPTION, False): return cls(config)
+    if issubclass(cls, LoopPlug):     proxy = ProcessLoopPlug
+    elif issubclass(cls, SignalPlug): proxy = ProcessSignalPlug
+    elif issubclass(cls, EmpAlarm):   proxy = ProcessAlarm
+    else: raise Exception("%s can't be run in a worker process." % cls.__name__)
+    return proxy(config, cls, filename)
+
+def dropAttachment(attachment):
+    """ Stops the attachment's worker process, if it has one. Its deactivated
+    first if it needs to be.
+    """
+    if isinstance(attachment, ProcessAttachment): attachment.stopWorker()
+
+def stopWorkers(timeout=EXIT_TIMEOUT):
+    """ Stops all of the worker processes, waiting up to timeout seconds for
+    them to exit. The daemon does this once its saved everything.
+    """
+    with _workerLock: workers = list(_workers)
+    deadline = time.monotonic()+timeout
+    for worker in workers: worker.stop()
+    for worker in workers: worker.join(max(deadline-time.monotonic(), 0.0))
+
+def _logTarget():
+    """ Where this process is logging to and at what level, so the workers
+    can log to the same place.
+    """
+    root = logging.getLogger()
+    for handler in root.handlers:
+        if isinstance(handler, logging.FileHandler):
+            return handler.baseFilename, root.level
+    return None, root.level
+
+
+class _Channel():
+    """ One end of a worker's pipe. Calls to the other end wait for what it
+    returns (or re-raise what it raised), notes don't wait for anything. What
+    comes in is passed to the handler as (method, *args).
+    """
+    def __init__(self, conn, handler, onclose=None, threads=SERVE_THREADS):
+        self._conn = conn
+        self._handler = handler
+        self._onclose = onclose
+        self._sending = Lock()
+        self._pending = {}  # call id -> Future
+        self._ids = itertools.count(1)
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self.closed = Flag()
+        Thread(target=self.__read, daemon=True).start()
+
+    def call(self, method, *args, timeout=None):
+        """ Runs the method at the other end and returns what it did. Raises
+        an Exception if it did, or if the other end has gone away.
+        """
+        cid = next(self._ids)
+        future = self._pending[cid] = Future()
+        if self.closed.is_set(): # checked after, in case it closed in between.
+            self._pending.pop(cid, None)
+            raise Exception("The worker process isn't running.")
+        try:
+            self.__send((_CALL, cid, method, args))
+            return future.result(timeout)
+        finally: self._pending.pop(cid, None)
+
+    def notify(self, method, *args):
+        """ Sends a note to the other end, doesn't wait for it to be handled."""
+        if self.closed.is_set(): return
+        try: self.__send((_NOTE, None, method, args))
+        except OSError: pass # its gone, the reader will see.
+
+    def __send(self, msg):
+        with self._sending: self._conn.send(msg)
+
+    def __read(self):
+        while True:
+            try: kind, cid, method, args = self._conn.recv()
+            except (EOFError, OSError): break
+            except Exception as e: # couldn't be unpickled, skip it.
+                logging.exception(e)
+                continue
+
+            if kind == _REPLY:
+                future = self._pending.get(cid)
+                if future is None: continue
+                if method: future.set_result(args)
+                else: future.set_exception(Exception(args))
+            elif kind == _CALL:
+                try: self._pool.submit(self.__serve, cid, method, args)
+                except RuntimeError: break # closing.
+            else:
+                try: self._handler(method, *args)
+                except Exception as e: logging.exception(e)
+        self.__close()
+
+    def __serve(self, cid, method, args):
+        try: reply = (_REPLY, cid, True, self._handler(method, *args))
+        except Exception as e: reply = (_REPLY, cid, False, str(e))
+        try: self.__send(reply)
+        except OSError: pass
+        except Exception as e: # the result couldn't be pickled.
+            try: self.__send((_REPLY, cid, False, "Couldn't send %s's result: %s" % (method, e)))
+            except OSError: pass
+
+    def __close(self):
+        self.closed.set()
+        for future in list(self._pending.values()):
+            if not future.done():
+                future.set_exception(Exception("The worker process isn't running."))
+        self._pool.shutdown(wait=False)
+        try: self._conn.close()
+        except OSError: pass
+        if self._onclose is not None: self._onclose()
+
+
+class Worker():
+    """ A worker process and the daemon's end of its pipe. """
+    def __init__(self, name, handler, onexit=None):
+        self.name = name
+        self.stopping = False
+        self._onexit = onexit
+        logfile, level = _logTarget()
+        conn, child = _context.Pipe()
+        self.process = _context.Process(target=_serve, name="emp-worker-"+name,
+                                        args=(child, logfile, level), daemon=True)
+        self.process.start()
+        child.close() # so when the worker goes, so does the pipe.
+        self.channel = _Channel(conn, handler, onclose=self.__closed)
+        with _workerLock: _workers.append(self)
+
+    def isRunning(self):
+        return not self.channel.closed.is_set()
+
+    def call(self, method, *args, timeout=None):
+        return self.channel.call(method, *args, timeout=timeout)
+
+    def stop(self):
+        """ Tells the worker to exit, see join(). """
+        self.stopping = True
+        self.channel.notify("exit")
+
+    def join(self, timeout=EXIT_TIMEOUT):
+        """ Waits for the worker to exit, and kills it if it doesn't. """
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logging.warning("killing worker process %s (%s)" % (self.process.pid, self.name))
+            self.process.kill()
+            self.process.join(EXIT_TIMEOUT)
+
+    def __closed(self):
+        with _workerLock:
+            if self in _workers: _workers.remove(self)
+        if not self.stopping:
+            logging.error("worker process %s (%s) died" % (self.process.pid, self.name))
+        if self._onexit is not None: self._onexit()
+
+
+class ProcessAlert(Alert):
+    """ Stands in for an alert of an alarm in a worker process. """
+    def __init__(self, alarm, name, aid, description=""):
+        Alert.__init__(self, name, aid, description)
+        self.alarm = alarm
+
+    def run(self, eventobj):
+        # the event can't go over as it is, what it refers to is daemon side.
+        self.alarm._call("alert", self.ID, (eventobj.plug.ID, eventobj.ID, eventobj.name,
+                                            eventobj.msg, eventobj.description))
+
+
+class ProcessAttachment():
+    """ The daemon's side of an attachment in a worker process, mixed into a
+    stand-in of the right type. The real one is told what the stand-in is
+    asked to do, and the stand-in keeps copies of its events, alerts and
+    commands for the daemon.
+    """
+    def _startWorker(self, cls, filename):
+        self._events = []
+        self._alerts = []
+        self._commands = []
+        self._sentid = None
+        self.wasactive = False
+        self._handlers = {"trigger"    : self.__trigger,
+                          "detrigger"  : eventmanager.detriggerEvent,
+                          "loadEvent"  : self.__loadEvent,
+                          "unloadEvent": self.__unloadEvent,
+                          "loadAlert"  : self.__loadAlert,
+                          "unloadAlert": self.__unloadAlert}
+        self.worker = Worker(cls.__name__, self.__handle, onexit=self.__exited)
+        try:
+            info = self.worker.call("load", filename, cls.__name__, dict(self.config._value),
+                                    self.config._savedir, timeout=START_TIMEOUT)
+        except Exception:
+            self.worker.stop()
+            raise
+        self.makeactive = info["makeactive"]
+        if "importance" in info: self.update_importance = info["importance"]
+        self._events = [self.__event(*event) for event in info.get("events", [])]
+        self._alerts = [ProcessAlert(self, *alert) for alert in info.get("alerts", [])]
+        self.__setCommands(info["commands"])
+
+    def stopWorker(self):
+        """ Stops the worker process for good, the attachment can't be used
+        after this.
+        """
+        if self.is_activated:
+            try: self.deactivate()
+            except Exception as e: logging.exception(e)
+        self.worker.stop()
+        self.worker.join()
+
+    def killWorker(self):
+        """ Kills the worker process straight away, for when its hung. Calls
+        waiting on it fail, and the attachment is left deactivated.
+        """
+        self.worker.stopping = True
+        self.worker.process.kill()
+        self.worker.join()
+        self.worker.channel.closed.wait(EXIT_TIMEOUT)
+
+    def _call(self, method, *args):
+        # the ID is given out after the attachment's made, so the worker's
+        # told what it is the first time its needed.
+        if self._sentid != self.ID:
+            self.worker.call("identify", self.ID)
+            self._sentid = self.ID
+        return self.worker.call(method, *args)
+
+    def activate(self):
+        if self.is_activated: return
+        eids = dict((event.name, event.ID) for event in self._events)
+        lids = dict((alert.name, alert.ID) for alert in self._alerts)
+        self.__setCommands(self._call("activate", eids, lids))
+        self.is_activated = True
+
+    def deactivate(self):
+        self.is_activated = False
+        if self.worker.isRunning(): self.__setConfig(self._call("deactivate"))
+
+    def save(self):
+        # if the worker's gone the config is left as it was last time.
+        if self.worker.isRunning(): self.__setConfig(self._call("save"))
+
+    def get_commands(self):
+        return self._commands
+
+    def __setCommands(self, commands):
+        self._commands = [Command(name, trigger=self.__command(name), help=help, desc=desc)
+                          for name, help, desc in commands]
+
+    def __command(self, name):
+        return lambda *args: self._call("command", name, *args)
+
+    def __setConfig(self, values):
+        self.config._value.clear()
+        self.config._value.update(values)
+
+    def __event(self, name, description, halflife):
+        event = Event(self, name, description=description)
+        event.halflife = halflife
+        return event
+
+    def __exited(self):
+        self.wasactive = self.is_activated # so a restart knows what it was.
+        self.is_activated = False
+
+    def __handle(self, method, *args):
+        return self._handlers[method](*args)
+
+    def __trigger(self, eid, msg):
+        for event in self._events:
+            if event.ID == eid:
+                if msg is not None: event.msg = msg
+                break
+        eventmanager.triggerEvent(eid)
+
+    def __loadEvent(self, name, description, halflife):
+        event = self.__event(name, description, halflife)
+        eventmanager.registerEvent(event)
+        self._events.append(event)
+        return event.ID
+
+    def __unloadEvent(self, eid):
+        for event in list(self._events):
+            if event.ID == eid:
+                self._events.remove(event)
+                eventmanager.deregisterEvent(event)
+                return True
+        return False
+
+    def __loadAlert(self, name, aid, description):
+        alert = ProcessAlert(self, name, aid, description)
+        eventmanager.registerAlert(alert)
+        self._alerts.append(alert)
+        return alert.ID
+
+    def __unloadAlert(self, lid):
+        for alert in list(self._alerts):
+            if alert.ID == lid:
+                self._alerts.remove(alert)
+                eventmanager.deregisterAlert(alert)
+                return True
+        return False
+
+
+class ProcessLoopPlug(ProcessAttachment, LoopPlug):
+    def __init__(self, config, cls, filename):
+        LoopPlug.__init__(self, config)
+        self._startWorker(cls, filename)
+
+    def get_events(self):
+        return self._events
+
+    def update(self, *args):
+        return self._call("update", *args)
+
+
+class ProcessSignalPlug(ProcessAttachment, SignalPlug):
+    def __init__(self, config, cls, filename):
+        SignalPlug.__init__(self, config)
+        self._startWorker(cls, filename)
+
+    def get_events(self):
+        return self._events
+
+
+class ProcessAlarm(ProcessAttachment, EmpAlarm):
+    def __init__(self, config, cls, filename):
+        EmpAlarm.__init__(self, config)
+        self._startWorker(cls, filename)
+
+    def get_alerts(self):
+        return self._alerts
+
+
+class _Sender():
+    """ What a worker's copy of a triggered event says sent it. """
+    def __init__(self, ID):
+        self.ID = ID
+
+
+class _Hosted():
+    """ The worker process's side, the attachment itself. It also stands in
+    for the EventManager, sending the attachment's events and alerts to the
+    daemon's.
+    """
+    def __init__(self, conn):
+        self.attachment = None
+        self.events = {} # eid -> Event
+        self.alerts = {} # lid -> Alert
+        self.done = Flag()
+        self._calls = {"load"      : self.__load,
+                       "identify"  : self.__identify,
+                       "activate"  : self.__activate,
+                       "deactivate": self.__deactivate,
+                       "save"      : self.__save,
+                       "update"    : self.__update,
+                       "command"   : self.__command,
+                       "alert"     : self.__alert,
+                       "exit"      : self.done.set}
+        self.channel = _Channel(conn, self.__handle, onclose=self.done.set)
+
+    def __handle(self, method, *args):
+        return self._calls[method](*args)
+
+    def __load(self, filename, classname, values, savedir):
+        # the same as the daemon's loader does it, see DefaultPluginManager.
+        if "__init__" in os.path.basename(filename):
+            sys.path.append(os.path.dirname(filename))
+        candidate_globals = {"__file__":filename}
+        with open(filename, "rb") as source:
+            exec(compile(source.read(), filename, "exec"), candidate_globals)
+        cls = candidate_globals.get(classname)
+        if cls is None: raise Exception("%s has no attachment called %s." % (filename, classname))
+        self.attachment = cls(TinyCfgPrsr(values, savedir))
+
+        info = {"makeactive": self.attachment.makeactive,
+                "commands"  : self.__commands()}
+        if isinstance(self.attachment, LoopPlug):
+            info["importance"] = self.attachment.update_importance
+        if isinstance(self.attachment, EmpPlug):
+            info["events"] = [(event.name, event.description, event.halflife)
+                              for event in self.attachment.get_events()]
+        elif isinstance(self.attachment, EmpAlarm):
+            info["alerts"] = [(alert.name, alert.aid, alert.description)
+                              for alert in self.attachment.get_alerts()]
+        return info
+
+    def __commands(self):
+        return [(cmd.name, cmd.help, cmd.desc) for cmd in self.attachment.get_commands()]
+
+    def __identify(self, aid):
+        self.attachment.ID = aid
+
+    def __activate(self, eids, lids):
+        # the daemon loaded the events and alerts before activating it.
+        if isinstance(self.attachment, EmpPlug):
+            for event in self.attachment.get_events():
+                if event.name in eids:
+                    event.ID = eids[event.name]
+                    self.events[event.ID] = event
+        elif isinstance(self.attachment, EmpAlarm):
+            for alert in self.attachment.get_alerts():
+                if alert.name in lids:
+                    alert.ID = lids[alert.name]
+                    self.alerts[alert.ID] = alert
+        self.attachment.activate()
+        return self.__commands()
+
+    def __deactivate(self):
+        self.attachment.deactivate()
+        return dict(self.attachment.config._value)
+
+    def __save(self):
+        self.attachment.save()
+        return dict(self.attachment.config._value)
+
+    def __update(self, *args):
+        from empbase.daemon.aioruntime import runUpdate
+        return runUpdate(self.attachment, *args)
+
+    def __command(self, name, *args):
+        for cmd in self.attachment.get_commands():
+            if cmd.name == name: return cmd.run(*args)
+        raise Exception("%s isn't a command." % name)
+
+    def __alert(self, lid, event):
+        alert = self.alerts.get(lid)
+        if alert is None:
+            for alert in self.attachment.get_alerts():
+                if alert.ID == lid: break
+            else: raise Exception("The alarm has no alert %s." % lid)
+        pid, eid, name, msg, description = event
+        eventobj = Event(_Sender(pid), name, msg, description)
+        eventobj.ID = eid
+        return alert.run(eventobj)
+
+    # The EventManager's methods that attachments use, see eventmanager.py.
+    def countTrigger(self, eid): pass # the daemon counts them.
+    def triggerCount(self, pid): return 0
+
+    def triggerEvent(self, eid):
+        event = self.events.get(eid)
+        self.channel.notify("trigger", eid, event.msg if event is not None else None)
+
+    def detriggerEvent(self, eid):
+        self.channel.notify("detrigger", eid)
+
+    def loadEvent(self, event):
+        event.ID = self.channel.call("loadEvent", event.name, event.description, event.halflife)
+        self.events[event.ID] = event
+
+    def loadEvents(self, eventlist):
+        for event in eventlist: self.loadEvent(event)
+
+    def unloadEvent(self, event):
+        if self.channel.call("unloadEvent", event.ID):
+            self.events.pop(event.ID, None)
+            event.ID = eventmanager.UNKNOWN
+            return True
+        return False
+
+    def loadAlert(self, alert):
+        alert.ID = self.channel.call("loadAlert", alert.name, alert.aid, alert.description)
+        self.alerts[alert.ID] = alert
+
+    def loadAlerts(self, alertlist):
+        for alert in alertlist: self.loadAlert(alert)
+
+    def unloadAlert(self, alert):
+        if self.channel.call("unloadAlert", alert.ID):
+            self.alerts.pop(alert.ID, None)
+            alert.ID = eventmanager.UNKNOWN
+            return True
+        return False
+
+    def addStream(self, stream):
+        raise Exception("Event streams can't be watched from a worker process.")
+
+    def removeStream(self, stream): pass
+
+
+def _serve(conn, logfile, level):
+    """ The worker process. It answers the daemon until its told to exit or
+    the daemon goes away.
+    """
+    if logfile is not None:
+        logging.basicConfig(level=level, format=_LOGGING_FORMAT_,
+                            datefmt=_DATE_FORMAT_, filename=logfile)
+    hosted = _Hosted(conn)
+    eventmanager._theEManager_ = hosted
+    hosted.done.wait()
+    logging.shutdown()
+    # a SignalPlug's thread may never return, so don't wait for it.
+    os._exit(0)
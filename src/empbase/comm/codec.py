@@ -0,0 +1,388 @@
+"""
+Copyright (c) 2010-2011 Alexander Dean (dstar@csh.rit.edu)
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import re
+import json
+import struct
+import logging
+
+#
+# The wire encodings EMP knows how to speak. JSON is what every interface
+# starts with (and all that the Java jsmtg client knows), the binary codec is
+# negotiated after the 'proceed' handshake with the 'codec' command.
+#
+JSON_CODEC   = "json"
+BINARY_CODEC = "bin"
+CODECS = [JSON_CODEC, BINARY_CODEC]
+
+# Every binary frame starts with this byte. It can never show up in UTF-8
+# text, so a reader can tell binary and JSON messages apart on the same
+# connection without any extra state.
+MAGIC   = 0xFE
+VERSION = 1
+
+# magic, version, message type index, body length.
+HEADER = struct.Struct("!BBBI")
+NO_TYPE = 0xFF # the message type isn't one of the known ones, its in the body.
+
+# The tags for the values in the body of a binary frame. Short strings, lists
+# and maps get a one byte length, the rest get four.
+_NONE, _TRUE, _FALSE = 0x00, 0x01, 0x02
+_INT8, _INT32, _INT64, _BIGINT, _FLOAT = 0x03, 0x04, 0x05, 0x06, 0x07
+_STR8, _STR32   = 0x08, 0x09
+_LIST8, _LIST32 = 0x0A, 0x0B
+_MAP8, _MAP32   = 0x0C, 0x0D
+_WORD = 0x0E # one of the WORDS below, given by its index.
+
+# Strings that show up in nearly every message are sent as a single index.
+# Only ever append to this list, or old binary interfaces will break.
+WORDS = ["message", "source", "dest", "value", "command", "args", "title",
+         "dead", "daemon", "proceed", "id"]
+_WORD_IDS = dict((w, bytes((_WORD, i))) for i, w in enumerate(WORDS))
+
+_B   = struct.Struct("!B")
+_b   = struct.Struct("!b")
+_I   = struct.Struct("!I")
+_i   = struct.Struct("!i")
+_q   = struct.Struct("!q")
+_d   = struct.Struct("!d")
+_INT64_MIN, _INT64_MAX = -(1<<63), (1<<63)-1
+
+# If a JSON message hasn't completed after this many bytes, its garbage.
+MAX_PENDING = 1<<20
+_WHITESPACE = b" \t\r\n"
+
+# The only bytes that matter when looking for where a JSON message ends. The
+# rest are jumped over, so a long string or number costs next to nothing.
+_JSON_STOPS = re.compile(rb'["\\{}\[\]\xfe]')
+_JSON_STRSTOPS = re.compile(rb'["\\\xfe]') # inside a string.
+_JSON_STARTS = re.compile(rb'[{\[\xfe]')
+
+# Most messages come in whole and are far smaller than this, so this much of
+# the buffer is decoded straight off before scanning for where one ends.
+_JSON_WINDOW = 1<<13
+
+
+class CodecError(Exception):
+    """ Raised when a value can't be encoded in, or decoded from, one of the
+    EMP wire formats.
+    """
+    pass
+
+
+def encode(value, msgtypes, codec=JSON_CODEC, encoding="utf-8"):
+    """ Encodes a message dictionary into the bytes that are sent down the
+    socket. The list of message types is given so the type can be packed into
+    the header of the binary frame.
+    """
+    if codec == JSON_CODEC:
+        return json.dumps(value, separators=(',', ':')).encode(encoding)
+    elif codec == BINARY_CODEC:
+        body = dict(value)
+        try: mtype = msgtypes.index(body.pop("message"))
+        except (KeyError, ValueError):
+            mtype = NO_TYPE
+            if "message" in value: body["message"] = value["message"]
+        out = bytearray(HEADER.size)
+        _pack(body, out)
+        HEADER.pack_into(out, 0, MAGIC, VERSION, mtype, len(out)-HEADER.size)
+        return bytes(out)
+    else: raise CodecError("Unknown codec: %s" % codec)
+
+def decode(data, msgtypes, encoding="utf-8"):
+    """ Decodes a single message from a bytes object, the codec is figured
+    out from the first byte. Use a FrameBuffer if the data is coming off of
+    a stream.
+    """
+    if len(data) > 0 and data[0] == MAGIC:
+        return _unframe(bytes(data), msgtypes)
+    return json.loads(data.decode(encoding))
+
+def isBinary(data):
+    """ Checks if the given bytes are the start of a binary frame. """
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def _pack(value, out):
+    """ Appends the tagged form of the value to the bytearray. """
+    t = type(value)
+    if t is str:
+        word = _WORD_IDS.get(value)
+        if word is not None: 
+            out += word
+            return
+        tmp = value.encode("utf-8")
+        n = len(tmp)
+        if n < 256: out += bytes((_STR8, n))
+        else:
+            out.append(_STR32)
+            out += _I.pack(n)
+        out += tmp
+    elif value is None:  out.append(_NONE)
+    elif value is True:  out.append(_TRUE)
+    elif value is False: out.append(_FALSE)
+    elif t is dict:
+        n = len(value)
+        if n < 256: out += bytes((_MAP8, n))
+        else:
+            out.append(_MAP32)
+            out += _I.pack(n)
+        for k, v in value.items():
+            # JSON would turn the keys into strings, so we do too.
+            _pack(k if type(k) is str else json.dumps(k), out)
+            _pack(v, out)
+    elif t is list or t is tuple:
+        n = len(value)
+        if n < 256: out += bytes((_LIST8, n))
+        else:
+            out.append(_LIST32)
+            out += _I.pack(n)
+        for item in value: _pack(item, out)
+    elif isinstance(value, int):
+        if -128 <= value < 128:
+            out.append(_INT8)
+            out += _b.pack(value)
+        elif -(1<<31) <= value < (1<<31):
+            out.append(_INT32)
+            out += _i.pack(value)
+        elif _INT64_MIN <= value <= _INT64_MAX:
+            out.append(_INT64)
+            out += _q.pack(value)
+        else:
+            tmp = str(value).encode("ascii")
+            out.append(_BIGINT)
+            out += _I.pack(len(tmp))
+            out += tmp
+    elif isinstance(value, float):
+        out.append(_FLOAT)
+        out += _d.pack(value)
+    elif isinstance(value, str):  _pack(str(value), out)
+    elif isinstance(value, dict): _pack(dict(value), out)
+    elif isinstance(value, (list, tuple)): _pack(list(value), out)
+    else:
+        raise CodecError("Can't encode value of type %s" % t.__name__)
+
+def _unpack(buf, pos):
+    """ Reads one tagged value out of the buffer (a bytes object) at the given
+    position and returns it with the position just after it.
+    """
+    tag = buf[pos]; pos += 1
+    if tag == _WORD:
+        return WORDS[buf[pos]], pos+1
+    elif tag == _STR8:
+        n = buf[pos]; pos += 1
+        return buf[pos:pos+n].decode("utf-8"), pos+n
+    elif tag == _MAP8 or tag == _MAP32:
+        if tag == _MAP8: n = buf[pos]; pos += 1
+        else: n = _I.unpack_from(buf, pos)[0]; pos += 4
+        dct = {}
+        for _ in range(n):
+            k, pos = _unpack(buf, pos)
+            dct[k], pos = _unpack(buf, pos)
+        return dct, pos
+    elif tag == _LIST8 or tag == _LIST32:
+        if tag == _LIST8: n = buf[pos]; pos += 1
+        else: n = _I.unpack_from(buf, pos)[0]; pos += 4
+        lst = []
+        for _ in range(n):
+            item, pos = _unpack(buf, pos)
+            lst.append(item)
+        return lst, pos
+    elif tag == _NONE:  return None, pos
+    elif tag == _TRUE:  return True, pos
+    elif tag == _FALSE: return False, pos
+    elif tag == _INT8:  return _b.unpack_from(buf, pos)[0], pos+1
+    elif tag == _INT32: return _i.unpack_from(buf, pos)[0], pos+4
+    elif tag == _INT64: return _q.unpack_from(buf, pos)[0], pos+8
+    elif tag == _FLOAT: return _d.unpack_from(buf, pos)[0], pos+8
+    elif tag == _STR32:
+        n = _I.unpack_from(buf, pos)[0]; pos += 4
+        return buf[pos:pos+n].decode("utf-8"), pos+n
+    elif tag == _BIGINT:
+        n = _I.unpack_from(buf, pos)[0]; pos += 4
+        return int(buf[pos:pos+n].decode("ascii")), pos+n
+    else: raise CodecError("Unknown value tag: %r" % tag)
+
+def _unframe(buf, msgtypes):
+    """ Decodes a whole binary frame (header included) into a dictionary. """
+    try:
+        magic, version, mtype, length = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise CodecError("Not a version %d binary frame." % VERSION)
+        value, end = _unpack(buf, HEADER.size)
+        if end != HEADER.size+length or not isinstance(value, dict):
+            raise CodecError("Malformed binary frame body.")
+    except (struct.error, UnicodeDecodeError, ValueError, IndexError) as e:
+        raise CodecError(str(e))
+
+    if mtype != NO_TYPE:
+        if mtype >= len(msgtypes): raise CodecError("Unknown message type.")
+        value["message"] = msgtypes[mtype]
+    return value
+
+
+class FrameBuffer():
+    """ Collects the bytes coming off of a stream and cuts them up into whole
+    messages. JSON messages are found by decoding them back to back (so old
+    interfaces that don't delimit their messages still work), binary frames
+    by the length in their header. Both can be mixed on the same stream.
+    """
+    def __init__(self, msgtypes, encoding="utf-8"):
+        self._buf = bytearray()
+        self._msgtypes = msgtypes
+        self._encoding = encoding
+        self._decoder = json.JSONDecoder()
+        self._scan = _JsonScan() # how far into the JSON message at the front.
+
+    def __len__(self):
+        return len(self._buf)
+
+    def feed(self, data):
+        """ Adds the data to the buffer and returns a list of all of the
+        complete messages (as dictionaries) that can be pulled out of it.
+        Anything that doesn't parse gets logged and thrown away.
+        """
+        self._buf += data
+        values = []
+        while True:
+            # skip the whitespace between messages.
+            start = 0
+            while start < len(self._buf) and self._buf[start] in _WHITESPACE:
+                start += 1
+            if start: del self._buf[:start]
+            if not self._buf: break
+
+            if self._buf[0] == MAGIC:
+                if len(self._buf) < HEADER.size: break
+                version, length = HEADER.unpack_from(self._buf, 0)[1::2]
+                if version != VERSION or length > MAX_PENDING:
+                    # don't wait on a body that'll never be any good, skip
+                    # the magic byte and look for the next message after it.
+                    logging.error("Dropping bad binary frame header (version %d, length %d)." %
+                                  (version, length))
+                    del self._buf[:1]
+                    continue
+                end = HEADER.size + length
+                if len(self._buf) < end: break
+                frame = bytes(self._buf[:end])
+                del self._buf[:end]
+                try: values.append(_unframe(frame, self._msgtypes))
+                except CodecError as e: logging.error("Dropping bad binary frame: %s" % e)
+            else:
+                if not self.__feedjson(values): break
+        return values
+
+    def __feedjson(self, values):
+        """ Pulls one JSON message off the front of the buffer. Returns False
+        if more data is needed before it can be parsed. Its only decoded once
+        the scan finds where it ends, and the scan picks up where it left off
+        each time more of it comes in.
+        """
+        if self._buf[0] not in b"{[":
+            # not a message, but it might still be some JSON value, like the
+            # old interfaces sometimes send. Anything else is dropped up to 
+            # what looks like the next message.
+            nxt = _JSON_STARTS.search(self._buf, 1)
+            end = self.__decode(nxt.start() if nxt else len(self._buf), values)
+            del self._buf[:end]
+            return True
+        
+        if self._scan.pos == 0 and self.__decodeWhole(values): return True
+        end = self._scan.resume(self._buf)
+        if end is None:
+            if len(self._buf) <= MAX_PENDING: return False
+            logging.error("Dropping bad JSON message: its over %d bytes long." % MAX_PENDING)
+            end = len(self._buf)
+        else: end = self.__decode(end, values)
+        self._scan = _JsonScan()
+        del self._buf[:end]
+        return True
+
+    def __decodeWhole(self, values):
+        """ Tries to decode a message off the front of the buffer without
+        scanning it first. Returns False if there isn't a whole one in the
+        first _JSON_WINDOW bytes.
+        """
+        stop = self._buf.find(MAGIC, 0, _JSON_WINDOW)
+        chunk = bytes(self._buf[:_JSON_WINDOW if stop == -1 else stop])
+        try: text = chunk.decode(self._encoding)
+        except UnicodeDecodeError as e:
+            # most likely a character cut in half by the window.
+            text = chunk[:e.start].decode(self._encoding, "replace")
+        try: value, used = self._decoder.raw_decode(text)
+        except ValueError: return False
+        values.append(value)
+        del self._buf[:len(text[:used].encode(self._encoding))]
+        return True
+
+    def __decode(self, end, values):
+        """ Decodes the first end bytes of the buffer and adds the value to
+        values. Returns how many bytes to drop, always at least one so bytes
+        that aren't text at all don't stay stuck at the front.
+        """
+        try:
+            text = bytes(self._buf[:end]).decode(self._encoding)
+            value, used = self._decoder.raw_decode(text)
+        except ValueError as e: # UnicodeDecodeError is one too.
+            logging.error("Dropping bad JSON message: %s" % e)
+            return max(end, 1)
+        values.append(value)
+        if used < len(text): end = len(text[:used].encode(self._encoding))
+        return max(end, 1)
+
+
+class _JsonScan():
+    """ Finds where the top level JSON object or array at the front of a 
+    buffer ends. It remembers how far its got, so when only part of a message
+    has come in the next scan doesn't start over from the beginning.
+    """
+    __slots__ = ("pos", "closers", "instr", "escaped")
+    def __init__(self):
+        self.pos = 0
+        self.closers = []
+        self.instr = False
+        self.escaped = False
+
+    def resume(self, buf):
+        """ Scans whatever's been added since last time. Returns where the
+        message ends, or None if it hasn't yet. If the brackets don't match
+        up, or a binary frame starts, the position just past the bad byte (or
+        of the frame) is returned, since its garbage up to there.
+        """
+        pos, closers = self.pos, self.closers
+        if self.escaped and pos < len(buf):
+            if buf[pos] == MAGIC: return pos
+            pos += 1
+            self.escaped = False
+        while True:
+            m = (_JSON_STRSTOPS if self.instr else _JSON_STOPS).search(buf, pos)
+            if m is None: break
+            i, c = m.start(), buf[m.start()]
+            pos = i+1
+            if c == MAGIC: return i
+            if self.instr:
+                if c == 0x5C: # a backslash, skip what it escapes.
+                    if pos == len(buf):
+                        self.escaped = True
+                        break
+                    if buf[pos] == MAGIC: return pos
+                    pos += 1
+                elif c == 0x22: self.instr = False
+            elif c == 0x22: self.instr = True
+            elif c == 0x7B: closers.append(0x7D)
+            elif c == 0x5B: closers.append(0x5D)
+            elif c in (0x7D, 0x5D):
+                if not closers or closers.pop() != c or not closers: return pos
+        self.pos = len(buf)
+        return None
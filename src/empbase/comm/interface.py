@@ -13,48 +13,150 @@ See the License for the specific language governing permissions and
 limitations under the License. 
 """
 import logging
+import itertools
 from empbase.comm.routee import Routee
+from empbase.comm.command import Command
+from empbase.comm.codec import JSON_CODEC, CODECS
+from empbase.comm.ioloop import SLOW_DISCONNECT
+from empbase.event.streams import EventStream, DEFAULT_BUFFER, DEFAULT_CREDIT
+from empbase.event.eventmanager import addStream, removeStream
        
 class Interface(Routee):
     """ This is just so the internal references can handle interfaces as 
     Routees. 
     """
     
-    def __init__(self, router, socket):
+    def __init__(self, router, socket, streambuffer=DEFAULT_BUFFER, 
+                 streamcredit=DEFAULT_CREDIT, outputlimit=0, 
+                 slowpolicy=SLOW_DISCONNECT):
         """ Create an Interface using a socket. Assumes that it is of the
-        type DaemonServerSocket.
+        type DaemonServerSocket. The stream sizes are what each of the 
+        interface's event streams start with. The output limit is the most
+        bytes that are held for the interface if it stops reading, and the 
+        policy is what to do when that fills up (see empbase.comm.ioloop).
         """
         self._socket = socket
+        self._conn = None
         self.router = router
+        self.codec = JSON_CODEC
+        self._streams = {} # stream id -> EventStream
+        self._streamids = itertools.count(1)
+        self._streambuffer = streambuffer
+        self._streamcredit = streamcredit
+        self._outputlimit = outputlimit
+        self._slowpolicy = slowpolicy
+        self._commands = [Command("codec", trigger=self.__cmd_codec, 
+                                  help="switches this connection to one of the given message codecs."),
+                          Command("watch", trigger=self.__cmd_watch,
+                                  help="streams triggered events to this connection, given 'all', or 'plug', 'event' or 'alarm' and its id or name."),
+                          Command("unwatch", trigger=self.__cmd_unwatch,
+                                  help="stops the stream with the given id."),
+                          Command("credit", trigger=self.__cmd_credit,
+                                  help="given a stream id and a count, lets the stream send that many more events."),
+                          Command("streams", trigger=self.__cmd_streams,
+                                  help="get this connection's streams, their credit and how many events they've sent and dropped.")]
+        
+    def get_commands(self):
+        """ Interfaces have a few commands of their own that only affect their
+        connection. The router checks these before the daemon's. 
+        """
+        return self._commands
         
     def handle_msg(self, msg):
         """ Interfaces "handle the message" by sending it to the 
         interface on the other end of the socket.
         """
-        self._socket.send(msg)
+        data = self.__encode(msg)
+        if self._conn is not None: self._conn.write(data)
+        else: self._socket.send(data)
         
-    def receiver(self):
-        """ Runs the receiving portion of the interface. """
-        from empbase.comm.messages import strToMessage
+    def handle_msgs(self, msgs):
+        """ Sends a few messages at once, they're written together so it only
+        takes one system call rather than one each. 
+        """
+        data = b"".join(self.__encode(msg) for msg in msgs)
+        if self._conn is not None: self._conn.write(data, len(msgs))
+        else: self._socket.send(data)
+        
+    def __encode(self, msg):
+        if hasattr(msg, "encode") and not isinstance(msg, str):
+            return msg.encode(self.codec, self._socket.ENCODING)
+        return str(msg).encode(self._socket.ENCODING)
+        
+    def __cmd_codec(self, *args):
+        """ Picks the first codec in the given list that we know, and uses it
+        for everything sent to the interface from then on. Whatever the 
+        interface sends us is read in either codec.
+        """
+        for codec in args:
+            if codec in CODECS:
+                self.codec = codec
+                return codec
+        raise Exception("None of the given codecs are supported: %s" % ",".join(CODECS))
+        
+    def __cmd_watch(self, kind="all", target=None, *args):
+        """ Starts a stream, returns its id and the credit it starts with. """
+        stream = EventStream(next(self._streamids), self.ID, kind, target, 
+                             self.router.sendMsg, self._streambuffer, 
+                             self._streamcredit)
+        addStream(stream)
+        self._streams[stream.ID] = stream
+        return {"stream":stream.ID, "credit":stream.credit}
+    
+    def __cmd_unwatch(self, id=None, *args):
+        stream = self.__getStream(id)
+        removeStream(stream)
+        self._streams.pop(stream.ID, None)
+        return stream.stats()
+    
+    def __cmd_credit(self, id=None, count=None, *args):
+        if count is None: raise Exception("Need a stream id and a count.")
+        return self.__getStream(id).addCredit(count)
+    
+    def __cmd_streams(self, *args):
+        return dict((id, stream.stats()) for id, stream in self._streams.items())
+        
+    def __getStream(self, id):
+        try: return self._streams[int(id)]
+        except (KeyError, ValueError, TypeError): 
+            raise Exception("There is no stream %s." % id)
+        
+    def stopStreams(self):
+        """ Stops all of the interface's event streams. """
+        for stream in list(self._streams.values()):
+            removeStream(stream)
+        self._streams.clear()
+        
+    def start(self, loop):
+        """ Starts watching the interface's socket on the daemon's IOLoop. 
+        Everything it sends is handed to the router, and it deregisters 
+        itself when the socket closes. 
+        """
+        from empbase.comm.messages import MSG_TYPES
         
         #LATER: Add security to this portion. Adjust message handling for privilege level?
     
         logging.debug("starting interface comm")
-        self._socket.setblocking(True)
-        try:
-            while 1:
-                msg = self._socket.recv()
-                if not msg: break
-                else: self.router.sendMsg(strToMessage(msg))
-        except Exception as e: 
-            logging.error("interface died because: %s"%e)
-        finally:
-            logging.debug("ending interface comm")
-            self.router.rmInterface(self.ID)
-            self.close()
+        self._conn = loop.addConnection(self._socket.socket, 
+                                        onframe=self.__onframe,
+                                        onclose=self.__onclose,
+                                        msgtypes=MSG_TYPES,
+                                        encoding=self._socket.ENCODING)
+        self._conn.setLimit(self._outputlimit, self._slowpolicy)
+    
+    def __onframe(self, value):
+        from empbase.comm.messages import strToMessage
+        self.router.sendMsg(strToMessage(value))
+        
+    def __onclose(self):
+        logging.debug("ending interface comm")
+        self.stopStreams()
+        self.router.rmInterface(self.ID)
             
     def close(self):
         """ Closes the communication to the Interface. """
-        try: self._socket.shutdown()
+        self.stopStreams()
+        try:
+            if self._conn is not None: self._conn.close()
+            else: self._socket.shutdown()
         except Exception as e: logging.error(str(e))
-
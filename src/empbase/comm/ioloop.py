@@ -0,0 +1,356 @@
+"""
+Copyright (c) 2010-2011 Alexander Dean (dstar@csh.rit.edu)
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import socket
+import logging
+import selectors
+from threading import Lock, RLock, Event, get_ident
+
+from empbase.comm.codec import FrameBuffer
+
+# The loop wakes up at least this often to check if the daemon is still up.
+LOOP_LIVENESS = 2.0
+
+# How long closeSocket() waits for the loop to let go of a socket.
+RELEASE_TIMEOUT = 5.0
+
+# How much is read off of a socket at a time.
+READ_SIZE = 4096
+
+# What to do when a connection's output buffer is full, because whoever is on
+# the other end isn't reading: hang up on them, or throw away what doesn't fit.
+SLOW_DISCONNECT = "disconnect"
+SLOW_DROP       = "drop"
+SLOW_POLICIES   = [SLOW_DISCONNECT, SLOW_DROP]
+
+
+def addListener(sock, onaccept):
+    """ Watches a listening socket on the daemon's IOLoop, the onaccept
+    function is called (on the loop's thread) with each new connection. Plugs
+    can use this rather than running their own accept thread.
+    """
+    global _theIOLoop_
+    if _theIOLoop_ is not None:
+        return _theIOLoop_.addListener(sock, onaccept)
+    logging.error("There's no IOLoop running to watch the socket.")
+
+def addConnection(sock, onframe=None, onclose=None, msgtypes=None,
+                  encoding="utf-8"):
+    """ Watches a connected socket on the daemon's IOLoop. Returns the
+    Connection to write to, or None if there isn't a loop running.
+    """
+    global _theIOLoop_
+    if _theIOLoop_ is not None:
+        return _theIOLoop_.addConnection(sock, onframe, onclose, msgtypes, encoding)
+    logging.error("There's no IOLoop running to watch the socket.")
+
+def removeSocket(sock):
+    """ Stops watching a socket that was added with addListener. """
+    global _theIOLoop_
+    if _theIOLoop_ is not None:
+        _theIOLoop_.remove(sock)
+
+def closeSocket(sock):
+    """ Stops watching a socket that was added with addListener and closes it.
+    It doesn't return until its closed, so the port or path its bound to can
+    be bound again straight away (eg. by a plug that was just reloaded).
+    """
+    global _theIOLoop_
+    loop, closed = _theIOLoop_, Event()
+    def release():
+        try: 
+            if loop is not None: loop.remove(sock)
+        finally:
+            try: sock.close()
+            except OSError: pass
+            closed.set()
+    if loop is None: release()
+    else: 
+        # its closed on the loop's thread, after its unwatched, so the loop
+        # never polls a closed socket.
+        loop.call(release)
+        if not closed.wait(RELEASE_TIMEOUT):
+            logging.warning("The IOLoop didn't let go of a socket, closing it anyway.")
+            try: sock.close()
+            except OSError: pass
+
+# The IOLoop the helper functions above use.
+_theIOLoop_ = None
+
+
+class Connection():
+    """ A connected socket that is being watched by an IOLoop. Everything that
+    comes in is cut into messages and handed to onframe, and writes are
+    buffered so a slow reader never blocks whoever is writing to it.
+    """
+    def __init__(self, loop, sock, onframe=None, onclose=None, msgtypes=None,
+                 encoding="utf-8"):
+        """ The output buffer isn't bounded until setLimit() is called. """
+        self.loop = loop
+        self.socket = sock
+        self.socket.setblocking(False)
+        self._onframe = onframe
+        self._onclose = onclose
+        self._frames = FrameBuffer(msgtypes or [], encoding)
+        self._outbuf = bytearray()
+        self._lock = RLock()
+        self._writing = False # waiting for the socket to be writable.
+        self.closed = False
+        self.limit  = 0 # most bytes to hold for a slow reader, 0 for no limit.
+        self.policy = SLOW_DISCONNECT
+        self.dropped = 0 # messages thrown away because the buffer was full.
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def setLimit(self, limit, policy=SLOW_DISCONNECT):
+        """ Bounds the output buffer to limit bytes. If a write won't fit, the
+        policy says whether to drop it or close the connection.
+        """
+        if policy not in SLOW_POLICIES: 
+            raise Exception("Slow consumer policy must be one of: %s" % ", ".join(SLOW_POLICIES))
+        self.limit, self.policy = max(int(limit), 0), policy
+    
+    def write(self, data, count=1):
+        """ Sends the data, anything the socket won't take right now is kept
+        and sent by the loop when it can. Safe to call from any thread. The
+        count is how many messages are in the data, for the metrics. Returns
+        False if the data was dropped or the connection is closed.
+        """
+        with self._lock:
+            if self.closed: return False
+            sent = 0
+            if not self._outbuf:
+                try: 
+                    sent = self.socket.send(data)
+                    self.loop._wrote(sent)
+                except (BlockingIOError, InterruptedError): pass
+                except OSError as e:
+                    logging.debug("connection failed on send: %s" % e)
+                    self.loop.call(self._close)
+                    return False
+                if sent == len(data): return True
+                data = data[sent:]
+            if self.limit and len(self._outbuf)+len(data) > self.limit:
+                # a whole message fits or none of it does, so nothing gets 
+                # cut in half. If some of it's already gone out, the rest 
+                # can't be dropped without doing just that.
+                policy = SLOW_DISCONNECT if sent else self.policy
+                self.dropped += count
+                self.loop._slow(policy, count)
+                if policy == SLOW_DISCONNECT:
+                    logging.warning("closing a connection that stopped reading, %d bytes behind." % (len(self._outbuf)+len(data)))
+                    self.closed = True
+                    self._outbuf.clear() # no point in a last try.
+                    self.loop.call(self._close)
+                return False
+            self._outbuf += data
+            self.loop._buffered(len(self._outbuf))
+            if not self._writing:
+                self._writing = True
+                self.loop.call(self.loop.modify, self, selectors.EVENT_READ|selectors.EVENT_WRITE)
+            return True
+
+    def pending(self):
+        """ The number of bytes still waiting to be written. """
+        return len(self._outbuf)
+
+    def _onwritable(self):
+        with self._lock:
+            try: 
+                sent = self.socket.send(self._outbuf)
+                self.loop._wrote(sent)
+                del self._outbuf[:sent]
+            except (BlockingIOError, InterruptedError): return
+            except OSError as e:
+                logging.debug("connection failed on send: %s" % e)
+                self._outbuf.clear()
+            if not self._outbuf:
+                self._writing = False
+                self.loop.modify(self, selectors.EVENT_READ)
+
+    def _onreadable(self):
+        try: data = self.socket.recv(READ_SIZE)
+        except (BlockingIOError, InterruptedError): return
+        except OSError: data = b''
+        if not data:
+            self._close()
+            return
+        for value in self._frames.feed(data):
+            if self._onframe is not None:
+                try: self._onframe(value)
+                except Exception as e: logging.exception(e)
+
+    def close(self):
+        """ Closes the connection, whatever is still buffered is sent if the
+        socket will take it right away, the rest is lost.
+        """
+        self.loop.call(self._close)
+
+    def _close(self):
+        with self._lock:
+            if self.socket is None: return
+            self.closed = True
+            sock, self.socket = self.socket, None
+            data, self._outbuf = bytes(self._outbuf), bytearray()
+        self.loop.remove(sock)
+        try:
+            # one last try to get out what the reader hasn't taken, but only
+            # what fits, the loop can't wait on one connection.
+            if data and sock.send(data) < len(data):
+                logging.debug("closed a connection with %d bytes unsent." % len(data))
+        except OSError: pass
+        try: sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+        sock.close()
+        if self._onclose is not None:
+            try: self._onclose()
+            except Exception as e: logging.exception(e)
+
+
+class IOLoop():
+    """ Watches every interface socket (and any other socket that wants it,
+    like the TimerPlug's) from a single thread using the best selector the
+    system has. An idle connection is just an entry in the selector rather
+    than a thread blocked on recv, so thousands of them cost next to nothing.
+    """
+    def __init__(self):
+        global _theIOLoop_
+        _theIOLoop_ = self
+        self._thread = None
+        self._running = False
+        self._statlock = Lock()
+        self._counts = {"writes":0, "bytes":0, "peak-buffer":0, 
+                        "dropped":0, "disconnected":0}
+        self._setup()
+
+    def _setup(self):
+        self._selector = selectors.DefaultSelector()
+        self._calls = []
+        self._callock = Lock()
+
+        # writing a byte to this wakes the loop up out of select.
+        self._wakeread, self._wakewrite = socket.socketpair()
+        self._wakeread.setblocking(False)
+        self._wakewrite.setblocking(False)
+        self._selector.register(self._wakeread, selectors.EVENT_READ, None)
+
+    def addListener(self, sock, onaccept):
+        """ Calls onaccept with the socket's accept() result whenever a new
+        connection is waiting.
+        """
+        sock.setblocking(False)
+        self.call(self._selector.register, sock, selectors.EVENT_READ,
+                  lambda: self._accept(sock, onaccept))
+
+    def addConnection(self, sock, onframe=None, onclose=None, msgtypes=None,
+                      encoding="utf-8"):
+        """ Wraps the connected socket in a Connection and starts watching it."""
+        conn = Connection(self, sock, onframe, onclose, msgtypes, encoding)
+        self.call(self._selector.register, conn, selectors.EVENT_READ, conn)
+        return conn
+
+    def modify(self, fileobj, events):
+        """ Changes what is watched for on the socket, loop thread only. """
+        try: self._selector.modify(fileobj, events, self._selector.get_key(fileobj).data)
+        except (KeyError, ValueError, AttributeError): pass # its been closed.
+
+    def remove(self, fileobj):
+        """ Stops watching the socket or Connection. """
+        if self.inLoop():
+            try: self._selector.unregister(fileobj)
+            except (KeyError, ValueError): pass
+        else: self.call(self.remove, fileobj)
+
+    def inLoop(self):
+        """ Checks if the caller is the loop's thread, or the loop's dead. """
+        return not self._running or self._thread == get_ident()
+
+    def call(self, fn, *args):
+        """ Runs the function on the loop's thread. If that's the caller (or
+        the loop isn't running) its called straight away.
+        """
+        if self.inLoop():
+            fn(*args)
+            return
+        with self._callock:
+            self._calls.append((fn, args))
+        try: self._wakewrite.send(b'\0')
+        except (BlockingIOError, InterruptedError): pass # its already awake.
+
+    def size(self):
+        """ The number of sockets being watched. """
+        return len(self._selector.get_map())-1
+    
+    def stats(self):
+        """ How much the connections have written, and how many messages were
+        dropped or connections closed because of slow readers.
+        """
+        with self._statlock: return dict(self._counts)
+    
+    def _wrote(self, nbytes):
+        with self._statlock:
+            self._counts["writes"] += 1
+            self._counts["bytes"] += nbytes
+            
+    def _buffered(self, nbytes):
+        with self._statlock:
+            if nbytes > self._counts["peak-buffer"]: self._counts["peak-buffer"] = nbytes
+            
+    def _slow(self, policy, count):
+        with self._statlock:
+            self._counts["dropped"] += count
+            if policy == SLOW_DISCONNECT: self._counts["disconnected"] += 1
+
+    def run(self, triggermethod=lambda:False):
+        """ Runs until the trigger method returns False. """
+        self._thread = get_ident()
+        self._running = True
+        try:
+            while triggermethod():
+                for key, events in self._selector.select(LOOP_LIVENESS):
+                    handler = key.data
+                    try:
+                        if handler is None: self.__drainwakeup()
+                        elif isinstance(handler, Connection):
+                            if events & selectors.EVENT_WRITE: handler._onwritable()
+                            if events & selectors.EVENT_READ and not handler.closed:
+                                handler._onreadable()
+                        else: handler()
+                    except Exception as e: logging.exception(e)
+                self.__runcalls()
+        finally:
+            self._running = False
+            self.__runcalls()
+            for key in list(self._selector.get_map().values()):
+                if isinstance(key.data, Connection): key.data._close()
+            self._selector.close()
+            self._wakeread.close()
+            self._wakewrite.close()
+
+    def __runcalls(self):
+        with self._callock:
+            calls, self._calls = self._calls, []
+        for fn, args in calls:
+            try: fn(*args)
+            except Exception as e: logging.exception(e)
+
+    def __drainwakeup(self):
+        try:
+            while self._wakeread.recv(READ_SIZE): pass
+        except (BlockingIOError, InterruptedError): pass
+
+    def _accept(self, sock, onaccept):
+        try: onaccept(sock.accept())
+        except (BlockingIOError, InterruptedError, socket.timeout): pass
@@ -15,6 +15,7 @@ limitations under the License.
 
 import json
 import logging
+from empbase.comm.codec import JSON_CODEC, encode, decode, isBinary
 
 
 # Can be used for type checking.
@@ -22,7 +23,9 @@ ERROR_MSG_TYPE   = "err"
 COMMAND_MSG_TYPE = "cmd"
 BASE_MSG_TYPE    = "base"
 ALERT_MSG_TYPE   = "alrt"
-MSG_TYPES = [ERROR_MSG_TYPE, COMMAND_MSG_TYPE, BASE_MSG_TYPE, ALERT_MSG_TYPE]
+BATCH_MSG_TYPE   = "batch"
+MSG_TYPES = [ERROR_MSG_TYPE, COMMAND_MSG_TYPE, BASE_MSG_TYPE, ALERT_MSG_TYPE,
+             BATCH_MSG_TYPE]
 
 
 
@@ -35,29 +38,39 @@ def strToMessage(s):
     any communication between the interface and a plug-in. You most likely wont
     have to worry about this since the API 'should' take care of the 
     communication for you. 
+    
+    Bytes in either codec (see empbase.comm.codec) and dictionaries that were
+    already decoded by a FrameBuffer can be given too.
     """
     if isinstance(s, Message): return s
+    if s is None: return None
     
     try:
-        tmp = json.loads(s)
+        if isinstance(s, dict): tmp = s
+        elif isinstance(s, (bytes, bytearray)) and isBinary(s):
+            tmp = decode(s, MSG_TYPES)
+        else: 
+            tmp = json.loads(s)
         logging.debug("value JSON unloaded was: %s" % tmp)
     except Exception as e:
         logging.error("Error parsing with JSON: %s" % e)
         return None
     
-    if tmp.get("message") in MSG_TYPES:
+    if isinstance(tmp, dict) and tmp.get("message") in MSG_TYPES:
         return Message(tmp)
     else:
-        logging.error("String parsed was not a message type: %s"% tmp.getType())
+        logging.error("String parsed was not a message type: %s"% tmp)
         return None
 
 
-def makeMsg(value, source, dest):
-    """ Utility method for quickly creating a base message."""
-    return Message({"message":BASE_MSG_TYPE,
+def makeMsg(value, source, dest, id=None):
+    """ Utility method for quickly creating a base message. The id is the 
+    request id of the command it is answering, if it had one.
+    """
+    return _withId({"message":BASE_MSG_TYPE,
                     "source":source,
                     "dest": dest,
-                    "value":value})
+                    "value":value}, id)
 
 def makeAlertMsg(value, source, dest=None, title="", args=None):
     """ Utility method for quickly creating an alert message."""
@@ -68,21 +81,42 @@ def makeAlertMsg(value, source, dest=None, title="", args=None):
                     "value":value,
                     "args":args})
 
-def makeCommandMsg(cmd, source, dest=None, args=[]):
-    """ Utility method for quickly creating a command message."""
-    return Message({"message":COMMAND_MSG_TYPE,
+def makeCommandMsg(cmd, source, dest=None, args=[], id=None):
+    """ Utility method for quickly creating a command message. If an id is 
+    given the daemon puts it in the reply.
+    """
+    return _withId({"message":COMMAND_MSG_TYPE,
                     "source":source,
                     "dest":dest,
                     "command":cmd,
-                    "args":args})
+                    "args":args}, id)
 
-def makeErrorMsg(value, source, dest, dead=False):
+def makeBatchMsg(cmds, source, atomic=False, id=None):
+    """ Utility method for quickly creating a batch message. The cmds are a 
+    list of dictionaries each with a "command" and optionally a "dest" and 
+    "args", just like a command message. If atomic is True and any of them 
+    fail, the registry changes the others made are undone, they can only be
+    the daemon's subscribe and unsubscribe then.
+    """
+    return _withId({"message":BATCH_MSG_TYPE,
+                    "source":source,
+                    "dest":None,
+                    "atomic":atomic,
+                    "cmds":cmds}, id)
+
+def makeErrorMsg(value, source, dest, dead=False, id=None):
     """ Utility method for quickly creating an error message."""
-    return Message({"message":ERROR_MSG_TYPE,
+    return _withId({"message":ERROR_MSG_TYPE,
                     "source":source,
                     "dest":dest, 
                     "dead":dead,
-                    "value":value})
+                    "value":value}, id)
+
+def _withId(value, id):
+    # The id is left off unless there is one, so interfaces that don't know
+    # about request ids see the same messages as always.
+    if id is not None: value["id"] = id
+    return Message(value)
 
 
 class Message():
@@ -96,9 +130,49 @@ class Message():
     Please see the below description.
     """
     
+    # Messages are made for every hop, so keep them small. The encoded forms 
+    # are cached so a message sent to many interfaces is only serialized once.
+    __slots__ = ("_value", "_encoded")
+    
+    # The dictionary methods that change the message, calling any of these
+    # throws away the cached encodings.
+    _MUTATORS = frozenset(["update", "pop", "popitem", "setdefault", "clear"])
+    
     def __init__(self, value):
         """ Initializes the message with a dictionary object. """
-        self.value = value
+        self._value = value
+        self._encoded = {}
+        
+    @property
+    def value(self):
+        """ The dictionary the message is wrapping. """
+        return self._value
+    
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self._encoded.clear()
+        
+    def invalidate(self):
+        """ Throws away the cached encodings of this message. This happens on 
+        its own when the message is changed through the Message, but if you
+        change a list or dictionary inside of it you need to call this.
+        """
+        self._encoded.clear()
+        
+    def __getitem__(self, key):
+        return self._value[key]
+    
+    def __setitem__(self, key, value):
+        self._value[key] = value
+        self._encoded.clear()
+        
+    def __delitem__(self, key):
+        del self._value[key]
+        self._encoded.clear()
+        
+    def __contains__(self, key):
+        return key in self._value
         
     def getSource(self):
         """ Returns the source of the message """
@@ -108,6 +182,12 @@ class Message():
         """ Returns the destination of the message """
         return self.get("dest")
 
+    def getId(self):
+        """ Returns the request id of the message, or None if it has none. 
+        Replies carry the id of the command they answer.
+        """
+        return self.get("id")
+
     def getType(self):
         """ Gets the type of the message, which is one of the following:
         error, command, or base. These can be checked using the globals
@@ -128,11 +208,34 @@ class Message():
     def __getattr__(self,name):
         # get all the methods from the internal dictionary. 
         #Message is just a decorator to dict.
-        return getattr(self.value,name)
+        if name.startswith("_"): raise AttributeError(name)
+        attr = getattr(self._value,name)
+        if name in Message._MUTATORS:
+            def mutator(*args, **kwargs):
+                self._encoded.clear()
+                return attr(*args, **kwargs)
+            return mutator
+        return attr
+    
+    def encode(self, codec=JSON_CODEC, encoding="utf-8"):
+        """ Returns the message as the bytes to send down a socket in the given
+        codec. See empbase.comm.codec for what is available. The result is 
+        cached until the message is changed, so sockets can write it as is.
+        """
+        key = (codec, encoding)
+        data = self._encoded.get(key)
+        if data is None:
+            data = encode(self._value, MSG_TYPES, codec, encoding)
+            self._encoded[key] = data
+        return data
     
     def __str__(self):
         try: #output in compact form.
-            return json.dumps(self.value, separators=(',', ':'))
+            data = self._encoded.get(None)
+            if data is None:
+                data = json.dumps(self._value, separators=(',', ':'))
+                self._encoded[None] = data
+            return data
         except Exception as e:
             logging.exception(e)
         
@@ -218,6 +321,29 @@ to. So commands can vary by plug-in, see the plug-in API for handling these.
       are attached to it:
           {"message":"cmd","source":"0934287342"."name":"list-plugins"}
              
+#######
+  Batch Message Structure
+#######
+    Batches are a list of commands sent all at once, the daemon runs them in
+order and sends back a single <base> message with all of their results.
+
+        {"message" : "batch",
+         "source"  : "obj-id",
+         "dest"    : null,
+         "atomic"  : true/false,
+         "cmds"    : [{"dest":"obj-id"/null, "command":"name", "args":[]},
+                      ...] }
+
+  Explanation:
+    - atomic: if true, and any of the commands fail, the rest are skipped and
+        whatever the batch changed in the registry is put back. They can only
+        be the daemon's subscribe and unsubscribe commands.
+    - cmds: the commands to run, in order. Each is just like the body of a 
+        command message.
+    The reply's value is {"ok":true/false, "rolledback":true/false, 
+    "results":[...]} with a {"command":name, "value":value} or a 
+    {"command":name, "error":"message"} for each command.
+
 #######
   Error Message Structure
 #######                 
@@ -0,0 +1,172 @@
+"""
+Copyright (c) 2010-2011 Alexander Dean (dstar@csh.rit.edu)
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import logging
+from threading import Lock
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from empbase.comm.scheduling import FairScheduler, NOTHING
+
+DEFAULT_WORKERS = 4
+
+class WorkerPool():
+    """ A bounded set of threads for running jobs, so a busy interface can't
+    make the daemon create threads without end. Jobs past the number of
+    workers wait their turn. It keeps some counts so the daemon can report
+    how busy it is.
+    """
+    def __init__(self, name, workers=DEFAULT_WORKERS):
+        self.name = name
+        self.workers = max(int(workers), 1)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._lock = Lock()
+        self._pending = 0 # submitted but not finished
+        self._active  = 0 # currently running
+        self._done    = 0
+        self._failed  = 0
+        self._fair    = FairScheduler() # jobs from submitFrom() waiting on a worker.
+        self._fairrunning = 0           # and the ones that have one.
+
+    def submit(self, fn, *args, **kwargs):
+        """ Queues up the function to be run by one of the workers. Exceptions
+        are logged, since there is nobody to hand them back to.
+        """
+        with self._lock: self._pending += 1
+        try: return self._executor.submit(self.__run, fn, args, kwargs)
+        except RuntimeError: # we've been shut down.
+            with self._lock: self._pending -= 1
+            logging.debug("%s pool is shut down, dropped a job." % self.name)
+
+    def submitFrom(self, key, fn, *args, **kwargs):
+        """ Like submit(), but the jobs waiting on a worker take turns by key,
+        so a source with a lot of jobs can't push the others to the back.
+        """
+        with self._lock:
+            self._pending += 1
+            if self._fairrunning >= self.workers:
+                self._fair.push(key, (fn, args, kwargs))
+                return
+            self._fairrunning += 1
+        self.__submitFair(fn, args, kwargs)
+        
+    def __submitFair(self, fn, args, kwargs):
+        try: self._executor.submit(self.__runFair, fn, args, kwargs)
+        except RuntimeError:
+            with self._lock: 
+                self._pending -= 1
+                self._fairrunning -= 1
+            logging.debug("%s pool is shut down, dropped a job." % self.name)
+            
+    def __runFair(self, fn, args, kwargs):
+        """ Runs the job, then hands the worker to whoever's turn is next. """
+        self.__run(fn, args, kwargs)
+        with self._lock:
+            job, _ = self._fair.pop()
+            if job is NOTHING: 
+                self._fairrunning -= 1
+                return
+        self.__submitFair(*job)
+
+    def __run(self, fn, args, kwargs):
+        with self._lock: self._active += 1
+        try: return fn(*args, **kwargs)
+        except Exception as e:
+            with self._lock: self._failed += 1
+            logging.exception(e)
+        finally:
+            with self._lock:
+                self._active  -= 1
+                self._pending -= 1
+                self._done    += 1
+
+    def shutdown(self, wait=False):
+        """ Stops taking jobs, and if asked waits for the current ones. """
+        self._executor.shutdown(wait=wait)
+
+    def stats(self):
+        """ Returns a dictionary of the pool's counters. """
+        with self._lock:
+            return {"workers" : self.workers,
+                    "active"  : self._active,
+                    "queued"  : self._pending - self._active,
+                    "done"    : self._done,
+                    "failed"  : self._failed,
+                    "waiting" : self._fair.depths()}
+
+
+class DeliveryQueues():
+    """ Every destination gets its own queue of messages, which is drained in
+    order by one worker at a time. So the replies to one interface never get
+    reordered, but a slow interface only ever holds up its own messages.
+    """
+    def __init__(self, pool):
+        self._pool = pool
+        self._lock = Lock()
+        self._queues   = {} # id -> deque of messages
+        self._draining = set() # ids that a worker is currently emptying
+
+    def deliver(self, ref, msg):
+        """ Queues the message for the routee, and gets a worker draining its
+        queue if there isn't one already.
+        """
+        with self._lock:
+            q = self._queues.get(ref.ID)
+            if q is None: q = self._queues[ref.ID] = deque()
+            q.append(msg)
+            if ref.ID in self._draining: return
+            self._draining.add(ref.ID)
+        self._pool.submit(self.__drain, ref, q)
+
+    def __drain(self, ref, q):
+        """ Hands the routee its messages until its queue is empty. If the
+        routee can take a few at once (like an Interface) everything that's 
+        waiting is handed over together.
+        """
+        many = getattr(ref, "handle_msgs", None)
+        while True:
+            with self._lock:
+                if self._queues.get(ref.ID) is not q:
+                    return # its been removed, and maybe made over since.
+                if not q:
+                    self._draining.discard(ref.ID)
+                    return
+                if many is not None:
+                    msgs = list(q)
+                    q.clear()
+                else: msgs = [q.popleft()]
+            try: 
+                if len(msgs) > 1: many(msgs)
+                else: ref.handle_msg(msgs[0])
+            except Exception as e:
+                logging.error("delivery to %s failed: %s" % (ref.ID, e))
+
+    def remove(self, id):
+        """ Throws away anything still waiting for the given destination. """
+        with self._lock:
+            self._queues.pop(id, None)
+            self._draining.discard(id)
+
+    def depths(self):
+        """ Returns how many messages are waiting for each destination. """
+        with self._lock:
+            return dict((id, len(q)) for id, q in self._queues.items() if q)
+
+    def shutdown(self, wait=False):
+        self._pool.shutdown(wait)
+
+    def stats(self):
+        """ The pool's counters, along with the depth of each queue. """
+        stats = self._pool.stats()
+        stats["waiting"] = self.depths()
+        return stats
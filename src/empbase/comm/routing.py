@@ -12,62 +12,248 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and 
 limitations under the License. 
 """
-import time
 import queue
-import random
 import logging
-from threading import Thread
+from threading import Lock
 
 from empbase.comm.interface import Interface
+from empbase.attach.lazy import LazyAttachment
+from empbase.comm.pools import WorkerPool, DeliveryQueues, DEFAULT_WORKERS
+from empbase.comm.scheduling import FairQueue, TokenBucket
 from empbase.comm.messages import strToMessage, makeMsg, makeErrorMsg,  \
                                   ERROR_MSG_TYPE, ALERT_MSG_TYPE,       \
-                                  COMMAND_MSG_TYPE, Message
+                                  COMMAND_MSG_TYPE, BATCH_MSG_TYPE,     \
+                                  Message
+
+# Put on the message queue to wake the router up and tell it to die.
+_SHUTDOWN = object()
+
+# The router blocks on the queue, but still checks it's trigger method after 
+# this many seconds of quiet in case nobody told it to stop.
+ROUTER_LIVENESS = 5.0
+
+# What a destination in the routing table turns out to be.
+ROUTE_DAEMON  = "daemon"
+ROUTE_ROUTEE  = "routee"     # an interface, messages are delivered to it.
+ROUTE_ATTACH  = "attachment" # a loaded plug or alarm, it runs commands.
+ROUTE_LAZY    = "lazy"       # a plug or alarm that hasn't been imported yet.
+ROUTE_UNKNOWN = "unknown"    # registered, but there's nothing to hand it to.
+
+# The only commands an atomic batch can have. It holds the registry's lock
+# the whole time, so they have to be quick changes to the registry that don't
+# run attachment code or wait on any other lock.
+ATOMIC_COMMANDS = ("subscribe", "unsubscribe")
+
+
+class Route():
+    """ Where an id or command name goes, and the commands it takes by name,
+    so the router doesn't have to search for either. 
+    """
+    __slots__ = ("ID", "kind", "ref", "commands")
+    def __init__(self, id, kind, ref=None, commands=None):
+        self.ID = id
+        self.kind = kind
+        self.ref = ref
+        self.commands = {}
+        for cmd in commands or []:
+            self.commands.setdefault(cmd.name, cmd)
+
                                   
 class MessageRouter():
     """ Routing is now an object, this is so if we needed two instances of the
     Router with different registry information we can. Honestly, I can't think
     of a valid case when we would need to though.
     """
-    def __init__(self, registry, daemon, attachments):
+    def __init__(self, registry, daemon, attachments, cmdworkers=DEFAULT_WORKERS,
+                 attachworkers=DEFAULT_WORKERS, deliveryworkers=DEFAULT_WORKERS,
+                 msgqueue=None, ratelimit=0, rateburst=20, sourcequeue=0):
+        """ The message queue can be swapped out for anything with the same
+        put/get_nowait/empty/qsize/depths methods as the FairQueue, like the
+        asyncio runtime's. If the rate limit isn't 0, each interface can only
+        send that many messages a second (with bursts of up to rateburst), 
+        the rest wait their turn. If the source queue isn't 0, only that many
+        of an interface's messages can be waiting, the rest get an Error back.
+        """
         self._routees = {} #the registered receivers of messages (Routee objects)
-        self._msg_queue = queue.Queue()#thread-safe message queue
+        self._msg_queue = msgqueue if msgqueue is not None else FairQueue()#thread-safe message queue
+        self._ratelimit = (float(ratelimit), rateburst)
+        self._buckets = {} # interface id -> TokenBucket, if rate limited.
+        self._sourcequeue = max(int(sourcequeue), 0)
         self._registry = registry # the object all attachments and events are registered
         self._attachments = attachments
         self._daemon = (self._registry.daemonId(), daemon)
+        
+        # Every id and command name the registry knows, to its Route. Its 
+        # built the first time its needed and thrown away whenever something
+        # is registered, deregistered or renamed.
+        self._routes = None
+        self._generation = 0 # bumped by invalidate(), a table built across it is stale.
+        self._routelock = Lock()
+        self._rebuilds = 0
+        self._registry.addListener(self.invalidate)
+        
+        # Commands are run by a fixed number of threads, the daemon's and the
+        # attachments' are kept apart so a slow plug can't stall 'status'.
+        self._cmdpool    = WorkerPool("daemon-commands", cmdworkers)
+        self._attachpool = WorkerPool("attachment-commands", attachworkers)
+        self._delivery   = DeliveryQueues(WorkerPool("delivery", deliveryworkers))
             
     def addInterface(self, ref):
         """ If this throws an error, it's because the reference isn't 
         registered yet. 
         """
         self._routees[ref.ID] = ref
+        if self._ratelimit[0] > 0:
+            self._buckets[ref.ID] = TokenBucket(*self._ratelimit)
+        self.invalidate()
     
     def isRegistered(self, cid):
         """ Checks the internal registry if the id or name is registered. """
-        if self._registry.isRegistered(cid):
+        if self.getRoute(cid) is not None:
             logging.debug("%s is registered"%cid)
             return True
         else:
             logging.debug("%s is NOT registered"%cid)
             return False
     
+    def getRoute(self, cid):
+        """ Returns the Route for an id or command name, or None if nothing by
+        that name is registered.
+        """
+        routes = self._routes
+        if routes is None: routes = self.__buildRoutes()
+        return routes.get(cid)
+    
+    def invalidate(self):
+        """ Throws away the routing table, the next message builds a new one."""
+        self._generation += 1
+        self._routes = None
+    
+    def __buildRoutes(self):
+        """ Looks up where everything the registry knows about goes. The 
+        registry is locked while this happens, so if it changes the table is 
+        thrown out after its built and not before. Interfaces come and go
+        without the registry, so if invalidate() is called while its being
+        built its built over again.
+        """
+        with self._registry.locked(), self._routelock:
+            while True:
+                if self._routes is not None: return self._routes
+                generation = self._generation
+                did, base = self._daemon
+                byid = {}
+                for attach in self._attachments.getAllPlugins():
+                    byid[attach.plugin_object.ID] = attach.plugin_object
+            
+                routes, made = {}, {}
+                for cid, id in self._registry.targets().items():
+                    route = made.get(id)
+                    if route is None:
+                        if id == did:
+                            route = Route(id, ROUTE_DAEMON, base, 
+                                          base.get_commands() if base is not None else None)
+                        elif id in self._routees:
+                            ref = self._routees[id]
+                            route = Route(id, ROUTE_ROUTEE, ref, 
+                                          ref.get_commands() if isinstance(ref, Interface) else None)
+                        elif id in byid and isinstance(byid[id], LazyAttachment):
+                            # asking for its commands would import it.
+                            route = Route(id, ROUTE_LAZY, byid[id])
+                        elif id in byid:
+                            route = Route(id, ROUTE_ATTACH, byid[id], byid[id].get_commands())
+                        else: route = Route(id, ROUTE_UNKNOWN)
+                        made[id] = route
+                    routes[cid] = route
+                self._rebuilds += 1
+                if generation == self._generation:
+                    self._routes = routes
+                    return routes
+                # an interface came or went while it was being built.
+
     def rmInterface(self, id):
         """ Removes an interface from the registry."""
         if self._routees.pop(id, False):
+            self.invalidate()
+            self._buckets.pop(id, None)
+            self._delivery.remove(id)
             return self._registry.deregister(id)
         return False
         
         
     def sendMsg(self, msg):
-        """ Adds a message to the message queue so it can be sent. """
-        self._msg_queue.put(msg) #blocks until open slot... SHOULDN'T HAPPEN!
+        """ Adds a message to the message queue so it can be sent. Messages 
+        from an interface wait in that interface's lane, and everything going
+        to an interface waits in a lane for it, so a busy interface only 
+        slows down itself.
+        """
+        key, ready, limit = None, 0.0, 0
+        if isinstance(msg, Message):
+            source = msg.getSource()
+            if source in self._routees:
+                key, limit = source, self._sourcequeue
+                bucket = self._buckets.get(source)
+                if bucket is not None: ready = bucket.reserve()
+            else: key = "to:%s" % msg.getDestination()
+        if not self._msg_queue.put(msg, key, ready, limit):
+            logging.debug("%s has too many messages waiting, refused: %s" % (key, msg))
+            if msg.getType() != ERROR_MSG_TYPE:
+                self.sendMsg(makeErrorMsg("Too many messages waiting, slow down.", msg.getDestination(),
+                                          msg.getSource(), id=msg.getId()))
+            return
         logging.debug("added message to send queue: %s" % msg)
     
+    def setRateLimit(self, ratelimit, rateburst):
+        """ Changes how many messages a second each interface can send, the 
+        ones that are already connected start over with a full bucket.
+        """
+        self._ratelimit = (float(ratelimit), rateburst)
+        buckets = {}
+        if self._ratelimit[0] > 0:
+            for id in list(self._routees): buckets[id] = TokenBucket(*self._ratelimit)
+        self._buckets = buckets
+    
+    def setSourceQueue(self, sourcequeue):
+        """ Changes how many messages each interface can have waiting. """
+        self._sourcequeue = max(int(sourcequeue), 0)
+    
+    def stop(self):
+        """ Wakes the router up and makes it exit. The shutdown has a lane of
+        its own so it can come out before other interfaces' messages, but
+        the router routes everything that's waiting before it exits (see
+        routeQueued), except what the rate limit is still holding back.
+        """
+        self._msg_queue.put(_SHUTDOWN)
+    
+    def routeQueued(self):
+        """ Routes the messages that are waiting and ready to go, without
+        waiting for more. Only as many as were queued when its called are
+        taken, so interfaces that keep sending can't keep it from returning.
+        """
+        for _ in range(self._msg_queue.qsize()):
+            try: msg = self._msg_queue.get_nowait()
+            except queue.Empty: return
+            if msg is _SHUTDOWN: continue
+            try: self.route(msg)
+            except Exception as e: logging.exception(e)
+    
+    def stats(self):
+        """ Returns how busy the router's pools are and how many messages are
+        waiting to be routed or delivered.
+        """
+        return {"queued"    : self._msg_queue.qsize(),
+                "sources"   : self._msg_queue.depths(),
+                "commands"  : self._cmdpool.stats(),
+                "attachment-commands" : self._attachpool.stats(),
+                "delivery"  : self._delivery.stats(),
+                "routes"    : {"targets" : len(self._routes or {}),
+                               "rebuilds": self._rebuilds}}
+    
     def flush(self):
         """ Make sure all messages get where they are going before shutdown."""
         # LATER: Push all messages were they need to go. Right now just purging.
         try:
             while not self._msg_queue.empty(): 
-                self._msg_queue.get()
+                self._msg_queue.get_nowait()
         except:pass
         finally:#deregister all tmps, makes sure all interface threads are dead
             while len(self._routees) > 0:
@@ -77,6 +263,8 @@ class MessageRouter():
                     routee.handle_msg(makeMsg("shutting-down",None,id))
                     routee.close()
                 logging.debug("deregistered: %s"%id)
+            for pool in (self._cmdpool, self._attachpool, self._delivery):
+                pool.shutdown()
                 
                 
     def __sendToDaemon(self, msg):
@@ -85,30 +273,154 @@ class MessageRouter():
         _,base=self._daemon
         if base is not None:
             if msg.getType() == COMMAND_MSG_TYPE:
-                found = False
-                for cmd in base.get_commands():
-                    #logging.debug("comparing: %s ?= %s"%(cmd,msg.getValue()))
-                    if cmd == msg.getValue():
-                        found = True 
-                        Thread(target=self._cmdrun, args=msg.get("args"),
-                               kwargs={"cmd":cmd, "dest":msg.getSource(),
-                                       "source":msg.getDestination()}).start()
-                if not found:
-                    self.sendMsg(makeErrorMsg("Command does not exist.",msg.getDestination(), msg.getSource() ))
+                cmd = self.__daemonCommand(msg.getValue(), msg.getSource())
+                if cmd is not None:
+                    self._cmdpool.submitFrom(msg.getSource(), self._cmdrun, 
+                                             *(msg.get("args") or []),
+                                             cmd=cmd, dest=msg.getSource(),
+                                             source=msg.getDestination(),
+                                             id=msg.getId())
+                else:
+                    self.sendMsg(makeErrorMsg("Command does not exist.",msg.getDestination(), msg.getSource(), id=msg.getId()))
             elif msg.getType() == ERROR_MSG_TYPE:
                 logging.error("error from %s: %s" % (msg.getSource(), msg.getValue()))
             else: #alert or base we ignore
                 pass
         else: logging.debug("should have sent the message to the base handler")
+    
+    def __daemonCommand(self, name, source):
+        """ Finds a command for the daemon. Interfaces have commands for their
+        own connection, these are checked before the daemon's.
+        """
+        if not isinstance(name, str): return None
+        ref = self.getRoute(source)
+        if ref is not None and ref.kind == ROUTE_ROUTEE and name in ref.commands:
+            return ref.commands[name]
+        daemon = self.getRoute(self._daemon[0])
+        if daemon is None: return None
+        return daemon.commands.get(name)
         
-    def _cmdrun(self, *args, cmd=None, dest=None, source=None):
-        """ Runs as a separate thread for taking care of commands."""
+    def _cmdrun(self, *args, cmd=None, dest=None, source=None, id=None):
+        """ Runs on one of the command pools for taking care of commands. The
+        reply carries the command's request id, since commands from the same
+        interface can finish in any order.
+        """
         try:
             if cmd == None: return
             value = cmd.run(*args)
-            self.sendMsg(makeMsg(value,source,dest))
+            self.sendMsg(makeMsg(value,source,dest,id=id))
         except Exception as e:
-            self.sendMsg(makeErrorMsg(str(e), source, dest))    
+            self.sendMsg(makeErrorMsg(str(e), source, dest, id=id))    
+
+    def __startBatch(self, msg):
+        """ Checks a batch over and hands it to a pool to run. If all of its
+        commands are for the daemon its run with the daemon's commands, 
+        otherwise with the attachments'.
+        """
+        cmds = msg.get("cmds")
+        if not isinstance(cmds, list) or len(cmds) == 0:
+            self.sendMsg(makeErrorMsg("Batch has no commands.", msg.getDestination(), 
+                                      msg.getSource(), id=msg.getId()))
+            return
+        pool = self._cmdpool
+        for item in cmds:
+            if isinstance(item, dict) and not self.__isDaemon(item.get("dest")):
+                pool = self._attachpool
+                break
+        if msg.get("atomic") and not all(self.__isAtomic(item) for item in cmds):
+            # routing and new interfaces would wait on anything else, or it
+            # could wait on a lock held by someone waiting on the registry.
+            self.sendMsg(makeErrorMsg("Atomic batches can only have these daemon commands: %s." %
+                                      ", ".join(ATOMIC_COMMANDS), 
+                                      msg.getDestination(), msg.getSource(), id=msg.getId()))
+            return
+        pool.submitFrom(msg.getSource(), self._batchrun, cmds, 
+                        atomic=bool(msg.get("atomic")),
+                        dest=msg.getSource(), source=msg.getDestination(),
+                        id=msg.getId())
+
+    def _batchrun(self, cmds, atomic=False, dest=None, source=None, id=None):
+        """ Runs the commands of a batch one after the other and replies once
+        with all of their results. If the batch is atomic (only ATOMIC_COMMANDS,
+        see __startBatch) the registry is locked for the whole thing,
+        and the first failure skips the rest and puts back whatever the batch
+        changed in the registry.
+        """
+        results, failed = [], False
+        if atomic:
+            # anything they name that hasn't been imported is woken first,
+            # waking takes locks that can't be taken under the registry's.
+            for item in cmds: self.__wakeArgs(item)
+            lock = self._registry.locked()
+            lock.acquire()
+            snapshot = self._registry.snapshot()
+        try:
+            for item in cmds:
+                name = item.get("command") if isinstance(item, dict) else None
+                if failed and atomic:
+                    results.append({"command":name, "error":"skipped"})
+                    continue
+                try:
+                    cmd = self.__findCommand(item, dest)
+                    results.append({"command":name, 
+                                    "value":cmd.run(*(item.get("args") or []))})
+                except Exception as e:
+                    results.append({"command":name, "error":str(e)})
+                    failed = True
+            if failed and atomic:
+                self._registry.restore(snapshot)
+        except Exception as e:
+            logging.exception(e)
+            self.sendMsg(makeErrorMsg(str(e), source, dest, id=id))
+            return
+        finally:
+            if atomic: lock.release()
+        self.sendMsg(makeMsg({"ok": not failed, 
+                              "rolledback": failed and atomic,
+                              "results": results}, source, dest, id=id))
+
+    def __wake(self, standin, msg):
+        """ Imports the attachment the command is for, then sends it on. """
+        try: standin.wake()
+        except Exception as e:
+            logging.exception(e)
+            self.sendMsg(makeErrorMsg("Couldn't load the target: %s" % e, msg.getDestination(), 
+                                      msg.getSource(), id=msg.getId()))
+            return
+        self.sendMsg(msg)
+
+    def __isAtomic(self, item):
+        return (isinstance(item, dict) and self.__isDaemon(item.get("dest")) and
+                item.get("command") in ATOMIC_COMMANDS)
+    
+    def __wakeArgs(self, item):
+        """ Imports the attachments a subscription names, if they're lazy. """
+        for arg in item.get("args") or []:
+            if not isinstance(arg, str): continue
+            route = self.getRoute(arg.split(".")[0])
+            if route is not None and route.kind == ROUTE_LAZY:
+                try: route.ref.wake()
+                except Exception as e: logging.exception(e) # the command will fail.
+    
+    def __isDaemon(self, target):
+        return target in (None, "", "daemon", self._daemon[0])
+
+    def __findCommand(self, item, source):
+        """ Looks up a command of a batch, the same way single commands are. """
+        if not isinstance(item, dict) or "command" not in item:
+            raise Exception("Not a command.")
+        target = item.get("dest")
+        if self.__isDaemon(target):
+            cmd = self.__daemonCommand(item["command"], source)
+        else:
+            route = self.getRoute(target)
+            if route is None: raise Exception("I don't know who %s is." % target)
+            if route.kind == ROUTE_LAZY:
+                route.ref.wake() # its put in its place, so its route changes.
+                route = self.getRoute(target)
+            cmd = route.commands.get(item["command"]) if isinstance(item["command"], str) else None
+        if cmd is None: raise Exception("Command does not exist.")
+        return cmd
            
     def startRouter(self, triggermethod=lambda:False):
         """ This is the thread that runs and pushes messages everywhere. """
@@ -116,84 +428,88 @@ class MessageRouter():
         logging.debug("ComRouter thread has started")
         while triggermethod():
             try:
-                if self._msg_queue.empty():raise queue.Empty
-                msg = self._msg_queue.get() #remove and return a message
-                
-                if isinstance(msg, str): 
-                    msg = strToMessage(msg)
-                elif msg is None or not isinstance(msg, Message): 
-                    continue
-                
-                logging.debug("destination: %s"%msg.getDestination())
-                
-                # if the destination is not "registered" but its a known type
-                if msg.getDestination() == "" or msg.getDestination() == None:
-                    # Check if the message type is an alert, if it is, then send it
-                    # to all interfaces and alerters. We keep this functionality for
-                    # possible use in Chat programs or quick universal relays. But
-                    # actual "Alerts" are now called Events and are managed by the
-                    # EventManager.
-                    if msg.getType() == ALERT_MSG_TYPE:
-                        for id in list( self._routees.keys()):
-                            logging.debug("sending alert to %s: %s"% (id, msg))
-                            _,ref = self._routees.get(id)
-                            if isinstance(ref, Interface):
-                                Thread(target=ref.handle_msg, args=(msg,)).start()
-                            # Notice, alarms don't get the message.
-                            
-                    # if not send it to the daemon to handle.
-                    else:
-                        self.__sendToDaemon(msg)
-                            
-                
-                elif self.isRegistered(msg.getDestination()):
-                    if msg.getDestination() == "daemon" or msg.getDestination() == None:
-                        self.__sendToDaemon(msg)
-                        continue
-                    # if its registered, it could be a routee or an attachment.
-                    if msg.getType() == COMMAND_MSG_TYPE:
-                        cmds = self._attachments.getCommands(msg.getDestination())
-                        if cmds is not None:#we can run the command and send the result.
-                            found = False
-                            for cmd in cmds:
-                                if cmd == msg.getValue():
-                                    found = True
-                                    Thread(target=self._cmdrun, args=msg.get("args"),
-                                           kwargs={"cmd":cmd, "dest":msg.getSource(),
-                                                   "source":msg.getDestination()}).start()
-                            if not found:
-                                self.sendMsg(makeErrorMsg("Command does not exist.",msg.getDestination(), msg.getSource() ))
-                            continue   
-                            
-                    #ok to send since its been registered, but is a routee
-                    ref = self._routees.get(msg.getDestination(),None)
-                    if ref is not None:
-                        logging.debug("sending message: %s" % msg)
-                        Thread(target=ref.handle_msg, args=(msg,)).start()
-                    else: #send to daemon.
-                        self.__sendToDaemon(msg)
-                
-                # if we don't know how to handle the message, log and discard it. oh well.
-                else:
-                    logging.warning("I don't know who %s is, msg=%s" % 
-                                    (msg.getDestination(), str(msg.getValue())))
-                    
+                # sleep until there is something to do, sending is what wakes
+                # us up so there is no delay on the first message after a 
+                # quiet spell.
+                msg = self._msg_queue.get(timeout=ROUTER_LIVENESS)
+                if msg is _SHUTDOWN: 
+                    self.routeQueued()
+                    break
+                self.route(msg)
             except queue.Empty: pass
             except Exception as e:
                 logging.exception(e)
-    
-            ## then we sleep for a while. This is randomized because we don't really know
-            ## the speed at which messages are being sent. We could write a method to adapt
-            ## to the internal rate, later. But currently randomizing provides a better 
-            ## compensation than a constant time factor.
-            if not self._msg_queue.empty(): continue
-            try: time.sleep(random.random())
-            except: pass
             
         #when closing, it doesn't need to clean anything, just die and 
         #log about it
         logging.debug("ComRouter thread has died")
         
-    
-    
-        
\ No newline at end of file
+    def route(self, msg):
+        """ Sends a single message on to where it's going. """
+        if isinstance(msg, str): 
+            msg = strToMessage(msg)
+        elif msg is None or not isinstance(msg, Message): 
+            return
+        
+        if msg.getType() == BATCH_MSG_TYPE:
+            self.__startBatch(msg)
+            return
+        
+        logging.debug("destination: %s"%msg.getDestination())
+        
+        # if the destination is not "registered" but its a known type
+        if msg.getDestination() == "" or msg.getDestination() == None:
+            # Check if the message type is an alert, if it is, then send it
+            # to all interfaces and alerters. We keep this functionality for
+            # possible use in Chat programs or quick universal relays. But
+            # actual "Alerts" are now called Events and are managed by the
+            # EventManager.
+            if msg.getType() == ALERT_MSG_TYPE:
+                # the message caches its encoding, so its only 
+                # serialized once no matter how many get it.
+                for id in list( self._routees.keys()):
+                    logging.debug("sending alert to %s: %s"% (id, msg))
+                    ref = self._routees.get(id)
+                    if isinstance(ref, Interface):
+                        self._delivery.deliver(ref, msg)
+                    # Notice, alarms don't get the message.
+                    
+            # if not send it to the daemon to handle.
+            else:
+                self.__sendToDaemon(msg)
+                    
+        
+        else:
+            # one lookup says where it goes, and what commands it has.
+            route = self.getRoute(msg.getDestination())
+            if route is None: 
+                # if we don't know how to handle the message, log and discard
+                # it. oh well.
+                logging.warning("I don't know who %s is, msg=%s" % 
+                                (msg.getDestination(), str(msg.getValue())))
+                return
+            
+            if route.kind == ROUTE_ATTACH and msg.getType() == COMMAND_MSG_TYPE:
+                # we can run the command and send the result.
+                name = msg.getValue()
+                cmd = route.commands.get(name) if isinstance(name, str) else None
+                if cmd is not None:
+                    self._attachpool.submitFrom(msg.getSource(), self._cmdrun, 
+                                                *(msg.get("args") or []),
+                                                cmd=cmd, dest=msg.getSource(),
+                                                source=msg.getDestination(),
+                                                id=msg.getId())
+                else:
+                    self.sendMsg(makeErrorMsg("Command does not exist.",msg.getDestination(), msg.getSource(), id=msg.getId()))
+                    
+            elif route.kind == ROUTE_LAZY and msg.getType() == COMMAND_MSG_TYPE:
+                # importing it can take a while, so its done off the router's
+                # thread. The command is routed again once its in its place.
+                self._attachpool.submitFrom(msg.getSource(), self.__wake, route.ref, msg)
+                
+            #ok to send since its been registered, but is a routee
+            elif route.kind == ROUTE_ROUTEE:
+                logging.debug("sending message: %s" % msg)
+                self._delivery.deliver(route.ref, msg)
+            else: #send to daemon.
+                self.__sendToDaemon(msg)
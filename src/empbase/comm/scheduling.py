@@ -0,0 +1,145 @@
+"""
+Copyright (c) 2010-2011 Alexander Dean (dstar@csh.rit.edu)
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import time
+import queue
+from threading import Condition
+from collections import deque
+
+#
+# The router used to have one FIFO queue for everything, so an interface that
+# sent a flood of commands pushed everyone else's to the back of the line.
+# Now every source gets a lane of its own and the lanes take turns, one
+# message each. Sources can also be rate limited, a message that's over the
+# limit just isn't ready yet and its lane is skipped until it is. A lane can
+# be given a limit on how much it holds, so a source that keeps sending while
+# its rate limited can't grow it without end.
+#
+
+# Returned by FairScheduler.pop() when there's nothing ready.
+NOTHING = object()
+
+
+class TokenBucket():
+    """ Allows rate messages a second on average, and up to burst at once. """
+    def __init__(self, rate, burst):
+        self.rate  = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    def reserve(self):
+        """ Takes a token and returns the time it can be used, which is now
+        unless the bucket is empty. Going into debt rather than refusing keeps
+        the messages in order.
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now-self._last)*self.rate)
+        self._last = now
+        self._tokens -= 1
+        if self._tokens >= 0: return now
+        return now - self._tokens/self.rate
+
+
+class FairScheduler():
+    """ Round-robin over a FIFO lane per key. Not thread-safe on its own, see
+    FairQueue.
+    """
+    def __init__(self):
+        self._lanes = {}     # key -> deque of (ready time, item)
+        self._ring = deque() # keys with something waiting, in turn order.
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, key, item, ready=0.0, limit=0):
+        """ Adds the item to the back of its key's lane. It won't be handed
+        out before the ready time (from time.monotonic()). If the lane already
+        has limit items (and limit isn't 0) it isn't added, and False is 
+        returned.
+        """
+        lane = self._lanes.get(key)
+        if limit and lane is not None and len(lane) >= limit: return False
+        if lane is None:
+            lane = self._lanes[key] = deque()
+            self._ring.append(key)
+        lane.append((ready, item))
+        self._size += 1
+        return True
+
+    def pop(self):
+        """ Returns the next item and None, or NOTHING and how long until a
+        rate limited item is ready (None if the scheduler is empty).
+        """
+        now, wait = time.monotonic(), None
+        for _ in range(len(self._ring)):
+            key = self._ring[0]
+            self._ring.rotate(-1) # its turn is over either way.
+            lane = self._lanes[key]
+            ready, item = lane[0]
+            if ready <= now:
+                lane.popleft()
+                self._size -= 1
+                if not lane: # rotated to the end, so thats where it is.
+                    del self._lanes[key]
+                    self._ring.pop()
+                return item, None
+            if wait is None or ready-now < wait: wait = ready-now
+        return NOTHING, wait
+
+    def depths(self):
+        """ Returns how many items are waiting in each lane. """
+        return dict((str(key), len(lane)) for key, lane in self._lanes.items())
+
+
+class FairQueue():
+    """ A thread-safe FairScheduler with the same put/get/get_nowait/empty/
+    qsize methods as queue.Queue, so the router can block on it.
+    """
+    def __init__(self):
+        self._sched = FairScheduler()
+        self._cond = Condition()
+
+    def put(self, item, key=None, ready=0.0, limit=0):
+        """ Returns False if the item's lane is full, see FairScheduler.push."""
+        with self._cond:
+            if not self._sched.push(key, item, ready, limit): return False
+            self._cond.notify()
+            return True
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic()+timeout
+        with self._cond:
+            while True:
+                item, wait = self._sched.pop()
+                if item is not NOTHING: return item
+                if not block: raise queue.Empty
+                if deadline is not None:
+                    left = deadline-time.monotonic()
+                    if left <= 0: raise queue.Empty
+                    wait = left if wait is None else min(wait, left)
+                self._cond.wait(wait)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def qsize(self):
+        with self._cond: return len(self._sched)
+
+    def depths(self):
+        with self._cond: return self._sched.depths()
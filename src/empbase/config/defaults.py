@@ -45,6 +45,25 @@ DEFAULT_CONFIGS = {
     # registry file.
       "registry-file" : "",
  
+    # where what was found in the attachment directories is remembered 
+    # between starts, so only what's changed is read again. Leave it empty 
+    # to look through everything every time.
+      "manifest-file" : "",
+ 
+    # attachments that aren't made active at start up aren't imported until
+    # they're first wanted, by a command, a subscription or being activated.
+    # Its the manifest that says what they are without importing them, so
+    # the first start after one's changed still imports it.
+      "lazy-load" : "false",
+ 
+    # how many attachments are loaded, and then activated, at the same time, 
+    # and how many seconds each one can take before the daemon goes on 
+    # without it (0 for no limit). An attachment can have its own 
+    # 'startup-timeout' in its section for its activation. With 1 worker
+    # they're done one after the other, and the timeout can't cut one short.
+      "startup-workers" : "4",
+      "startup-timeout" : "30",
+ 
     # the location of the directory to save all data to, can't be relative. 
       "base-dir" : "",
     
@@ -58,6 +77,45 @@ DEFAULT_CONFIGS = {
     # allowed to go, but it can be adjusted to longer than 1 minute.
       "update-speed" : "1.0",
  
+    # a LoopPlug can poll faster or slower by giving its own 'update-interval'
+    # in seconds, otherwise its importance speeds it up or slows it down. 
+    # Each wait is stretched or shrunk by up to update-jitter (a fraction of
+    # the interval) so the plugs don't all go off at once.
+      "update-jitter" : "0.1",
+ 
+    # adaptive LoopPlugs double their wait after each update that triggers 
+    # nothing, up to update-backoff times their interval, and go back to it 
+    # as soon as one does. A plug can set its own 'update-adaptive', and its
+    # bounds in seconds with 'update-min-interval' and 'update-max-interval'.
+      "update-adaptive" : "false",
+      "update-backoff" : "8",
+ 
+    # how many LoopPlugs can update at the same time, and how many seconds one
+    # can take before its logged as stuck (0 for no limit). A plug can have
+    # its own 'update-timeout' in its section.
+      "update-workers" : "4",
+      "update-timeout" : "60",
+ 
+    # how many seconds an alert can run before its logged as stuck (0 for no
+    # limit), an alarm can have its own 'alert-timeout' in its section.
+      "alert-timeout" : "60",
+ 
+    # what's done about an attachment whose update or alert gets stuck, or 
+    # whose worker process dies: 'log' it, or 'restart' the attachment. Only
+    # one with 'worker-process = true' can be restarted, the rest are just
+    # counted. The first restart waits watchdog-backoff seconds and each one 
+    # after that twice as long, up to watchdog-max-backoff. After 
+    # watchdog-limit of them in a row its deactivated until its reloaded.
+      "watchdog" : "log",
+      "watchdog-backoff" : "1",
+      "watchdog-max-backoff" : "300",
+      "watchdog-limit" : "5",
+ 
+    # how many seconds the daemon waits, when its stopped, for running 
+    # updates to finish and queued messages to be delivered before it gives
+    # up on them.
+      "shutdown-timeout" : "5",
+ 
     # only allow local interface connections.
       "local-only" : "true",
       
@@ -69,7 +127,46 @@ DEFAULT_CONFIGS = {
       "allow-all" : "false",
       
     # Allow emp to boot up at startup
-      "boot-launch" : "true"
+      "boot-launch" : "true",
+      
+    # the number of threads that run daemon commands, and the number that run 
+    # attachment commands. Commands past these wait their turn.
+      "command-workers" : "4",
+      "attachment-workers" : "4",
+      
+    # the number of threads that push messages out to the interfaces. Each 
+    # interface still gets its messages in order.
+      "delivery-workers" : "4",
+      
+    # how many messages a second each interface can send, 0 for no limit. It
+    # can send up to rate-burst at once before the limit kicks in. Messages
+    # over the limit aren't dropped, they just wait.
+      "rate-limit" : "0",
+      "rate-burst" : "20",
+      
+    # how many messages from each interface can be waiting to be routed, 0
+    # for no limit. The ones past it get an Error back instead of waiting.
+      "source-queue" : "1000",
+      
+    # each event stream an interface watches holds this many events while it 
+    # waits for credit (then the oldest are dropped), and starts with this
+    # much credit.
+      "stream-buffer" : "100",
+      "stream-credit" : "10",
+      
+    # the most bytes held for an interface that isn't reading what it's sent
+    # (0 for no limit), and what to do when that fills up: 'disconnect' the
+    # interface, or 'drop' the messages that don't fit.
+      "output-buffer" : "1048576",
+      "slow-consumer" : "disconnect",
+      
+    # the size in bytes of the ring buffer local processes can push events to
+    # trigger into (see empbase.event.ringbuffer), 0 to not share one.
+      "event-ring" : "0",
+      
+    # how the daemon runs its router, event dispatch and interface server,
+    # either 'threads' or 'asyncio' (as coroutines on a single event loop).
+      "runtime" : "threads"
     },
 
 #Logging section-
@@ -119,6 +216,7 @@ if CUR_PLATFORM.find("linux")!=-1:    #linux systems.
     
     DEFAULT_CONFIGS["Daemon"]["pid-file"]="/var/tmp/emp.pid"
     DEFAULT_CONFIGS["Daemon"]["registry-file"]=SAVE_DIR+"/registry.xml"
+    DEFAULT_CONFIGS["Daemon"]["manifest-file"]=SAVE_DIR+"/manifest.json"
     
     DEFAULT_CONFIGS["Logging"]["log-file"]=BASE_DIR+"/errors.log"
     
@@ -141,6 +239,7 @@ elif CUR_PLATFORM.find("win32")!=-1:  # Windows systems.
     
     DEFAULT_CONFIGS["Daemon"]["pid-file"]=BASE_DIR+"/running.pid"
     DEFAULT_CONFIGS["Daemon"]["registry-file"]=SAVE_DIR+"/registry.xml"
+    DEFAULT_CONFIGS["Daemon"]["manifest-file"]=SAVE_DIR+"/manifest.json"
     
     DEFAULT_CONFIGS["Logging"]["log-file"]=BASE_DIR+"/errors.log"
     
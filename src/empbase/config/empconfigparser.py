@@ -71,7 +71,49 @@ class EmpConfigParser(ConfigParser):
         ### ### VALIDATION ### ### 
         #then check if the update speed is valid, must be >= 1 minute
         if self.getfloat("Daemon","update-speed") < 1.0:
-            self.set("Daemon","update-speed", 1.0)
+            self.set("Daemon","update-speed", "1.0")
+        
+        #jitter is a fraction of a plug's interval.
+        if not 0.0 <= self.getfloat("Daemon","update-jitter") < 1.0:
+            self.set("Daemon","update-jitter", "0.1")
+        
+        #an adaptive plug can't poll faster than its interval by backing off.
+        if self.getfloat("Daemon","update-backoff") < 1.0:
+            self.set("Daemon","update-backoff", "1")
+        
+        #attachments are loaded and activated side by side, each in time.
+        if self.getint("Daemon","startup-workers") < 1:
+            self.set("Daemon","startup-workers", "1")
+        if self.getfloat("Daemon","startup-timeout") < 0.0:
+            self.set("Daemon","startup-timeout", "0")
+        
+        #an interface's waiting messages are bounded, or not (0).
+        if self.getint("Daemon","source-queue") < 0:
+            self.set("Daemon","source-queue", "0")
+        
+        #the daemon can't take less than no time to shut down.
+        if self.getfloat("Daemon","shutdown-timeout") < 0.0:
+            self.set("Daemon","shutdown-timeout", "0")
+            
+        #the watchdog either just logs or restarts, and backs off doing it.
+        if self.get("Daemon","watchdog") not in ("log", "restart"):
+            self.set("Daemon","watchdog", "log")
+        if self.getfloat("Daemon","alert-timeout") < 0.0:
+            self.set("Daemon","alert-timeout", "0")
+        if self.getfloat("Daemon","watchdog-backoff") <= 0.0:
+            self.set("Daemon","watchdog-backoff", "1")
+        if self.getfloat("Daemon","watchdog-max-backoff") < self.getfloat("Daemon","watchdog-backoff"):
+            self.set("Daemon","watchdog-max-backoff", self.get("Daemon","watchdog-backoff"))
+        if self.getint("Daemon","watchdog-limit") < 1:
+            self.set("Daemon","watchdog-limit", "1")
+            
+        #only two runtimes to choose from.
+        if self.get("Daemon","runtime") not in ("threads", "asyncio"):
+            self.set("Daemon","runtime", "threads")
+            
+        #slow interfaces are either hung up on or miss out on messages.
+        if self.get("Daemon","slow-consumer") not in ("disconnect", "drop"):
+            self.set("Daemon","slow-consumer", "disconnect")
             
         #first check logging capabilities.
         if self.getboolean("Logging","logging-on"):              
@@ -105,6 +147,40 @@ class EmpConfigParser(ConfigParser):
             try: return TinyCfgPrsr(dict(self.items(attach_name)),savedir)
             except: return TinyCfgPrsr({},savedir)
         
+    def reread(self):
+        """ Reads the config files again into a new EmpConfigParser, checked
+        the same way this one was. This one isn't changed.
+        """
+        fresh = EmpConfigParser()
+        fresh.CONFIG_FILES = self.CONFIG_FILES
+        fresh.validateInternals()
+        return fresh
+        
+    def changes(self, other):
+        """ Returns a dictionary of section name to the list of options that
+        are different in the other config. A section only one of them has 
+        counts as all of its options changing.
+        """
+        changed = {}
+        for section in set(self.sections()) | set(other.sections()):
+            mine, theirs = self.__raw(section), other.__raw(section)
+            options = sorted(option for option in set(mine) | set(theirs)
+                             if mine.get(option) != theirs.get(option))
+            if options: changed[section] = options
+        return changed
+    
+    def copySection(self, section, other):
+        """ Replaces the section with the other config's copy of it. """
+        if self.has_section(section): self.remove_section(section)
+        if other.has_section(section):
+            self.add_section(section)
+            for option, value in other.__raw(section).items():
+                self.set(section, option, value)
+    
+    def __raw(self, section):
+        if not self.has_section(section): return {}
+        return dict(self.items(section, raw=True))
+        
     def getAttachmentDirs(self):
         """ Gets the directories that attachments can be found in."""
         #TODO: ?? allow to be changable via cfg file ??
@@ -114,6 +190,10 @@ class EmpConfigParser(ConfigParser):
         """ The registry file to be read in by the Registry object. """
         return self.get("Daemon","registry-file")
     
+    def getManifestFile(self):
+        """ The file the attachment manager remembers what it found in. """
+        return self.get("Daemon","manifest-file")
+    
     def defaultAttachmentVars(self, module, defaults, category):
         """Called by SmtgPluginManager and SmtgAlertManager to load the default
         configurations into the database for use later.
@@ -26,24 +26,56 @@ The Daemon assumes that the installation went correctly as directory
 settings and default subprocess/threading control is pulled from
 the configuration files.
 """
+import os
 import time
 import logging
-from socket import timeout
-from threading import Thread
+from threading import Thread, Event, Lock
 
 
 from empbase.comm.interface import Interface
 from empbase.registration.registry import Registry
 from empbase.event.eventmanager import EventManager, triggerEvent
+from empbase.event.ringbuffer import RingConsumer
 from empbase.attach.management import AttachmentManager
+from empbase.attach.updates import LoopUpdater
+from empbase.attach.workers import ProcessAttachment, stopWorkers
+from empbase.attach.watchdog import Watchdog
+from empbase.attach.lazy import LazyAttachment
 from empbase.config.logger import setup_logging
 from empbase.comm.command import Command, CommandList
 from empbase.config.empconfigparser import EmpConfigParser
 
 from empbase.daemon.RDaemon import RDaemon
-from empbase.daemon.daemonipc import DaemonServerSocket
+from empbase.daemon.daemon import DaemonError, PID_POLL
+from empbase.daemon.daemonipc import DaemonServerSocket, AF_UNIX
 from empbase.comm.routing import MessageRouter
+from empbase.comm.ioloop import IOLoop
 from empbase.comm.messages import makeCommandMsg
+from empbase.comm.codec import CODECS
+from empbase.daemon.aioruntime import AsyncRuntime, ASYNCIO_RUNTIME, runUpdate
+
+# The pull loop sleeps until the next LoopPlug is due (or an adaptive one is 
+# moved sooner, or the daemon is stopping), but looks for new plugs at least 
+# this often.
+PULL_LIVENESS = 5.0
+
+# How much longer than its shutdown-timeout stop() gives the daemon to exit,
+# for saving the config and registry once everything's drained.
+STOP_GRACE = 1.0
+
+# The Daemon options 'reload' can change while the daemon is running, the 
+# rest are only read when it starts.
+RELOADABLE = ("update-speed", "update-jitter", "update-adaptive", "update-backoff",
+              "update-timeout", "rate-limit", "rate-burst", "source-queue", "stream-buffer", 
+              "stream-credit", "output-buffer", "slow-consumer", "shutdown-timeout",
+              "boot-launch", "alert-timeout", "watchdog", "watchdog-backoff",
+              "watchdog-max-backoff", "watchdog-limit")
+
+# Even past the deadline, the daemon's loops get this long to see they should
+# exit, its all they need once nothing's left to drain.
+JOIN_GRACE = 0.1
+
+def _nothing(): pass
 
 def notimplemented(*args):
     raise Exception("This command has not be implemented yet, sorry!")
@@ -84,6 +116,22 @@ class EmpDaemon(RDaemon):
         self.registry = None #Registry object!!
         self.aman     = None #AttachmentManager
         self.router   = None #message router
+        self.ioloop   = None #watches all the interface sockets
+        self.updater  = None #runs the LoopPlugs' updates
+        self.watchdog = None #restarts the attachments that hang
+        self.ring     = None #events pushed in by local processes, if shared
+        self._ringtargets = {} #what's been pushed into the ring -> event ids
+        
+        # set as soon as the daemon starts shutting down, every loop waits on
+        # it (or is woken by one of the wakers) rather than sleeping. The 
+        # router and IOLoop keep going until closed is set, so whatever is 
+        # in flight can still be delivered.
+        self.stopping = Event()
+        self.closed   = Event()
+        self._wakers  = []
+        self._threads = [] #the daemon's loops, joined on shutdown
+        self._routing = None #the router's thread
+        self._reloading = Lock() #one reload at a time
 
         # now set up the internal configuration via a config file.
         self.config=EmpConfigParser(configfile)
@@ -95,6 +143,54 @@ class EmpDaemon(RDaemon):
                               pchannel=self.config.getint("Daemon", "port"),
                               dprog=dprg,
                               dargs=configfile)
+        
+        # local processes can push events to trigger into a shared ring
+        # buffer, it sits next to the pid-file like the unix socket.
+        self.RING_FILE = os.path.splitext(self.PID_FILE)[0]+".ring"
+         
+    def getRingPath(self):
+        """ Returns the path of the event ring (see empbase.event.ringbuffer),
+        or None if the daemon isn't running or isn't sharing one.
+        """
+        if self.isRunning() and os.path.exists(self.RING_FILE):
+            return self.RING_FILE
+        return None
+         
+    def isRunning(self):
+        """ In the daemon itself its pid file is watched for it, so this is 
+        just whether its started shutting down.
+        """
+        if self._lockfile is not None: return not self.stopping.is_set()
+        return RDaemon.isRunning(self)
+    
+    def shutdown(self):
+        """ Starts shutting the daemon down from the inside, and wakes up all
+        of its loops so they see it straight away.
+        """
+        if self.stopping.is_set(): return
+        logging.debug("daemon is shutting down")
+        self.stopping.set()
+        for waker in list(self._wakers):
+            try: waker()
+            except Exception as e: logging.exception(e)
+            
+    def addWaker(self, fn):
+        """ The function is called when the daemon starts shutting down. """
+        self._wakers.append(fn)
+        
+    def checkPid(self):
+        """ Starts shutting down if the pid file has been removed (which is 
+        how stop() tells the daemon to). Returns whether its still running.
+        """
+        if not RDaemon.isRunning(self): self.shutdown()
+        return not self.stopping.is_set()
+    
+    def __watchPid(self):
+        while not self.stopping.wait(PID_POLL): self.checkPid()
+        
+    def _deadline(self):
+        """ When a shutdown starting now has to be drained by. """
+        return time.monotonic() + self.config.getfloat("Daemon", "shutdown-timeout")
          
     def startup(self):
         """ Startup the daemon if there is a variable called boot-launch and 
@@ -105,20 +201,21 @@ class EmpDaemon(RDaemon):
          
          
     def stop(self):
-        """ Stops the daemon but then waits a while to make sure all the threads are done. """
-        try: 
-            RDaemon.stop(self)
-            time.sleep(3)#dont worry about the magic number
-        except: pass
+        """ Stops the daemon and waits for it to finish shutting down, which
+        is only as long as it takes to drain (up to its shutdown-timeout).
+        Returns whether it has exited.
+        """
+        try: RDaemon.stop(self)
+        except DaemonError: pass # it could still be on its way out.
+        if self.waitForExit(self.config.getfloat("Daemon", "shutdown-timeout")+STOP_GRACE):
+            return True
+        logging.warning("the daemon still hasn't exited, its holding %s" % self.LOCK_FILE)
+        return False
          
     def restart(self):
-        """ Restarts the daemon by killing both threads, and making sure their
-        both down before trying to run the daemon again.
-        """
-        try:
-            self.stop()
-            time.sleep(2)#dont worry about the magic number
-        except:pass
+        """ Restarts the daemon as soon as the old one has exited. """
+        if not self.stop():
+            raise DaemonError("The daemon didn't stop in time, so it wasn't restarted.")
         self.start()
 
     
@@ -134,6 +231,8 @@ class EmpDaemon(RDaemon):
                           Command("cvar",   trigger=self.__cmd_cvar, help="given a variable name and a value, it will change it to the given value."),
                           Command("trigger",trigger=self.__cmd_trigger, help="hand trigger an event given an id or event string"),
                           Command("status", trigger=self.__cmd_status, help="get the daemon status, or the status of a plugin/alert given the id."),
+                          Command("stats",  trigger=self.__cmd_stats, help="get the daemon's internal counters, like how busy the worker pools are."),
+                          Command("reload", trigger=self.__cmd_reload, help="re-reads the config file, and remakes only the attachments whose settings changed."),
                           Command("events", trigger=self.__cmd_events, help="get a list of all the events that a given plug has"),
                           Command("alerts", trigger=self.__cmd_alerts, help="get a list of all the alerts that a given alarm has"),
                           Command("plugs",  trigger=self.__cmd_plugs, help="get a list of plug-ins ids to names."),
@@ -152,7 +251,79 @@ class EmpDaemon(RDaemon):
 
 
     def __cmd_status(self, *args):
-        return "SMTG-D Running since: "+self.fm_start_time
+        if len(args) == 0: return "SMTG-D Running since: "+self.fm_start_time
+        id = self.registry.getAttachId(args[0])
+        for attach in self.aman.getAllPlugins():
+            if id is not None and attach.plugin_object.ID == id: break
+        else: raise Exception("Target name or id does not exist.")
+        status = {"id": id, "name": attach.name,
+                  "active": attach.plugin_object.is_activated}
+        # LoopPlugs also have their current interval and update times.
+        updates = self.updater.status(attach.name)
+        if updates is not None: status["updates"] = updates
+        if isinstance(attach.plugin_object, ProcessAttachment):
+            status["worker"] = attach.plugin_object.worker.process.pid
+        if isinstance(attach.plugin_object, LazyAttachment):
+            status["imported"] = False
+        watch = self.watchdog.status(attach.name)
+        if watch is not None: status["watchdog"] = watch
+        return status
+    
+    def __cmd_stats(self, *args):
+        return {"runtime": self.config.get("Daemon", "runtime"),
+                "router" : self.router.stats(),
+                "sockets": self.ioloop.size(),
+                "output" : self.ioloop.stats(),
+                "ring"   : self.ring.stats() if self.ring is not None else None,
+                "updates": self.updater.stats(),
+                "watchdog": self.watchdog.stats(),
+                "startup": self.aman.startupTimeline()}
+    
+    def __cmd_reload(self, *args):
+        """ Re-reads the config files and diffs them against the running
+        config. Only the attachments whose sections changed are remade, 
+        everything else (the event queue, timers, connections) carries on.
+        """
+        with self._reloading:
+            fresh = self.config.reread()
+            for attach in self.aman.getAllPlugins():
+                fresh.defaultAttachmentVars(attach.module, attach.defaults, attach.category)
+            
+            result = {"attachments": [], "applied": [], "restart": []}
+            for section, options in sorted(self.config.changes(fresh).items()):
+                if section == "Daemon":
+                    for option in options:
+                        if option in RELOADABLE:
+                            self.config.set(section, option, fresh.get(section, option))
+                            result["applied"].append(option)
+                        else: result["restart"].append("%s.%s" % (section, option))
+                    continue
+                
+                attach = self.aman.getAttachmentBySection(section)
+                if attach is None:
+                    result["restart"] += ["%s.%s" % (section, option) for option in options]
+                    continue
+                self.config.copySection(section, fresh)
+                try: self.aman.reloadAttachment(attach)
+                except Exception as e:
+                    logging.exception(e)
+                    raise Exception("Couldn't reload %s: %s" % (attach.name, e))
+                if attach in self.aman.getLoopPlugs(): self.updater.refresh(attach)
+                self.watchdog.forget(attach.name)
+                result["attachments"].append(attach.name)
+            
+            if result["applied"]:
+                self.updater.configure(timeout=self.config.getfloat("Daemon", "update-timeout"),
+                                       interval=self.config.getfloat("Daemon", "update-speed") * 60.0,
+                                       jitter=self.config.getfloat("Daemon", "update-jitter"),
+                                       adaptive=self.config.getboolean("Daemon", "update-adaptive"),
+                                       backoff=self.config.getfloat("Daemon", "update-backoff"))
+                self.router.setRateLimit(self.config.getfloat("Daemon", "rate-limit"),
+                                         self.config.getint("Daemon", "rate-burst"))
+                self.router.setSourceQueue(self.config.getint("Daemon", "source-queue"))
+                self.__configureWatchdog()
+            logging.debug("reloaded the config: %s" % result)
+            return result
     
     def __cmd_cmds(self, *args):
         cmdlst = CommandList(self.get_commands())
@@ -213,6 +384,10 @@ class EmpDaemon(RDaemon):
         if len(defaultsa) > 0 or len(defaultsb) > 0:
             raise Exception("One or both of your arguments are not valid subscription strings.")
         
+        # if either is an attachment that hasn't been imported yet, it is now.
+        for name in (namea, nameb):
+            if self.registry.getAttachId(name) is not None: self.aman.getAttachment(name)
+        
         #Find out what our first argument is:
         if suba is None and subb is None:
             ## we can pass our strings directly to subscribe, it'll figure it out.
@@ -272,27 +447,50 @@ class EmpDaemon(RDaemon):
     def __cmd_trigger(self, *args):
         if len(args) != 1:
             raise Exception("Trigger command needs an event string or an event's id.")
-        plug,event,others = parsesubs(args[0])
-        if len(others)>0: raise Exception("Invalid event string or id.")
         try:
-            if event is None: #could be either an id or just a plug name.
-                pid = self.registry.getAttachId(plug)
-                eids = self.registry.getPlugEventIds(pid)
-                if len(eids)==0:
-                    eid = self.registry.getEventId(plug)
-                    if eid is None: raise Exception()
-                    else: eids.append(eid)
-                for eid in eids: triggerEvent(eid)
-            else: #must be an event string
-                pid = self.registry.getAttachId(plug)
-                eid = self.registry.getPlugEventId(pid, event)
-                if eid is not None: triggerEvent(eid)
-                else: raise Exception("Could not find the given event to trigger!")
+            for eid in self.__findEvents(args[0]): triggerEvent(eid)
             return "Triggered!"
         except Exception as e: 
             logging.exception(e)
             raise e #explicit re-raise
         
+    def __findEvents(self, target):
+        """ Returns the ids of the events an event id, plug name or event 
+        string stands for.
+        """
+        plug,event,others = parsesubs(target)
+        if len(others)>0: raise Exception("Invalid event string or id.")
+        if event is None: #could be either an id or just a plug name.
+            pid = self.registry.getAttachId(plug)
+            eids = self.registry.getPlugEventIds(pid)
+            if len(eids)==0:
+                eid = self.registry.getEventId(plug)
+                if eid is None: raise Exception("Could not find the given event to trigger!")
+                else: eids.append(eid)
+            return eids
+        else: #must be an event string
+            pid = self.registry.getAttachId(plug)
+            eid = self.registry.getPlugEventId(pid, event)
+            if eid is not None: return [eid]
+            else: raise Exception("Could not find the given event to trigger!")
+    
+    def _inject(self, targets):
+        """ Triggers the events pushed into the event ring. They go straight
+        to the EventManager, what they stand for is only looked up once.
+        """
+        eman = self.aman.eman
+        for target in targets:
+            eids = self._ringtargets.get(target)
+            if eids is None or not all(eid in eman.eventmap for eid in eids):
+                try: eids = self._ringtargets[target] = self.__findEvents(target)
+                except Exception:
+                    logging.debug("nothing to trigger for %s in the event ring" % target)
+                    self.ring.unknown += 1
+                    continue
+            for eid in eids: 
+                eman.countTrigger(eid)
+                eman.triggerEvent(eid)
+        
     def __cmd_cvar(self, *args):    return notimplemented()        
     def __cmd_events(self, *args):  return notimplemented()
     def __cmd_alerts(self, *args):  return notimplemented()
@@ -345,110 +543,287 @@ class EmpDaemon(RDaemon):
                 
             - Thread 3: this is _t2(), it handles incoming communication to the
                 port that the SmtgDaemon listens to for Interfaces. See the
-                interface API for more information on how to talk to the 
-                daemon. 
+                interface API for more information on how to talk to the
+                daemon. It runs the IOLoop, so every connected interface is
+                read and written from this one thread.
+
+            If the Daemon's 'runtime' is set to asyncio, all three of these
+        are coroutines on a single loop instead. See aioruntime.py.
+        
+            The daemon holds its lock file the whole time, so stop() can tell
+        when its gone.
         """
+        try: self._lock()
+        except DaemonError as e:
+            logging.error("daemon didn't start: %s" % e.message)
+            return
         try:
-            # Load the registry from last time if it exists
-            self.registry = Registry(self.config.getRegistryFile())
-            self.ID       = self.registry.daemonId() 
-            
-            # load the attachment manager now and search for the user's 
-            # attachments. It will only load them if they pass inspection.
-            self.aman = AttachmentManager( self.config, 
-                                           self.registry,
-                                           EventManager(self.config, 
-                                                        self.registry, 
-                                                        self.isRunning))
-            self.aman.collectPlugins()
-            
-            # Set up the router using the loaded registry
-            self.router   = MessageRouter(self.registry, 
-                                          self, self.aman)
+            if self.config.get("Daemon", "runtime") == ASYNCIO_RUNTIME:
+                # everything but the attachments runs as coroutines on one loop.
+                AsyncRuntime(self).run()
+            else: self.__runThreads()
+        finally: self._unlock()
             
-            #activates the attachments based on user cfg file. 
-            # if the attachment was a SignalPlugin, it will throw the plug's
-            # run() function into a new thread.
-            self.aman.activateAttachments()
+    def __runThreads(self):
+        """ The threads runtime, see _run(). """
+        try:
+            self._setup()
+            self.aman.eman.pause = self.stopping.wait
     
             # starts the comm router running to send messages!!
-            Thread(target=self.router.startRouter,
-                   kwargs={"triggermethod":self.isRunning}).start()
+            self._routing = self.__thread(self.router.startRouter,
+                                          triggermethod=self.__open)
             
             # start the interface server thread
-            Thread(target=self.__t2).start()
+            self.__thread(self.__t2)
+            
+            # and the thread that reads the event ring.
+            if self.ring is not None:
+                self.__thread(self.ring.watch, self._inject, trigger=self.isRunning)
+                
+            # removing the pid file is how the daemon is told to stop.
+            self.__thread(self.__watchPid)
+            
+            # and the one that restarts the attachments that hang.
+            self.__thread(self.watchdog.watch, trigger=self.isRunning, 
+                          pause=self.stopping.wait)
     
             # start the pull loop.
             logging.debug("pull-loop thread started")
+            wakeup = Event()
+            self.updater.wake = wakeup.set
+            self.addWaker(wakeup.set)
             while self.isRunning():
                 
                 # get all active loop plug-ins
-                activePlugins = self.aman.getLoopPlugs()
-                if activePlugins:
-                    for plugin in activePlugins:
-                        if plugin.plugin_object.is_activated:
-                            # for each active feed run the update function with no
-                            # arguments. The only time arguments are needed 
-                            # is if the plug-in was force updated by a command.
-                            logging.debug("pulling LoopPlugin: %s" % plugin.name)
-                            try: plugin.plugin_object.update()
-                            except Exception as e:
-                                logging.error("%s failed to update: %s" % (plugin.name, e))    
+                activePlugins = [plugin for plugin in self.aman.getLoopPlugs()
+                                 if plugin.plugin_object.is_activated]
+                self.updater.schedule.sync(activePlugins)
+                for plugin in self.updater.schedule.due():
+                    # for each feed that's due start the update function with
+                    # no arguments, they run side by side on the updater's 
+                    # pool. The only time arguments are needed is if the 
+                    # plug-in was force updated by a command.
+                    logging.debug("pulling LoopPlugin: %s" % plugin.name)
+                    self.updater.update(plugin)
+                self.updater.check(activePlugins)
                 
-                try: # sleep, and every five seconds check if still alive
-                    count=0
-                    sleep_time = self.config.getfloat("Daemon","update-speed") * 60.0
-                    while(count<sleep_time):
-                        count+=5
-                        time.sleep(5)#every 5 seconds check state
-                        if not self.isRunning(): break;
+                # sleep until the next plug is due, but wake up every so 
+                # often to check if still alive.
+                try: 
+                    wakeup.wait(self.updater.sleepTime(activePlugins, PULL_LIVENESS))
+                    wakeup.clear()
                 except: pass
                 
-            #Stop all signal threads
-            for signal in self.aman.getSignalPlugs():
-                signal.plugin_object.deactivate()    
-            
-            #flush the router, and save all configurations.
-            self.router.flush()
-            self.config.save( self.aman.getAllPlugins() )
-            self.registry.save()
+            self._teardown()
             logging.debug("pull-loop thread is dead")
 
         except Exception as e:
             logging.error("Pull-loop thread was killed by: %s" % str(e))
             logging.exception(e)
+            self.shutdown()
+            self.closed.set()
+            if self.router is not None: self.router.stop()
+            if self.ioloop is not None: self.ioloop.call(_nothing)
+            
+    def __thread(self, fn, *args, **kwargs):
+        """ Starts one of the daemon's loops, its joined on shutdown. """
+        thread = Thread(target=fn, args=args, kwargs=kwargs)
+        thread.start()
+        self._threads.append(thread)
+        return thread
+    
+    def __open(self):
+        """ The router and IOLoop keep going until the daemon's closed. """
+        return not self.closed.is_set()
+        
+    def _setup(self, threaded=True, msgqueue=None, ioloop=None):
+        """ Loads the registry and attachments and makes the router, this is 
+        the same no matter which runtime is being used. The asyncio runtime
+        hands in its own message queue and IOLoop.
+        """
+        # Load the registry from last time if it exists
+        self.registry = Registry(self.config.getRegistryFile())
+        self.ID       = self.registry.daemonId() 
+        
+        # load the attachment manager now and search for the user's 
+        # attachments. It will only load them if they pass inspection.
+        self.aman = AttachmentManager( self.config, 
+                                       self.registry,
+                                       EventManager(self.config, 
+                                                    self.registry, 
+                                                    self.isRunning,
+                                                    threaded=threaded))
+        self.aman.collectPlugins()
+        
+        # share the event ring if its wanted.
+        size = self.config.getint("Daemon", "event-ring")
+        if size > 0:
+            try: self.ring = RingConsumer(self.RING_FILE, size)
+            except Exception as e:
+                logging.error("couldn't share the event ring %s: %s" % (self.RING_FILE, e))
+        
+        # Set up the router using the loaded registry
+        self.router   = MessageRouter(self.registry, 
+                                      self, self.aman,
+                                      cmdworkers=self.config.getint("Daemon", "command-workers"),
+                                      attachworkers=self.config.getint("Daemon", "attachment-workers"),
+                                      deliveryworkers=self.config.getint("Daemon", "delivery-workers"),
+                                      msgqueue=msgqueue,
+                                      ratelimit=self.config.getfloat("Daemon", "rate-limit"),
+                                      rateburst=self.config.getint("Daemon", "rate-burst"),
+                                      sourcequeue=self.config.getint("Daemon", "source-queue"))
+        
+        # the LoopPlugs are updated side by side, each with a timeout.
+        self.updater = LoopUpdater(workers=self.config.getint("Daemon", "update-workers"),
+                                   timeout=self.config.getfloat("Daemon", "update-timeout"),
+                                   run=runUpdate,
+                                   interval=self.config.getfloat("Daemon", "update-speed") * 60.0,
+                                   jitter=self.config.getfloat("Daemon", "update-jitter"),
+                                   adaptive=self.config.getboolean("Daemon", "update-adaptive"),
+                                   backoff=self.config.getfloat("Daemon", "update-backoff"),
+                                   triggers=self.__triggerCount)
+        
+        # the watchdog is told about the updates that go over their timeout,
+        # and times the alerts itself.
+        self.watchdog = Watchdog(self.aman, restart=self.__restart, stop=self.__stopAttachment)
+        self.__configureWatchdog()
+        self.updater.stuck = self.__stuck
+        self.aman.eman.runAlert = self.watchdog.runAlert
+        
+        # the loop is made before the attachments are activated, since 
+        # some (like the TimerPlug) have sockets for it to watch.
+        self.ioloop = ioloop if ioloop is not None else IOLoop()
+        
+        #activates the attachments based on user cfg file. 
+        # if the attachment was a SignalPlugin, it will throw the plug's
+        # run() function into a new thread.
+        self.aman.activateAttachments()
+        
+    def _teardown(self, deadline=None):
+        """ Stops the signal plugs, drains and flushes the router and saves 
+        everything. Running updates and queued messages are waited on until 
+        the deadline (by default shutdown-timeout from now), anything left
+        after that is dropped.
+        """
+        if deadline is None: deadline = self._deadline()
+        
+        #Stop all signal threads
+        for signal in self.aman.getSignalPlugs():
+            signal.plugin_object.deactivate()    
+        
+        #let the updates that are running finish, if they're quick about it.
+        late = self.updater.drain(max(deadline-time.monotonic(), 0.0))
+        if late: logging.warning("shutting down while still updating: %s" % ", ".join(late))
+        self.updater.shutdown()
+        
+        #route what's been queued, then flush the router.
+        self.router.stop()
+        if self._routing is not None: self.__join(self._routing, deadline)
+        self.router.flush()
+        
+        #and save all configurations.
+        self.config.save( self.aman.getAllPlugins() )
+        self.registry.save()
+        if self.ring is not None: self.ring.close()
+        stopWorkers(max(deadline-time.monotonic(), JOIN_GRACE))
+        
+        #the IOLoop has sent everything it can, so let the rest of the loops go.
+        self.closed.set()
+        self.ioloop.call(_nothing)
+        for thread in self._threads: self.__join(thread, deadline)
         
+    def __join(self, thread, deadline):
+        thread.join(max(deadline-time.monotonic(), JOIN_GRACE))
+        if thread.is_alive(): logging.warning("shutting down without waiting for %s" % thread.name)
+    
+    def __configureWatchdog(self):
+        self.watchdog.configure(policy=self.config.get("Daemon", "watchdog"),
+                                alerttimeout=self.config.getfloat("Daemon", "alert-timeout"),
+                                backoff=self.config.getfloat("Daemon", "watchdog-backoff"),
+                                maxbackoff=self.config.getfloat("Daemon", "watchdog-max-backoff"),
+                                limit=self.config.getint("Daemon", "watchdog-limit"))
+    
+    def __stuck(self, plugin, timeout):
+        """ Given to the LoopUpdater, for when an update goes over its timeout."""
+        self.watchdog.hung(plugin.name, "update", timeout)
+    
+    def __restart(self, attach):
+        """ Given to the Watchdog, starts a hung attachment over. Its worker
+        process is killed and its made again. One in the daemon's process 
+        can't be, its stuck thread can't be stopped.
+        """
+        with self._reloading:
+            if not self.isRunning(): return
+            old = attach.plugin_object
+            if not isinstance(old, ProcessAttachment):
+                raise Exception("%s runs in the daemon, it can't be restarted." % attach.name)
+            active = old.is_activated or old.wasactive
+            old.killWorker()
+            self.aman.reloadAttachment(attach, activate=active)
+            if attach in self.aman.getLoopPlugs(): self.updater.refresh(attach)
+    
+    def __stopAttachment(self, attach):
+        """ Given to the Watchdog, for an attachment its given up on. """
+        with self._reloading:
+            old = attach.plugin_object
+            if isinstance(old, ProcessAttachment): old.killWorker()
+            elif old.is_activated: old.deactivate()
+    
+    def __triggerCount(self, plugin):
+        """ Given to the LoopUpdater, how many events the plug has triggered."""
+        return self.aman.eman.triggerCount(plugin.plugin_object.ID)
+    
+    def __accept(self, client_socket):
+        """ Called by the IOLoop for each new interface connection. """
+        logging.debug("incoming message from interface.")
+        
+        # create an interface out of the socket
+        # LATER: authentication can go here, before they connect. (eg logging in)
+        interface = Interface(self.router, client_socket,
+                              streambuffer=self.config.getint("Daemon", "stream-buffer"),
+                              streamcredit=self.config.getint("Daemon", "stream-credit"),
+                              outputlimit=self.config.getint("Daemon", "output-buffer"),
+                              slowpolicy=self.config.get("Daemon", "slow-consumer"))
+        self.registry.registerInterface(interface) #gives the interface its ID
+        self.router.addInterface(interface)
+        interface.start(self.ioloop)
+    
+        # The arguments are the codecs the interface can switch to.
+        self.router.sendMsg(makeCommandMsg("proceed", self.ID, dest=interface.ID, args=CODECS))
+            
+    def _listen(self):
+        """ Creates the interface server sockets and has the IOLoop watch 
+        them for new interfaces. Returns the list of them.
+        """
+        # Create socket and bind to address
+        whitelist = self.config.getlist("Daemon", "whitelisted-ips")
+        isockets = [DaemonServerSocket(port=self.getComPort(),
+                                       ip_whitelist=whitelist,
+                                       externalBlock=self.config.getboolean("Daemon","local-only"),
+                                       allowAll=self.config.getboolean("Daemon", "allow-all"))]
+        
+        # local interfaces skip the TCP stack and the port lookup.
+        if AF_UNIX is not None:
+            try: isockets.append(DaemonServerSocket(path=self.SOCK_FILE))
+            except Exception as e:
+                logging.error("couldn't listen on %s: %s" % (self.SOCK_FILE, e))
             
+        for isocket in isockets:
+            self.ioloop.addListener(isocket, self.__accept)
+        return isockets
+        
     def __t2(self):
         """ Interface Server method, this runs in a new thread when the 
         daemon starts. See _run() method for more information.
         """
         
         logging.debug("communication-thread started")
-        # Create socket and bind to address
-        whitelist = self.config.getlist("Daemon", "whitelisted-ips")
-        isocket = DaemonServerSocket(port=self.getComPort(),
-                                     ip_whitelist=whitelist,
-                                     externalBlock=self.config.getboolean("Daemon","local-only"),
-                                     allowAll=self.config.getboolean("Daemon", "allow-all"))
-        
-        while self.isRunning(): # keep listening forever
-            try:
-                client_socket = isocket.accept()
-                logging.debug("incoming message from interface.")
-        
-                # create an interface out of the socket
-                # LATER: authentication can go here, before they connect. (eg logging in)
-                interface = Interface(self.router, client_socket)
-                self.registry.registerInterface(interface) #gives the interface its ID
-                self.router.addInterface(interface)
-            
-                # since there are abilities that this person can perform throw
-                # to new thread by way of the interface class
-                self.router.sendMsg(makeCommandMsg("proceed", self.ID, dest=interface.ID))
-                Thread(target=interface.receiver).start()
-            except timeout:pass #catches a timeout and allows for daemon status checking
-            except Exception as e: logging.exception(e)
-        isocket.close()
+        isockets = self._listen()
+        
+        # every interface is watched from this one thread, until everything 
+        # queued for them has been sent.
+        self.ioloop.run(triggermethod=self.__open)
+        for isocket in isockets: isocket.close()
         logging.debug("communication-thread is dead")
 
@@ -0,0 +1,378 @@
+"""
+Copyright (c) 2010-2011 Alexander Dean (dstar@csh.rit.edu)
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import time
+import queue
+import asyncio
+import logging
+import selectors
+from threading import Thread, Lock, get_ident
+
+from empbase.comm.ioloop import IOLoop, Connection
+from empbase.comm.pools import WorkerPool
+from empbase.comm.scheduling import FairScheduler, NOTHING
+from empbase.comm.routing import _SHUTDOWN
+from empbase.event.ringbuffer import MIN_POLL, MAX_POLL
+from empbase.attach.watchdog import WATCH_INTERVAL
+from empbase.daemon.daemon import PID_POLL
+
+#
+# The asyncio runtime is an alternative to the daemon's threads. The router,
+# event dispatch, interface server and timers all run as coroutines on one
+# event loop. Attachments don't know about any of this, their code is free to
+# block, so it's run on a pool of worker threads. It's picked with the
+# Daemon's 'runtime' config option.
+#
+ASYNCIO_RUNTIME = "asyncio"
+
+# The longest the pull loop sleeps, its woken up sooner if a LoopPlug is due
+# (or an adaptive one was moved sooner) or an update might go past its timeout.
+UPDATE_CHECK = 5.0
+
+
+def runCoroutine(fn, *args):
+    """ Starts an 'async def' function. If the daemon is using the asyncio
+    runtime it's run on its loop, otherwise it gets a thread and a loop of
+    its own.
+    """
+    global _theRuntime_
+    if _theRuntime_ is not None and _theRuntime_.loop is not None:
+        _theRuntime_.call(_theRuntime_.loop.create_task, fn(*args))
+    else:
+        Thread(target=asyncio.run, args=(fn(*args),)).start()
+
+def runUpdate(plug, *args):
+    """ Runs a LoopPlug's update from a thread, whether or not its a
+    coroutine.
+    """
+    if asyncio.iscoroutinefunction(plug.update):
+        return asyncio.run(plug.update(*args))
+    return plug.update(*args)
+
+# The runtime the functions above use, if there is one.
+_theRuntime_ = None
+
+
+class LoopPlugAdapter():
+    """ Lets a LoopPlug be awaited. Plugs written with 'async def update' are
+    run right on the loop, the rest are run on the pool since they may block.
+    """
+    def __init__(self, plug, pool):
+        self.plug = plug
+        self.pool = pool
+
+    async def update(self, *args):
+        if asyncio.iscoroutinefunction(self.plug.update):
+            return await self.plug.update(*args)
+        future = self.pool.submit(self.plug.update, *args)
+        if future is not None:
+            return await asyncio.wrap_future(future)
+
+
+class AsyncQueue():
+    """ The router's message queue. Any thread can put() on it like on a
+    FairQueue, but only the router coroutine gets from it. Items go straight
+    into the scheduler, the loop is only woken up if the router is waiting,
+    so a flood of messages doesn't become a flood of loop callbacks.
+    """
+    def __init__(self, runtime):
+        self._runtime = runtime
+        self._sched = FairScheduler()
+        self._lock = Lock()
+        self._ready = asyncio.Event()
+        self._sleeping = False # the router is waiting on _ready.
+
+    def put(self, item, key=None, ready=0.0, limit=0):
+        with self._lock:
+            if not self._sched.push(key, item, ready, limit): return False
+            if not self._sleeping: return True
+            self._sleeping = False
+        self._runtime.call(self._ready.set)
+        return True
+
+    def get_nowait(self):
+        with self._lock: item, _ = self._sched.pop()
+        if item is NOTHING: raise queue.Empty
+        return item
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def qsize(self):
+        with self._lock: return len(self._sched)
+
+    def depths(self):
+        with self._lock: return self._sched.depths()
+
+    async def get(self):
+        while True:
+            with self._lock:
+                item, wait = self._sched.pop()
+                if item is not NOTHING: return item
+                self._sleeping = True
+                self._ready.clear()
+            try: await asyncio.wait_for(self._ready.wait(), wait)
+            except asyncio.TimeoutError: pass # a rate limited one is ready.
+
+
+class AsyncIOLoop(IOLoop):
+    """ The IOLoop on top of an asyncio event loop, so the interfaces and the
+    plugs' sockets are watched along with everything else. Connections work
+    the same as on the selector loop.
+    """
+    def __init__(self, loop):
+        self._aio = loop
+        IOLoop.__init__(self)
+
+    def _setup(self):
+        self._watched = {} # fd -> socket or Connection
+
+    def addListener(self, sock, onaccept):
+        sock.setblocking(False)
+        self.call(self.__watch, sock, lambda: self._accept(sock, onaccept))
+
+    def addConnection(self, sock, onframe=None, onclose=None, msgtypes=None,
+                      encoding="utf-8"):
+        conn = Connection(self, sock, onframe, onclose, msgtypes, encoding)
+        self.call(self.__watch, conn, conn._onreadable)
+        return conn
+
+    def __watch(self, fileobj, onreadable):
+        fd = fileobj.fileno()
+        self._watched[fd] = fileobj
+        self._aio.add_reader(fd, onreadable)
+
+    def modify(self, fileobj, events):
+        try: fd = fileobj.fileno()
+        except AttributeError: return # its been closed.
+        if fd not in self._watched: return
+        if events & selectors.EVENT_WRITE: self._aio.add_writer(fd, fileobj._onwritable)
+        else: self._aio.remove_writer(fd)
+
+    def remove(self, fileobj):
+        if not self.inLoop():
+            self.call(self.remove, fileobj)
+            return
+        try: fd = fileobj.fileno()
+        except AttributeError: return
+        if self._watched.pop(fd, None) is not None:
+            self._aio.remove_reader(fd)
+            self._aio.remove_writer(fd)
+
+    def call(self, fn, *args):
+        if self.inLoop(): fn(*args)
+        else: self._aio.call_soon_threadsafe(fn, *args)
+
+    def size(self):
+        return len(self._watched)
+
+    def run(self, triggermethod=lambda:False):
+        raise NotImplementedError("the AsyncRuntime runs this loop.")
+
+    def start(self):
+        """ Called from the loop's thread once its running. """
+        self._thread = get_ident()
+        self._running = True
+
+    def close(self):
+        """ Closes every connection and stops watching everything. """
+        for fileobj in list(self._watched.values()):
+            if isinstance(fileobj, Connection): fileobj._close()
+            else: self.remove(fileobj)
+        self._running = False
+
+
+class AsyncRuntime():
+    """ Runs an EmpDaemon on a single asyncio event loop rather than its
+    threads. The daemon is set up the same way, the runtime just gives it an
+    IOLoop and message queue that are part of its loop, and takes over the
+    pull loop and the EventManager's watcher threads.
+    """
+    def __init__(self, daemon):
+        global _theRuntime_
+        _theRuntime_ = self
+        self.daemon = daemon
+        self.loop = None
+        self._thread = None
+        self._wakeup = None
+        self._updates = set() # the LoopPlug updates that are running.
+        self._pool = WorkerPool("attachments",
+                                daemon.config.getint("Daemon", "attachment-workers"))
+
+    def call(self, fn, *args):
+        """ Runs the function on the loop's thread, safe from any thread. """
+        if self._thread == get_ident(): fn(*args)
+        else:
+            try: self.loop.call_soon_threadsafe(fn, *args)
+            except RuntimeError: # the loop's closed, we're shutting down.
+                logging.debug("runtime has stopped, dropped a call.")
+
+    def spawn(self, fn, *args):
+        """ Given to the EventManager to run alerts on the pool. """
+        self._pool.submit(fn, *args)
+
+    def wake(self):
+        """ Given to the EventManager to wake dispatch when an event triggers."""
+        self.call(self._wakeup.set)
+
+    def run(self):
+        """ Runs the daemon until its pid file goes away. """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try: self.loop.run_until_complete(self.main())
+        except Exception as e:
+            logging.error("asyncio runtime was killed by: %s" % str(e))
+            logging.exception(e)
+            self.daemon.shutdown()
+            if self.daemon.router is not None: self.daemon.router.stop()
+        finally:
+            self.loop.close()
+            self._pool.shutdown()
+
+    async def main(self):
+        d = self.daemon
+        self._thread = get_ident()
+        self._wakeup = asyncio.Event()
+        ioloop = AsyncIOLoop(self.loop)
+        ioloop.start()
+
+        d._setup(threaded=False, msgqueue=AsyncQueue(self), ioloop=ioloop)
+        d.aman.eman.spawn = self.spawn
+        d.aman.eman.onTrigger = self.wake
+        isockets = d._listen()
+
+        # the daemon wakes us as soon as its shutting down.
+        stopping = asyncio.Event()
+        d.addWaker(lambda: self.call(stopping.set))
+
+        logging.debug("asyncio runtime started")
+        routing = self.loop.create_task(self.route())
+        pulling = self.loop.create_task(self.pull())
+        tasks = [routing, pulling] + [self.loop.create_task(coro) for coro in
+                 (self.dispatch(), self.halflifes(), self.inject(), self.watch())]
+        try:
+            while d.checkPid():
+                try: await asyncio.wait_for(stopping.wait(), PID_POLL)
+                except asyncio.TimeoutError: pass
+        finally:
+            d.shutdown()
+            # give the running updates and queued messages until the 
+            # deadline to finish, then cancel whatever's left.
+            deadline = d._deadline()
+            pulling.cancel()
+            if self._updates:
+                await asyncio.wait(list(self._updates), timeout=max(deadline-time.monotonic(), 0.0))
+            d.router.stop()
+            await asyncio.wait([routing], timeout=max(deadline-time.monotonic(), 0.0))
+            tasks += list(self._updates)
+            for task in tasks: task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for isocket in isockets:
+                ioloop.remove(isocket)
+                isocket.close()
+            d._teardown(deadline)
+            ioloop.close()
+            logging.debug("asyncio runtime is dead")
+
+    async def route(self):
+        """ Takes the place of MessageRouter.startRouter(). """
+        router, q = self.daemon.router, self.daemon.router._msg_queue
+        while True:
+            msg = await q.get()
+            if msg is _SHUTDOWN:
+                router.routeQueued()
+                break
+            try: router.route(msg)
+            except Exception as e: logging.exception(e)
+
+    async def dispatch(self):
+        """ Takes the place of EventManager.watchQueue(), but rather than
+        polling it sleeps until an event is triggered.
+        """
+        eman = self.daemon.aman.eman
+        while True:
+            self._wakeup.clear()
+            try:
+                while eman.processEvent(): pass
+            except Exception as e: logging.exception(e)
+            await self._wakeup.wait()
+
+    async def halflifes(self):
+        """ Takes the place of EventManager.watchList(). """
+        eman = self.daemon.aman.eman
+        while True:
+            try: eman.decayHalflifes()
+            except Exception as e: logging.exception(e)
+            await asyncio.sleep(1.0)
+
+    async def inject(self):
+        """ Takes the place of RingConsumer.watch(), if the daemon is sharing
+        an event ring.
+        """
+        d, wait = self.daemon, MIN_POLL
+        if d.ring is None: return
+        while True:
+            try: 
+                targets = d.ring.drain()
+                if targets: d._inject(targets)
+            except Exception as e: 
+                logging.exception(e)
+                targets = None
+            if targets: 
+                wait = MIN_POLL
+                await asyncio.sleep(0) # let everything else have a turn.
+            else:
+                await asyncio.sleep(wait)
+                wait = min(wait*2, MAX_POLL)
+
+    async def watch(self):
+        """ Takes the place of Watchdog.watch(), the restarts it starts still
+        get threads of their own.
+        """
+        while True:
+            try: self.daemon.watchdog.check()
+            except Exception as e: logging.exception(e)
+            await asyncio.sleep(WATCH_INTERVAL)
+
+    async def pull(self):
+        """ The pull loop, each active LoopPlug's update is started when its
+        schedule says its due (unless its last one is still running), and 
+        they all run side by side. The daemon's LoopUpdater keeps track of 
+        them.
+        """
+        d, wakeup = self.daemon, asyncio.Event()
+        d.updater.wake = lambda: self.call(wakeup.set)
+        while True:
+            wakeup.clear()
+            plugins = [plugin for plugin in d.aman.getLoopPlugs()
+                       if plugin.plugin_object.is_activated]
+            d.updater.schedule.sync(plugins)
+            for plugin in d.updater.schedule.due():
+                if d.updater.begin(plugin):
+                    logging.debug("pulling LoopPlugin: %s" % plugin.name)
+                    task = self.loop.create_task(self.update(plugin))
+                    self._updates.add(task)
+                    task.add_done_callback(self._updates.discard)
+            d.updater.check(plugins)
+            try: await asyncio.wait_for(wakeup.wait(), d.updater.sleepTime(plugins, UPDATE_CHECK))
+            except asyncio.TimeoutError: pass
+    
+    async def update(self, plugin):
+        """ Updates a single LoopPlug, and tells the updater when its done. """
+        failed = False
+        try: await LoopPlugAdapter(plugin.plugin_object, self._pool).update()
+        except Exception as e:
+            failed = True
+            logging.error("%s failed to update: %s" % (plugin.name, e))
+        finally: self.daemon.updater.finish(plugin, failed)
@@ -27,8 +27,17 @@ __version__ = "0.5"
 
 import os
 import sys
+import time
 import subprocess
 
+try: import fcntl
+except ImportError: fcntl = None # the lock file's existence is all we have.
+
+# How often a running daemon checks that its pid file is still there, and 
+# how often stop() checks if the daemon has exited yet.
+PID_POLL = 0.05
+EXIT_POLL = 0.01
+
 
 class DaemonError(Exception):
     """A Daemon Error is an issue caused from within the daemon and can
@@ -70,6 +79,15 @@ class Daemon():
                  daemonizingCommand=None):
         self.PID_FILE = pidfile # the pid-file name and path
         self.PCHANNEL = pchannel
+        
+        # local interfaces can connect on a unix socket, it sits next to the
+        # pid-file so they can find it without asking for the port.
+        self.SOCK_FILE = os.path.splitext(pidfile)[0]+".sock"
+        
+        # the running daemon holds a lock on this file until it exits, so 
+        # stop() can tell when its actually gone.
+        self.LOCK_FILE = os.path.splitext(pidfile)[0]+".lock"
+        self._lockfile = None
 
         if dargs is not None: self.args = dargs
         else: self.args = ""
@@ -117,6 +135,52 @@ class Daemon():
         pid = subprocess.Popen(self.daemonizingCommand, shell=True).pid
         open(self.PID_FILE, "w+").write(str(self.PCHANNEL)+"\n"+str(pid))
     
+    def hasExited(self):
+        """Checks that no daemon is holding the lock file, ie. that the last
+        one to run has finished shutting down (or died).
+        """
+        if not os.path.exists(self.LOCK_FILE): return True
+        if fcntl is None: return False
+        try: 
+            with open(self.LOCK_FILE, "r") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX|fcntl.LOCK_NB)
+                return True # closing it lets go again.
+        except FileNotFoundError: return True
+        except OSError: return False
+        
+    def waitForExit(self, timeout=None):
+        """Waits until the daemon has exited, or for timeout seconds. Returns
+        whether it has.
+        """
+        deadline = None if timeout is None else time.monotonic()+timeout
+        while not self.hasExited():
+            if deadline is not None and time.monotonic() >= deadline: return False
+            time.sleep(EXIT_POLL)
+        return True
+    
+    def _lock(self):
+        """Called by the daemon process as it starts up, it holds the lock 
+        file until _unlock() is called or the process dies.
+        """
+        self._lockfile = open(self.LOCK_FILE, "a+")
+        if fcntl is not None:
+            try: fcntl.flock(self._lockfile.fileno(), fcntl.LOCK_EX|fcntl.LOCK_NB)
+            except OSError:
+                self._lockfile.close()
+                self._lockfile = None
+                raise DaemonError("Another daemon is still running!")
+        self._lockfile.truncate(0)
+        self._lockfile.write(str(os.getpid()))
+        self._lockfile.flush()
+        
+    def _unlock(self):
+        """Called by the daemon process once its done shutting down. """
+        if self._lockfile is None: return
+        try: os.remove(self.LOCK_FILE)
+        except OSError: pass
+        self._lockfile.close() # lets anyone waiting on it know.
+        self._lockfile = None
+    
     def getComPort(self):
         """Returns the port to send interface commands to the daemon. See
         daemonipc for more information about inter-process communication.
@@ -127,6 +191,15 @@ class Daemon():
         else:
             return None
  
+    def getComPath(self):
+        """Returns the path of the unix socket to send interface commands to
+        the daemon, or None if it isn't running or isn't listening on one.
+        """
+        if self.isRunning() and os.path.exists(self.SOCK_FILE):
+            return self.SOCK_FILE
+        else:
+            return None
+            
     def _run(self):
         """ Write this yourself """
         raise NotImplementedError("Run functionality is default. Please override.")
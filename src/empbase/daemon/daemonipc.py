@@ -15,13 +15,21 @@ limitations under the License.
 
 #
 # The Daemon Socket classes are used to connect to a running daemon 
-# server with a TCP socket. Everything is non-specialized for SNTG.
+# server with a TCP socket, or a unix socket for local processes where the
+# platform has them. Everything is non-specialized for SNTG.
 # So have some fun with daemons in your own projects.
 #
 __version__ = "0.7"
 
+import os
+import time
+import logging
+import itertools
 from socket import timeout # Imported so others don't have to. 
-from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR
+from socket import socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR, SOMAXCONN
+try: from socket import AF_UNIX
+except ImportError: AF_UNIX = None # not on this platform, TCP only.
+from empbase.comm.codec import FrameBuffer, JSON_CODEC
 
 class DaemonSocketError(Exception):
     """A Daemon Socket Error is an issue caused from issues within the 
@@ -50,21 +58,33 @@ class DaemonServerSocket():
 
     def __init__(self, port=8080, bufferSize=4096, encoding="utf-8", 
                  altsocket=None, ip_whitelist=[], externalBlock=True, 
-                 allowAll=False):
+                 allowAll=False, path=None):
         """ Sets up an internal socket on the server side and auto binds to 
-        the given port number.
+        the given port number. If a path is given it binds a unix socket
+        there instead, only local processes can connect to those so the 
+        white-list doesn't apply.
         """
         self.BUFFER_SIZE = bufferSize
         self.PORT_NUM = port
+        self.PATH = path
         self.ENCODING = encoding
         self.WHITE_LIST = ip_whitelist
         self.LOCAL_ONLY = externalBlock
         self.ALLOW_ALL = allowAll
-        if altsocket == None:
+        if altsocket == None and path is not None:
+            if AF_UNIX is None:
+                raise DaemonSocketError("Unix sockets aren't supported here.")
+            if os.path.exists(path): os.remove(path) # left over from a crash.
+            self.socket = socket(AF_UNIX, SOCK_STREAM)
+            self.socket.bind(path)
+            os.chmod(path, 0o600) # only the user running the daemon.
+            self.socket.listen(SOMAXCONN)
+            self.socket.settimeout(2)
+        elif altsocket == None:
             self.socket = socket(AF_INET,SOCK_STREAM)
             self.socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
             self.socket.bind(("localhost",self.PORT_NUM))
-            self.socket.listen(3) # standard, change if you want.
+            self.socket.listen(SOMAXCONN) # lets a burst of interfaces queue up.
             self.socket.settimeout(2) #timeout in 3 seconds...
         else: 
             self.socket = altsocket
@@ -75,10 +95,14 @@ class DaemonServerSocket():
     def send(self, msg):
         """Sends a string as a byte sequence to a DaemonClientSocket at the
         other end. This acts as a socket.sendall(msg), so there is no worries
-        about network buffers or the accidental buffer-overflow.
+        about network buffers or the accidental buffer-overflow. If the 
+        message is already bytes (eg. an encoded Message) its sent as is.
         """
         try:
-            self.socket.sendall(str(msg).encode(self.ENCODING))
+            if isinstance(msg, (bytes, bytearray)):
+                self.socket.sendall(msg)
+            else:
+                self.socket.sendall(str(msg).encode(self.ENCODING))
         except AttributeError:
             raise TypeError("Parameter given is not a string.")
         except:
@@ -98,6 +122,14 @@ class DaemonServerSocket():
         except:pass
         finally:
             return msg.decode(self.ENCODING)
+        
+    def recvraw(self):
+        """Receives whatever bytes are waiting on the socket, up to the buffer
+        size, without decoding them. An empty bytes object means the other 
+        end has closed the connection. Use this with a FrameBuffer when the
+        other side may be sending binary frames or several messages at once.
+        """
+        return self.socket.recv(self.BUFFER_SIZE)
     
     def rebind(self, newPortNum):
         """Rebinds the DaemonServerSocket to a new port number. """
@@ -106,9 +138,13 @@ class DaemonServerSocket():
     
     def close(self):
         """Closes a current connection, does not un-bind the DaemonServerSocket.
-        If a connection is closed, there is not getting it back.
+        If a connection is closed, there is not getting it back. A unix 
+        socket's file is removed.
         """
         self.socket.close()
+        if self.PATH is not None:
+            try: os.remove(self.PATH)
+            except OSError: pass
 
    
     def accept(self):
@@ -123,7 +159,13 @@ class DaemonServerSocket():
             possible_addrs += self.WHITE_LIST
         
         while True:
-            client_socket, (addr, p) = self.socket.accept()
+            client_socket, addr = self.socket.accept()
+            if self.PATH is not None: # unix sockets are always local.
+                return DaemonServerSocket(port=None,
+                                          bufferSize=self.BUFFER_SIZE,
+                                          encoding=self.ENCODING,
+                                          altsocket=client_socket)
+            addr, p = addr[:2]
             
             if self.ALLOW_ALL or addr in possible_addrs:
                 return DaemonServerSocket(port=p, 
@@ -131,7 +173,7 @@ class DaemonServerSocket():
                                           encoding=self.ENCODING,
                                           altsocket=client_socket)
             # otherwise close
-            self.socket.close()
+            client_socket.close()
             
     def shutdown(self):
         self.socket.shutdown(SHUT_RDWR)
@@ -142,16 +184,25 @@ class DaemonClientSocket():
     special here except that it regulates the encoding and decoding of the 
     sent/recv messages for you.
     """
-    def __init__(self, port=8080, bufferSize=1024, encoding="utf-8"):
+    def __init__(self, port=8080, bufferSize=1024, encoding="utf-8", 
+                 msgtypes=None, path=None):
         """ This is the socket for the Client connection. Make sure the server
         socket has the same port number and encoding that the client has.
+        The message types are only needed if recvframe() will be used, they
+        are what the binary codec packs into its headers. If a path is given
+        it connects to the daemon's unix socket rather than the port.
         """
         self.BUFFER_SIZE = bufferSize
         self.PORT_NUM = port
+        self.PATH = path
         self.ENCODING = encoding
+        self.CODEC = JSON_CODEC
         self.RECV_LIMIT = 5 #DO NOT CHANGE!!
-        self.socket = socket(AF_INET,SOCK_STREAM)
+        if path is not None: self.socket = socket(AF_UNIX, SOCK_STREAM)
+        else: self.socket = socket(AF_INET,SOCK_STREAM)
         self.socket.settimeout(0.5)#intentionally very low. DO NOT CHANGE!!
+        self._frames = []
+        self._framebuf = FrameBuffer(msgtypes or [], encoding)
         
     def __getattr__(self, name):    
         return getattr(self.socket, name)
@@ -159,21 +210,39 @@ class DaemonClientSocket():
     def connect(self):
         """Connects to a currently running daemon on the local system. Make sure
         the daemon is utilizing a DaemonServerSocket and is the same encoding that
-        you are using.
+        you are using. If the daemon's unix socket can't be connected to (eg.
+        its file was removed, or it belongs to a daemon that died) the port is
+        tried instead.
         """
+        if self.PATH is not None:
+            try: 
+                self.socket.connect(self.PATH)
+                return
+            except OSError as e:
+                logging.debug("couldn't connect to %s, using port %s: %s"%(self.PATH, self.PORT_NUM, e))
+                timeout = self.socket.gettimeout()
+                self.socket.close()
+                self.PATH = None
+                self.socket = socket(AF_INET,SOCK_STREAM)
+                self.socket.settimeout(timeout)
         self.socket.connect(("localhost",self.PORT_NUM))
         
     def send(self,msg):
         """Sends a string as a byte sequence to a DaemonServerSocekt at the 
         other end. This essentially acts as a socket.sendall(msg), but if the 
-        message is larger than the buffer-size it will throw an error. 
+        message is larger than the buffer-size it will throw an error. Objects
+        that know how to encode themselves (like Messages) are sent in the 
+        codec that was set on this socket.
         """
-        msg = str(msg)
-        if len(msg) > self.BUFFER_SIZE:
+        if isinstance(msg, (bytes, bytearray)): data = msg
+        elif not isinstance(msg, str) and hasattr(msg, "encode"):
+            data = msg.encode(self.CODEC, self.ENCODING)
+        else: data = str(msg).encode(self.ENCODING)
+        if len(data) > self.BUFFER_SIZE:
             raise DaemonSocketError("Message given is larger than buffer size!")
         
         try:
-            self.socket.sendall(msg.encode(self.ENCODING))
+            self.socket.sendall(data)
             
         except AttributeError:
             raise TypeError("Parameter given is not a string.")
@@ -214,8 +283,92 @@ class DaemonClientSocket():
                     continue
                 else:break
             return msg
+        
+    def recvframe(self, blockout=5.0):
+        """Receives exactly one message from the daemon, in whichever codec it
+        was sent, and returns it decoded as a dictionary. Unlike recv() this 
+        returns as soon as the message is complete rather than waiting for the
+        socket to time out. Returns None if nothing came in before the 
+        blockout (in seconds) or the daemon hung up.
+        """
+        deadline = time.time()+blockout
+        while not self._frames:
+            try: data = self.socket.recv(self.BUFFER_SIZE)
+            except timeout:
+                if time.time() < deadline: continue
+                return None
+            if not data: return None
+            self._frames.extend(self._framebuf.feed(data))
+        return self._frames.pop(0)
     
     def close(self):
         """Closes the current connection with the Daemon."""
         self.socket.close()
                 
+
+
+class DaemonPipeline():
+    """Sends many requests down a single DaemonClientSocket without waiting
+    for each reply. Every request is given an id, which the daemon puts in 
+    its reply, so replies can be matched up in whatever order they come back.
+    Requests have to be Messages (see empbase.comm.messages).
+    """
+    def __init__(self, sock, window=64):
+        """ The window is the most requests that are left waiting on their 
+        replies at once, run() won't send more until some come back.
+        """
+        self.socket = sock
+        self.WINDOW = window
+        self._ids = itertools.count(1)
+        self._waiting = set() # ids sent that haven't been answered.
+        self._replies = {}    # replies that came in before they were asked for.
+        
+    def send(self, msg):
+        """Gives the request an id, sends it, and returns the id. """
+        id = next(self._ids)
+        msg["id"] = id
+        self.socket.send(msg)
+        self._waiting.add(id)
+        return id
+    
+    def pending(self):
+        """Returns the number of requests still waiting on a reply. """
+        return len(self._waiting)
+        
+    def recv(self, id=None, blockout=5.0):
+        """Returns the reply to the request with the given id, or to any 
+        request if no id is given, as an (id, reply) tuple. Replies to other 
+        requests that come in first are kept until they're asked for. Anything
+        that isn't a reply to one of our requests (like alerts) is dropped. 
+        Returns None if the reply doesn't come before the blockout. 
+        """
+        if id is None and self._replies: return self._replies.popitem()
+        if id in self._replies: return id, self._replies.pop(id)
+        
+        deadline = time.time()+blockout
+        while True:
+            reply = self.socket.recvframe(max(deadline-time.time(), 0))
+            if reply is None: return None
+            rid = reply.get("id")
+            if rid not in self._waiting: continue
+            self._waiting.discard(rid)
+            if id is None or rid == id: return rid, reply
+            self._replies[rid] = reply
+            
+    def run(self, msgs, blockout=5.0):
+        """Sends all of the requests, keeping no more than the window waiting
+        at a time, and returns their replies in the same order. A reply is 
+        None if it didn't come back before the blockout.
+        """
+        ids, replies = [], {}
+        for msg in msgs:
+            while self.pending() >= self.WINDOW:
+                got = self.recv(blockout=blockout)
+                if got is None: return [replies.get(id) for id in ids]
+                replies[got[0]] = got[1]
+            ids.append(self.send(msg))
+        while self.pending() > 0:
+            got = self.recv(blockout=blockout)
+            if got is None: break
+            replies[got[0]] = got[1]
+        return [replies.get(id) for id in ids]
@@ -13,7 +13,6 @@ See the License for the specific language governing permissions and
 limitations under the License. 
 """
 import time
-import queue
 import random
 import logging
 from threading import Thread
@@ -27,6 +26,7 @@ def triggerEvent(eid):
     """
     global _theEManager_
     if _theEManager_ is not None:
+        _theEManager_.countTrigger(eid) # before the update that did it finishes.
         Thread(target=_theEManager_.triggerEvent, args=[eid,]).start()
     else: # or eid == UNKNOWN
         logging.warning("Event(%s) was triggered before EM was initialized." % eid)
@@ -87,8 +87,31 @@ def deregisterAlert(alert):
         logging.warning("Alert tried to be deregistered before EM was initialized." )
      
 
+
+def addStream(stream):
+    """ Starts sending the triggered events that pass the stream's filter to
+    it. See empbase.event.streams for how the streams work. Throws an 
+    exception if what the stream is watching doesn't exist.
+    """
+    global _theEManager_
+    if _theEManager_ is not None:
+        _theEManager_.addStream(stream)
+    else: raise Exception("There are no events to watch yet.")
+
+def removeStream(stream):
+    """ Stops sending events to the stream. """
+    global _theEManager_
+    if _theEManager_ is not None:
+        _theEManager_.removeStream(stream)
         
         
+def _spawnThread(fn, *args):
+    """ Runs the function in a thread of its own. """
+    Thread(target=fn, args=args).start()
+
+def _runAlert(alert, eventobj):
+    alert.run(eventobj)
+        
 """ The event manager is a singleton, this is it."""
 _theEManager_ = None
 MIN_SLEEP = 0.0
@@ -97,7 +120,11 @@ MAX_SLEEP = 0.05  #will need testing, might need to be lower to seem instant!
 class EventManager():
     """ """
     
-    def __init__(self, config, registry, trigger):
+    def __init__(self, config, registry, trigger, threaded=True):
+        """ If threaded is False the watcher threads aren't started, whoever
+        made the manager has to call processEvent() and decayHalflifes() 
+        itself (see the asyncio runtime).
+        """
         global _theEManager_
         _theEManager_ = self
         self.eventqueue = []
@@ -110,7 +137,19 @@ class EventManager():
         self.eventmap = {} #eid -> ref
         self.alertmap = {} #lid -> ref
         self.halflifes= {} #eid -> int
-        if self.trigger():
+        self.streams  = [] #the interfaces' EventStreams
+        self.fired    = {} #pid -> how many times its events were triggered
+        
+        # how the alerts get run, and who gets told an event was triggered.
+        # The defaults are for the threaded daemon.
+        self.spawn = _spawnThread
+        self.onTrigger = None
+        # how an alert is run, the daemon's watchdog swaps in one that times it.
+        self.runAlert = _runAlert
+        # how the watcher threads sleep, the daemon swaps in one that returns
+        # as soon as its shutting down.
+        self.pause = time.sleep
+        if threaded and self.trigger():
             Thread(target=self.watchList).start()
             Thread(target=self.watchQueue).start()
     
@@ -156,10 +195,31 @@ class EventManager():
                 return True
         return False
     
+    def addStream(self, stream):
+        stream.resolve(self.registry)
+        self.streams = self.streams + [stream] # swapped, so its safe to loop over.
+        
+    def removeStream(self, stream):
+        self.streams = [s for s in self.streams if s is not stream]
+    
+    def countTrigger(self, eid):
+        """ Counts the trigger against the event's plug, see triggerCount()."""
+        event = self.eventmap.get(eid)
+        if event is None: return
+        pid = event._getPID()
+        self.fired[pid] = self.fired.get(pid, 0) + 1
+    
+    def triggerCount(self, pid):
+        """ How many times the plug's events have been triggered. The 
+        LoopUpdater uses it to tell if a plug's update found anything.
+        """
+        return self.fired.get(pid, 0)
+    
     def triggerEvent(self, eid):
         self.eventqueue.append(eid)
         self.history.triggered(eid)
         logging.debug("Event(%s) triggered!"%eid)
+        if self.onTrigger is not None: self.onTrigger()
         
     def detriggerEvent(self, eid):
         """To de-trigger we need to remove it from both the list
@@ -179,13 +239,42 @@ class EventManager():
         """
         logging.debug("running subscribers") #XXX: remove me
         for lid in lids:
-            try: Thread(target=self.alertmap[lid].run, args=(eventobj,)).start()
+            try: self.spawn(self.runAlert, self.alertmap[lid], eventobj)
             except Exception as e: 
                 logging.exception(e)
                 logging.debug("Alerts: %s"%str(self.alertmap))
         logging.debug("running subscribers dead") #XXX: remove me
     
     
+    def processEvent(self):
+        """ Takes one event off the queue and runs all of its subscribers. 
+        Returns False if there wasn't anything to do.
+        """
+        if len(self.eventqueue) == 0: return False
+        
+        id = self.eventqueue.pop()
+        lids = list(self.registry.subscribedTo(id))
+        self.spawn(self.runsubscribers, self.eventmap[id], lids)
+        for stream in self.streams:
+            try:
+                if stream.matches(self.eventmap[id], lids, self.registry): 
+                    stream.push(self.eventmap[id])
+            except Exception as e: logging.exception(e)
+        if self.eventmap[id].halflife > 0: 
+            self.triggered.append(self.eventmap[id])
+            self.halflifes[id] = self.eventmap[id].halflife
+        return True
+    
+    def decayHalflifes(self):
+        """ Takes a second off of the halflife of every triggered event, and
+        de-triggers the ones that have run out. Call once a second.
+        """
+        for k,v in list(self.halflifes.items()):
+            if v-1 > 0: self.halflifes[k] = v-1
+            else: 
+                self.halflifes.pop(k)
+                detriggerEvent( k )
+    
     def watchQueue(self):
         """ Watches the queue and if there is an event in there, runs all of 
         the subscribers as quickly as possible.
@@ -193,22 +282,11 @@ class EventManager():
         logging.debug("EventQueue watcher thread started")
         while self.trigger():
             try:
-                if len(self.eventqueue) == 0: raise queue.Empty
-                
-                id = self.eventqueue.pop()
-                Thread(target=self.runsubscribers, 
-                       args=(self.eventmap[id],
-                             self.registry.subscribedTo(id),)).start()
-                if self.eventmap[id].halflife > 0: 
-                    self.triggered.append(self.eventmap[id])
-                    self.halflifes[id] = self.eventmap[id].halflife 
-                
-            except queue.Empty: pass
+                if self.processEvent(): continue
             except Exception as e: logging.exception(e)
-                        
-            if len(self.eventqueue) != 0: continue
+            
             # sleep for a very small amount
-            try: time.sleep(random.uniform(MIN_SLEEP, MAX_SLEEP))
+            try: self.pause(random.uniform(MIN_SLEEP, MAX_SLEEP))
             except: pass
         logging.debug("EventQueue watcher thread dead")    
     
@@ -217,13 +295,7 @@ class EventManager():
         logging.debug("Event list watcher thread started")
         while self.trigger():
             t = time.time()
-            for k,v in self.halflifes.items():
-                if v-1 > 0: self.halflifes[k] = v-1
-                else: 
-                    self.halflifes.pop(k)
-                    detriggerEvent( k )
-            try: time.sleep(1.0-(time.time()-t))
+            self.decayHalflifes()
+            try: self.pause(1.0-(time.time()-t))
             except:pass #took too long, TODO: what should we do in this case?
         logging.debug("Event list watcher thread dead")
-    
-    
\ No newline at end of file
@@ -0,0 +1,256 @@
+"""
+Copyright (c) 2010-2011 Alexander Dean (dstar@csh.rit.edu)
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import mmap
+import time
+import struct
+import logging
+from threading import Lock
+
+try: import fcntl
+except ImportError: fcntl = None # no way to stop two producers sharing it.
+
+#
+# Triggering an event from outside the daemon means connecting and sending a
+# 'trigger' command, a round trip through the router for every event. For a
+# local process that has a lot of them, the daemon can instead share a ring
+# buffer with it in a memory mapped file. The process writes the events it
+# wants triggered into the ring and the daemon reads them out, so pushing an
+# event is just a copy into memory.
+#
+# There's one writer (the producer) and one reader (the daemon). The header
+# has two counters, head is how many bytes have ever been written and tail is
+# how many have been read. Each side only ever changes its own, and head is
+# moved only after the record is in place, so neither side needs a lock.
+#
+# The file looks like this, everything little-endian:
+#
+#     0  magic 'EMPRING1'
+#     8  version, capacity (uint32 each)
+#    16  head, tail, dropped, closed (uint64 each)
+#    64  the ring, capacity bytes of records
+#
+# A record is its length (uint32) followed by that many bytes, the utf-8 name
+# of what to trigger. Like the trigger command it can be an event's id, a
+# plug's name (all of its events) or 'plug.event'. Records wrap around the
+# end of the ring.
+#
+
+MAGIC = b"EMPRING1"
+VERSION = 1
+HEADER = struct.Struct("<8sII")
+HEADER_SIZE = 64
+RECORD = struct.Struct("<I")
+
+# The counters' positions in the header, counting in uint64s.
+_HEAD, _TAIL, _DROPPED, _CLOSED = 2, 3, 4, 5
+
+# How long the daemon sleeps when the ring is empty. It starts short and
+# backs off while nothing is coming in.
+MIN_POLL = 0.001
+MAX_POLL = 0.05
+
+
+def connectRing(path):
+    """ Opens the daemon's ring for writing. Returns a RingProducer, or None
+    if the daemon isn't sharing one at the path.
+    """
+    if path is None or not os.path.exists(path): return None
+    try: return RingProducer(path)
+    except OSError: return None
+
+
+class _Ring():
+    """ The memory map and the header's counters, shared by both ends. """
+    def __init__(self, path, fileno):
+        self.PATH = path
+        self._map = mmap.mmap(fileno, 0)
+        magic, version, self.capacity = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise Exception("%s isn't an event ring." % path)
+        # single indexed loads and stores, so the other side never sees
+        # half of a counter.
+        self._mem = memoryview(self._map)
+        self._words = self._mem[:HEADER_SIZE].cast("Q")
+        self._data = self._mem[HEADER_SIZE:HEADER_SIZE+self.capacity]
+
+    def _read(self, pos, size):
+        pos %= self.capacity
+        end = pos+size
+        if end <= self.capacity: return bytes(self._data[pos:end])
+        return bytes(self._data[pos:]) + bytes(self._data[:end-self.capacity])
+
+    def _write(self, pos, data):
+        pos %= self.capacity
+        split = min(len(data), self.capacity-pos)
+        self._data[pos:pos+split] = data[:split]
+        if split < len(data): self._data[:len(data)-split] = data[split:]
+
+    def used(self):
+        return self._words[_HEAD] - self._words[_TAIL]
+
+    def close(self):
+        if self._map is None: return
+        self._words.release()
+        self._data.release()
+        self._mem.release()
+        self._map.close()
+        self._map = None
+
+
+class RingProducer(_Ring):
+    """ The writing end, for the process that wants events triggered. Only
+    one can be open on a ring at a time.
+    """
+    def __init__(self, path):
+        self._file = open(path, "r+b")
+        if fcntl is not None:
+            try: fcntl.flock(self._file.fileno(), fcntl.LOCK_EX|fcntl.LOCK_NB)
+            except OSError:
+                self._file.close()
+                raise Exception("Another process is already writing to %s." % path)
+        try: _Ring.__init__(self, path, self._file.fileno())
+        except Exception:
+            self._file.close()
+            raise
+
+    def isOpen(self):
+        """ Checks that the daemon is still reading the ring. Once it stops a
+        new one has to be connected to.
+        """
+        return self._map is not None and not self._words[_CLOSED]
+
+    def push(self, target):
+        """ Writes one event to trigger into the ring. Returns False if it
+        didn't fit (the daemon is behind) or the daemon has closed the ring.
+        """
+        return self.pushMany([target]) == 1
+
+    def pushMany(self, targets):
+        """ Writes as many of the targets as will fit, and returns how many
+        that was. The daemon sees them all at once.
+        """
+        if not self.isOpen(): return 0
+        head = self._words[_HEAD]
+        free = self.capacity - (head - self._words[_TAIL])
+        count = 0
+        for target in targets:
+            data = target.encode("utf-8")
+            size = RECORD.size+len(data)
+            if size > free:
+                self._words[_DROPPED] += len(targets)-count
+                break
+            self._write(head, RECORD.pack(len(data)))
+            self._write(head+RECORD.size, data)
+            head += size
+            free -= size
+            count += 1
+        self._words[_HEAD] = head # publishes them.
+        return count
+
+    def close(self):
+        _Ring.close(self)
+        self._file.close()
+
+
+class RingConsumer(_Ring):
+    """ The daemon's end. It makes the ring file and removes it when its
+    closed.
+    """
+    def __init__(self, path, capacity):
+        if os.path.exists(path): os.unlink(path) # left from a dead daemon.
+        fd = os.open(path, os.O_RDWR|os.O_CREAT|os.O_EXCL, 0o600)
+        try:
+            os.ftruncate(fd, HEADER_SIZE+int(capacity))
+            os.write(fd, HEADER.pack(MAGIC, VERSION, int(capacity)))
+            _Ring.__init__(self, path, fd)
+        finally: os.close(fd)
+        self._lock = Lock() # so it can't be closed halfway through a drain.
+        self.received = 0
+        self.unknown = 0
+        self.corrupt = 0 # times the ring was thrown out because of a bad record.
+
+    def drain(self, limit=None):
+        """ Reads everything that's been pushed so far (or up to limit of
+        them), and returns their targets. The ring is written by another
+        process, so if a record doesn't make sense (its longer than what's
+        been written, or than the ring) everything left in the ring is thrown
+        out rather than read as records from the wrong place.
+        """
+        with self._lock:
+            if self._map is None: return []
+            tail, head = self._words[_TAIL], self._words[_HEAD]
+            targets = []
+            if not 0 <= head-tail <= self.capacity:
+                tail = self.__reset(tail, head, "its counters are %d bytes apart"%(head-tail))
+            while tail < head and (limit is None or len(targets) < limit):
+                if head-tail < RECORD.size:
+                    tail = self.__reset(tail, head, "there's half a record in it")
+                    break
+                size, = RECORD.unpack(self._read(tail, RECORD.size))
+                if size > self.capacity or RECORD.size+size > head-tail:
+                    tail = self.__reset(tail, head, "a record says its %d bytes"%size)
+                    break
+                targets.append(self._read(tail+RECORD.size, size).decode("utf-8", "replace"))
+                tail += RECORD.size+size
+            self._words[_TAIL] = tail # frees the space for the producer.
+            self.received += len(targets)
+            return targets
+
+    def __reset(self, tail, head, why):
+        """ Skips past everything that's been written, returns the new tail. """
+        logging.error("The event ring %s is corrupt, %s. Dropping the %d bytes in it."%(self.PATH, why, head-tail))
+        self.corrupt += 1
+        return head
+
+    def watch(self, handler, trigger=lambda:False):
+        """ Hands everything pushed into the ring to the handler, until the
+        trigger method returns False.
+        """
+        logging.debug("event ring watcher started: %s" % self.PATH)
+        wait = MIN_POLL
+        while trigger() and self._map is not None:
+            try: targets = self.drain()
+            except Exception as e:
+                logging.exception(e)
+                targets = []
+            if targets:
+                wait = MIN_POLL
+                try: handler(targets)
+                except Exception as e: logging.exception(e)
+                continue
+            time.sleep(wait)
+            wait = min(wait*2, MAX_POLL)
+        logging.debug("event ring watcher dead")
+
+    def stats(self):
+        """ How full the ring is and how many events came through it. """
+        with self._lock:
+            stats = {"capacity": self.capacity, "received": self.received,
+                     "unknown" : self.unknown, "corrupt": self.corrupt}
+            if self._map is not None:
+                stats["used"] = self.used()
+                stats["dropped"] = self._words[_DROPPED]
+            return stats
+
+    def close(self):
+        """ Tells the producer its closed and removes the file. """
+        with self._lock:
+            if self._map is None: return
+            self._words[_CLOSED] = 1
+            _Ring.close(self)
+        try: os.unlink(self.PATH)
+        except OSError: pass
@@ -0,0 +1,123 @@
+"""
+Copyright (c) 2010-2011 Alexander Dean (dstar@csh.rit.edu)
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from threading import Lock
+from collections import deque
+from empbase.comm.messages import makeAlertMsg
+
+#
+# Streams let an interface watch events as they're triggered, rather than
+# only seeing the alerts that happen to be sent its way. Each one has a
+# filter, a bounded buffer and some credit. An event is only sent while
+# there's credit left, the rest wait in the buffer until the interface asks
+# for more, and if the buffer fills up the oldest are dropped and counted.
+# So a slow interface only ever loses its own events, nothing waits on it.
+#
+
+# What a stream can watch: everything, a plug's events, a single event, or
+# the events that set off any of an alarm's alerts.
+WATCH_ALL   = "all"
+WATCH_PLUG  = "plug"
+WATCH_EVENT = "event"
+WATCH_ALARM = "alarm"
+WATCH_KINDS = [WATCH_ALL, WATCH_PLUG, WATCH_EVENT, WATCH_ALARM]
+
+DEFAULT_BUFFER = 100 # events held while there's no credit.
+DEFAULT_CREDIT = 10  # events sent before the interface has to ask for more.
+
+
+class EventStream():
+    """ A filtered stream of triggered events for a single interface. The
+    send function is given an AlertMsg for each event, with the stream's id
+    in its "stream" field so an interface can tell its streams apart.
+    """
+    def __init__(self, id, dest, kind, target, send,
+                 buffersize=DEFAULT_BUFFER, credit=DEFAULT_CREDIT):
+        """ The target is the plug, event or alarm id (or name) being watched,
+        it's resolved to an id when the stream is added to the EventManager.
+        """
+        if kind not in WATCH_KINDS:
+            raise Exception("Can only watch one of: %s" % ", ".join(WATCH_KINDS))
+        if kind != WATCH_ALL and target is None:
+            raise Exception("Need to know which %s to watch." % kind)
+        self.ID = id
+        self.dest = dest
+        self.kind = kind
+        self.target = target
+        self._send = send
+        self._lock = Lock()
+        self._buffer = deque(maxlen=max(int(buffersize), 1))
+        self.credit  = max(int(credit), 0)
+        self.sent    = 0
+        self.dropped = 0
+
+    def resolve(self, registry):
+        """ Turns the target into an id. Events can be given by id or as
+        'plug.event'. Throws an exception if it can't be found.
+        """
+        if self.kind == WATCH_ALL: return
+        if self.kind == WATCH_EVENT:
+            id = registry.getEventId(self.target)
+            if id is None and "." in self.target:
+                plug, name = self.target.split(".", 1)
+                id = registry.getPlugEventId(registry.getAttachId(plug), name)
+        else: id = registry.getAttachId(self.target)
+        if id is None: raise Exception("There is no %s called %s." % (self.kind, self.target))
+        self.target = id
+
+    def matches(self, event, lids, registry):
+        """ Checks if a triggered event passes the stream's filter. The lids
+        are the alerts subscribed to it.
+        """
+        if self.kind == WATCH_ALL: return True
+        elif self.kind == WATCH_PLUG: return event._getPID() == self.target
+        elif self.kind == WATCH_EVENT: return event.ID == self.target
+        else:
+            for lid in lids:
+                if registry.getAlertParent(lid) == self.target: return True
+            return False
+
+    def push(self, event):
+        """ Sends the event if there's credit, otherwise its buffered. """
+        msg = makeAlertMsg(event.msg, event._getPID(), dest=self.dest,
+                           title=event.name, args=[event.ID])
+        msg["stream"] = self.ID
+        # sending only puts it on the router's queue, so its done under the
+        # lock to keep the events in order.
+        with self._lock:
+            if self.credit > 0 and not self._buffer:
+                self.credit -= 1
+                self.sent += 1
+                self._send(msg)
+            else:
+                if len(self._buffer) == self._buffer.maxlen: self.dropped += 1
+                self._buffer.append(msg)
+
+    def addCredit(self, count):
+        """ Lets the stream send count more events, anything waiting in the
+        buffer goes out first. Returns the credit left over.
+        """
+        with self._lock:
+            self.credit += max(int(count), 0)
+            while self.credit > 0 and self._buffer:
+                self._send(self._buffer.popleft())
+                self.credit -= 1
+                self.sent += 1
+            return self.credit
+
+    def stats(self):
+        """ What the stream is watching and how far behind it is. """
+        return {"kind":self.kind, "target":self.target, "credit":self.credit,
+                "buffered":len(self._buffer), "buffer":self._buffer.maxlen,
+                "sent":self.sent, "dropped":self.dropped}
@@ -16,6 +16,7 @@ import os
 import time
 import random
 import logging
+from threading import RLock
 from string import ascii_lowercase, digits
 import xml.etree.ElementTree as ET
 from empbase.registration.regobj import RegAttach, RegEvent, RegAlert, \
@@ -84,6 +85,8 @@ class Registry():
         self._events      = {}
         self._alerts      = {}
         self._subscriptions = {}
+        self._lock = RLock() # held while subscriptions or targets change.
+        self._listeners = [] # called whenever a target comes, goes or is renamed.
         self._did = self.__genNewAttachId()
         self.load()
         logging.debug("loaded... theres %d attachments"%int(len(self._attachments)))
@@ -262,30 +265,31 @@ class Registry():
         slow and should only be done if we have no idea what types of ids they are,
         otherwise lets use a specific subscribe method below.
         """
-        try:
-            type,alid,epid = self.__validSubscription(alertAlarmID, eventPlugID)
-            if type is not SubscriptionType.Unknown:
-                sub = RegSubscription(self.__getNewSubscriptionId())
+        with self._lock:
+            try:
+                type,alid,epid = self.__validSubscription(alertAlarmID, eventPlugID)
+                if type is not SubscriptionType.Unknown:
+                    sub = RegSubscription(self.__getNewSubscriptionId())
     
-                if type is SubscriptionType.PlugAlarm:
-                    sub.setPlugAlarmSub(epid, alid)
-                elif type is SubscriptionType.EventAlarm:
-                    sub.setEventAlarmSub(epid, alid)
-                    sub.eparent = self.getEventParent(epid)
-                elif type is SubscriptionType.PlugAlert:
-                    sub.setPlugAlertSub(epid, alid)
-                    sub.lparent = self.getAlertParent(alid)
-                elif type is SubscriptionType.EventAlert:
-                    sub.setEventAlertSub(epid, alid)
-                    sub.eparent = self.getEventParent(epid)
-                    sub.lparent = self.getAlertParent(alid)
+                    if type is SubscriptionType.PlugAlarm:
+                        sub.setPlugAlarmSub(epid, alid)
+                    elif type is SubscriptionType.EventAlarm:
+                        sub.setEventAlarmSub(epid, alid)
+                        sub.eparent = self.getEventParent(epid)
+                    elif type is SubscriptionType.PlugAlert:
+                        sub.setPlugAlertSub(epid, alid)
+                        sub.lparent = self.getAlertParent(alid)
+                    elif type is SubscriptionType.EventAlert:
+                        sub.setEventAlertSub(epid, alid)
+                        sub.eparent = self.getEventParent(epid)
+                        sub.lparent = self.getAlertParent(alid)
                 
-                self._subscriptions[sub.ID] = sub 
-                return True
-            else: return False    
-        except Exception as e:
-            logging.exception(e)
-            raise e
+                    self._subscriptions[sub.ID] = sub 
+                    return True
+                else: return False    
+            except Exception as e:
+                logging.exception(e)
+                raise e
 
     def subscribeEventAlert(self, eid, lid): pass #TODO: write subscription for e-l
     def subscribeEventAlarm(self, eid, aid): pass #TODO: write subscription for e-a
@@ -312,13 +316,14 @@ class Registry():
 
     def unsubscribe(self, first, second): 
         """ Remove a specified event id from a given alert id. """
-        for sub in self._subscriptions.values():
-            if sub == (first, second):
-                self._subscriptions.pop(sub.ID)
-                return True
-            elif sub.contains(first) and sub.hasParent( second ):
-                self._subscriptions.pop(sub.ID)
-                return True
+        with self._lock:
+            for sub in self._subscriptions.values():
+                if sub == (first, second):
+                    self._subscriptions.pop(sub.ID)
+                    return True
+                elif sub.contains(first) and sub.hasParent( second ):
+                    self._subscriptions.pop(sub.ID)
+                    return True
             
         return False
     
@@ -371,15 +376,17 @@ class Registry():
     
     def __register(self, cmd, module, ref, type):
         """ Base registration method, returns the registry ID, """
-        newid = self.__genNewAttachId()
-        if cmd is not None or module is not None:
-            for id in self._attachments.keys():
-                if module == self._attachments[id].module:
-                    newid = id
-                    break
-        self._attachments[newid] = RegAttach( cmd, module, newid, type )
-        ref.ID = newid
-        return newid   
+        with self._lock:
+            newid = self.__genNewAttachId()
+            if cmd is not None or module is not None:
+                for id in self._attachments.keys():
+                    if module == self._attachments[id].module:
+                        newid = id
+                        break
+            self._attachments[newid] = RegAttach( cmd, module, newid, type )
+            ref.ID = newid
+            self.__changed()
+            return newid   
     
     def registerInterface(self, ref):
         """ Registers an interface temporarly with the registry. """
@@ -415,10 +422,12 @@ class Registry():
         
     def deregister(self, cid):
         """ Deregisters a Plug/Alarm/Interface given an id or cmd. """
-        id = self.__getIDFromCID(cid)
-        if id is not None:
-            try:    self._attachments.pop(id)
-            except: return False
+        with self._lock:
+            id = self.__getIDFromCID(cid)
+            if id is not None:
+                try:    self._attachments.pop(id)
+                except: return False
+                self.__changed()
         return True
  
     def isRegistered(self, cid):
@@ -470,18 +479,79 @@ class Registry():
         """ Resets the attachment's target name, the first parameter can be 
         the target's ID or its previous command string.
         """
-        id = self.__getIDFromCID(cid)
-        if id is not None:
-            self._attachments[id].cmd = newcmd
-            return True
-        else:
-            return False
+        with self._lock:
+            id = self.__getIDFromCID(cid)
+            if id is not None:
+                self._attachments[id].cmd = newcmd
+                self.__changed()
+                return True
+            else:
+                return False
+
+    def locked(self):
+        """ Returns the registry's lock. While its held nobody else can change
+        the subscriptions or target names, so a snapshot taken under it can be
+        restored without losing anyone else's changes.
+        """
+        return self._lock
+
+    def snapshot(self):
+        """ Returns a copy of the subscriptions and target names, to hand back
+        to restore() if a set of changes needs to be undone.
+        """
+        with self._lock:
+            return (dict(self._subscriptions),
+                    dict((id, a.cmd) for id, a in self._attachments.items()))
+
+    def restore(self, snapshot):
+        """ Puts the subscriptions and target names back to what they were
+        when the snapshot was taken. Attachments that have come or gone since
+        are left alone.
+        """
+        with self._lock:
+            subscriptions, cmds = snapshot
+            self._subscriptions.clear()
+            self._subscriptions.update(subscriptions)
+            for id, cmd in cmds.items():
+                attach = self._attachments.get(id, None)
+                if attach is not None: attach.cmd = cmd
+            self.__changed()
+
+    def addListener(self, fn):
+        """ The function is called with no arguments whenever a target is
+        registered, deregistered or renamed, so anyone caching what the ids
+        and command names point to (like the router) knows to look again. Its
+        called with the registry locked, so it should be quick.
+        """
+        with self._lock: self._listeners.append(fn)
+
+    def removeListener(self, fn):
+        with self._lock:
+            if fn in self._listeners: self._listeners.remove(fn)
+
+    def targets(self):
+        """ Returns a dictionary of every id and command name that can be 
+        routed to (including 'daemon'), to the id it stands for. Take it with 
+        the registry locked to be sure it doesn't change under you.
+        """
+        with self._lock:
+            targets = {"daemon":self._did, self._did:self._did}
+            for id, attach in self._attachments.items():
+                if attach.cmd is not None: targets.setdefault(attach.cmd, id)
+            for id in self._attachments.keys(): targets[id] = id
+            return targets
+
+    def __changed(self):
+        for fn in self._listeners:
+            try: fn()
+            except Exception as e: logging.exception(e)
 
 
     def getEventId(self, name):
-        for event in self._events.values():
-            if name == event:
-                return event.ID
+        with self._lock:
+            for event in self._events.values():
+                if name == event:
+                    return event.ID
         return None
 
 
@@ -494,10 +564,11 @@ class Registry():
 
     def loadEvent(self, name, aid):
         """ Saves an event to the registry if it doesn't exist, if it
-        does then it returns the ID."""
-        id = self.isEventLoaded(name, aid)
-        if id is not None: return id
-        else:
+        does then it returns the ID. Attachments are activated side by side,
+        so this can be called from a few threads at once."""
+        with self._lock:
+            id = self.isEventLoaded(name, aid)
+            if id is not None: return id
             eid = self.__genNewEventId()
             self._events[eid] = RegEvent(eid, aid, name)
             return eid
@@ -507,28 +578,31 @@ class Registry():
         ever need this one, but I thought I should add it for completeness
         sake.
         """
-        try: 
-            tmp  = self._subscriptions
-            self._subscriptions.clear()
-            for k in tmp.keys(): #FIXME: There needs to be a faster way of doing this.
-                if tmp[k].eid != eid:
-                    self._subscriptions[k] = tmp[k]
+        with self._lock:
+            try: 
+                tmp  = self._subscriptions
+                self._subscriptions.clear()
+                for k in tmp.keys(): #FIXME: There needs to be a faster way of doing this.
+                    if tmp[k].eid != eid:
+                        self._subscriptions[k] = tmp[k]
             
-            return self._events.pop(eid, None) is not None
-        except: return False
+                return self._events.pop(eid, None) is not None
+            except: return False
     
     def isEventLoaded(self, name, aid):
         """ Checks if an event by the given name for the given plug is already 
         registered.
         """
-        for event in self._events.values():
-            if event == (name, aid): return event.ID
+        with self._lock:
+            for event in self._events.values():
+                if event == (name, aid): return event.ID
         return None
     
     def getAlertId(self, name):
-        for alert in self._alerts.values():
-            if name == alert:
-                return alert.ID
+        with self._lock:
+            for alert in self._alerts.values():
+                if name == alert:
+                    return alert.ID
         return None        
     
     def loadAlerts(self, alertlist):
@@ -536,27 +610,29 @@ class Registry():
             alert.ID = self.loadAlert(alert.name, alert.aid)
     
     def loadAlert(self, name, aid):
-        id = self.isAlertLoaded(name, aid)
-        if id is not None: return id
-        else:
+        with self._lock:
+            id = self.isAlertLoaded(name, aid)
+            if id is not None: return id
             lid = self.__genNewAlertId()
             self._alerts[lid] = RegAlert(lid, aid, name)
             return lid
     
     def unloadAlert(self, lid):
-        try:
-            tmp  = self._subscriptions
-            self._subscriptions.clear()
-            for k in tmp.keys(): #FIXME: There needs to be a faster way of doing this.
-                if tmp[k].lid != lid:
-                    self._subscriptions[k] = tmp[k]
+        with self._lock:
+            try:
+                tmp  = self._subscriptions
+                self._subscriptions.clear()
+                for k in tmp.keys(): #FIXME: There needs to be a faster way of doing this.
+                    if tmp[k].lid != lid:
+                        self._subscriptions[k] = tmp[k]
 
-            return self._alerts.pop(lid, None) is not None
-        except: return False
+                return self._alerts.pop(lid, None) is not None
+            except: return False
     
     def isAlertLoaded(self, name, aid):
-        for alert in self._alerts.values():
-            if alert == (name, aid): return alert.ID
+        with self._lock:
+            for alert in self._alerts.values():
+                if alert == (name, aid): return alert.ID
         return None
     
     
@@ -577,31 +653,35 @@ class Registry():
     
     def __genNewAttachId(self):
         """ Utility function for generating new attachment IDs. """ 
-        while 1:
-            tmp = ''.join(random.choice(ID_LETTERS) for _ in range(AID_SIZE))
-            if tmp in self._attachments: continue
-            else: return tmp
+        with self._lock:
+            while 1:
+                tmp = ''.join(random.choice(ID_LETTERS) for _ in range(AID_SIZE))
+                if tmp in self._attachments: continue
+                else: return tmp
             
     def __genNewEventId(self):
         """ Utility function for generating new event IDs. """
-        while 1:
-            tmp = ''.join(random.choice(ID_LETTERS) for _ in range(EID_SIZE))
-            if tmp in self._events: continue
-            else: return tmp
+        with self._lock:
+            while 1:
+                tmp = ''.join(random.choice(ID_LETTERS) for _ in range(EID_SIZE))
+                if tmp in self._events: continue
+                else: return tmp
             
     def __genNewAlertId(self):
         """ Utility function for generating new alert IDs. """
-        while 1:
-            tmp = ''.join(random.choice(ID_LETTERS) for _ in range(LID_SIZE))
-            if tmp in self._alerts: continue
-            else: return tmp
+        with self._lock:
+            while 1:
+                tmp = ''.join(random.choice(ID_LETTERS) for _ in range(LID_SIZE))
+                if tmp in self._alerts: continue
+                else: return tmp
     
     def __getNewSubscriptionId(self):
         """ Utility function for generating new subscription IDs. """
-        while 1:
-            tmp = ''.join(random.choice(ID_LETTERS) for _ in range(SID_SIZE))
-            if tmp in self._subscriptions: continue
-            else: return tmp
+        with self._lock:
+            while 1:
+                tmp = ''.join(random.choice(ID_LETTERS) for _ in range(SID_SIZE))
+                if tmp in self._subscriptions: continue
+                else: return tmp
             
     def __makeBackup(self):
         """ Makes a temporary backup of the current registry file in case 
@@ -36,7 +36,7 @@ from optparse import OptionParser, SUPPRESS_HELP
 
 from empbase.daemon.daemonipc import DaemonClientSocket
 from empbase.daemon.EmpDaemon import EmpDaemon, __version__
-from empbase.comm.messages import makeCommandMsg, strToMessage
+from empbase.comm.messages import makeCommandMsg, strToMessage, MSG_TYPES
    
 def main():
     parser = OptionParser( usage=__usage__, 
@@ -100,14 +100,15 @@ def main():
                 daemon = EmpDaemon()
                 p = daemon.getComPort()
                 if p is not None:
-                    socket = DaemonClientSocket(port=p)
+                    socket = DaemonClientSocket(port=p, msgtypes=MSG_TYPES,
+                                                path=daemon.getComPath())
                     socket.connect()
-                    msg = strToMessage(socket.recv())
+                    msg = strToMessage(socket.recvframe())
                     logging.debug("empd got back: %s"%msg)
                     if msg.getValue() == "proceed":# it connected
                         myId= msg.getDestination()
                         socket.send(makeCommandMsg("status", myId))
-                        print(strToMessage(socket.recv()).getValue(),"\n")
+                        print(strToMessage(socket.recvframe()).getValue(),"\n")
                         socket.close()
                     else: print("ERROR: Daemon rejected connection attempt.")
                 else: print("ERROR: Daemon is not running.")
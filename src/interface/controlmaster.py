@@ -0,0 +1,152 @@
+"""
+Copyright (c) 2010-2011 Alexander Dean (dstar@csh.rit.edu)
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import os
+import itertools
+from threading import Thread, Lock
+from socket import socket, timeout, SOCK_STREAM, SHUT_RDWR, SOMAXCONN
+
+from empbase.comm.codec import FrameBuffer, JSON_CODEC
+from empbase.comm.messages import Message, makeMsg, makeCommandMsg, \
+                                  COMMAND_MSG_TYPE, MSG_TYPES
+from empbase.daemon.daemonipc import DaemonClientSocket, DaemonSocketError, AF_UNIX
+
+#
+# A control master keeps one connection to the daemon open and lets other emp
+# processes use it through a unix socket, a lot like ssh's ControlMaster.
+# Each emp run then only has to connect to the master, it doesn't have to
+# load the daemon's configuration to find it or wait on a new handshake.
+#
+
+# Where the master listens if no other path was given.
+DEFAULT_CONTROL_PATH = os.path.join("~", ".emp", "master.sock")
+
+# How much is read off of a socket at a time.
+READ_SIZE = 4096
+
+
+def controlPath(path=None):
+    """ Returns the control socket's path. If one isn't given, the EMP_CONTROL
+    environment variable is used, or the default one in ~/.emp.
+    """
+    if path is None: path = os.environ.get("EMP_CONTROL", DEFAULT_CONTROL_PATH)
+    return os.path.expanduser(path)
+
+def connectMaster(path, bufferSize=1024):
+    """ Connects to the control master at the path. Returns the connected
+    DaemonClientSocket, or None if there isn't a master running there.
+    """
+    if AF_UNIX is None or not os.path.exists(path): return None
+    master = DaemonClientSocket(msgtypes=MSG_TYPES, path=path, bufferSize=bufferSize)
+    try:
+        master.connect()
+        return master
+    except OSError:
+        master.close()
+        return None
+
+
+class ControlMaster():
+    """ Shares a connected and handshaken DaemonClientSocket with every emp
+    that connects to the control socket. Each client is greeted with its own
+    'proceed' like the daemon would, so it can't tell the difference. Their
+    requests are given a fresh request id before being passed on, which is
+    how the replies find their way back.
+    """
+    def __init__(self, daemon, proceed, path):
+        """ The proceed is the message the daemon greeted us with. """
+        self.daemon = daemon
+        self.ID = proceed.getDestination()
+        self.DID = proceed.getSource()
+        self.PATH = path
+        self._lock = Lock() # guards the waiting list and writes to the daemon.
+        self._ids = itertools.count(1)
+        self._waiting = {}  # our id -> (client socket, the client's id)
+        self._running = False
+
+    def run(self):
+        """ Serves clients until the daemon hangs up. """
+        server = socket(AF_UNIX, SOCK_STREAM)
+        if os.path.exists(self.PATH): os.unlink(self.PATH) # left from a dead master.
+        server.bind(self.PATH)
+        os.chmod(self.PATH, 0o600) # only the user that made it can use it.
+        server.listen(SOMAXCONN)
+        server.settimeout(1.0)
+
+        self._running = True
+        Thread(target=self.__relay, daemon=True).start()
+        try:
+            while self._running:
+                try: client,_ = server.accept()
+                except timeout: continue
+                Thread(target=self.__serve, args=(client,), daemon=True).start()
+        finally:
+            self._running = False
+            server.close()
+            try: os.unlink(self.PATH)
+            except OSError: pass
+            self.daemon.close()
+
+    def stop(self):
+        self._running = False
+
+    def __relay(self):
+        """ Passes replies from the daemon back to whoever asked for them. """
+        frames = FrameBuffer(MSG_TYPES)
+        while self._running:
+            try: data = self.daemon.socket.recv(READ_SIZE)
+            except timeout: continue
+            except OSError: data = b''
+            if not data: break # the daemon went away, so do we.
+            for reply in frames.feed(data):
+                with self._lock:
+                    client, id = self._waiting.pop(reply.get("id"), (None, None))
+                if client is None: continue # not a reply, or its client left.
+                if id is None: del reply["id"]
+                else: reply["id"] = id
+                try: client.sendall(Message(reply).encode(JSON_CODEC))
+                except OSError: pass
+        self._running = False
+
+    def __serve(self, client):
+        """ Reads a client's requests and sends them on to the daemon. """
+        frames = FrameBuffer(MSG_TYPES)
+        try:
+            # The master only talks JSON to its clients, so that's the only
+            # codec offered.
+            greeting = makeCommandMsg("proceed", self.DID, dest=self.ID, args=[JSON_CODEC])
+            client.sendall(greeting.encode())
+            while self._running:
+                data = client.recv(READ_SIZE)
+                if not data: break
+                for value in frames.feed(data):
+                    if value.get("message") == COMMAND_MSG_TYPE and \
+                       value.get("command") == "codec" and not value.get("dest"):
+                        client.sendall(makeMsg(JSON_CODEC, self.DID, self.ID,
+                                               id=value.get("id")).encode())
+                        continue
+                    with self._lock:
+                        id = next(self._ids)
+                        self._waiting[id] = (client, value.get("id"))
+                        value["id"] = id
+                        value["source"] = self.ID
+                        self.daemon.send(Message(value))
+        except (OSError, DaemonSocketError): pass
+        finally:
+            with self._lock:
+                for id in [id for id,(c,_) in self._waiting.items() if c is client]:
+                    del self._waiting[id]
+            try: client.shutdown(SHUT_RDWR)
+            except OSError: pass
+            client.close()
@@ -19,11 +19,13 @@ from plugs.timerplug.mytimer import MyTimer
 from empbase.event.events import Event
 from empbase.comm.command import Command
 from empbase.attach.attachments import SignalPlug
-from empbase.daemon.daemonipc import DaemonServerSocket, timeout
+from empbase.daemon.daemonipc import DaemonServerSocket
+from empbase.comm.ioloop import addListener, addConnection, closeSocket
 
 DEFAULT_PORT = 8081
 DEFAULT_MAXRAND = 360
 DEFAULT_MINRAND = 20
+ENCODING = "utf-8"
 
 LOWEST_RAND = 1
 
@@ -47,7 +49,7 @@ class TimerPlug(SignalPlug):
         if self._maxrand < self._minrand:
             self._maxrand , self._minrand = self._minrand, self._maxrand 
             
-        self._socket = DaemonServerSocket(port=self._port)
+        self._socket = None # bound when activated, closed when deactivated.
         #TODO: get these other settings working.
         #                                 ip_whitelist=whitelist,
         #                                 externalBlock=self.config.getboolean("Daemon","local-only"),
@@ -156,15 +158,16 @@ class TimerPlug(SignalPlug):
             raise Exception("Couldn't removed timer!")
     
     def sendSignal(self, timer):
-        for conn in self._connections:
-            try:conn.send(self.EVENT_timer)
+        data = str(self.EVENT_timer).encode(ENCODING)
+        for conn in list(self._connections):
+            try:conn.write(data)
             except:pass
         self.EVENT_timer.trigger()
         self._timers = list(filter(lambda a: not a.isFinished(), self._timers))
             
     def killconnections(self):
         """ Close all open connections. """
-        for conn in self._connections:
+        for conn in list(self._connections):
             try:conn.close()
             except:pass
         self._connections=[]
@@ -174,24 +177,39 @@ class TimerPlug(SignalPlug):
         for timer in self._timers: timer.cancel()
         self._timers = []
             
+    def activate(self):
+        """ Rather than a thread of its own, the plug's socket is watched by
+        the daemon's IOLoop along with all the interfaces. The port is only
+        bound while the plug is active.
+        """
+        if not self.is_activated:
+            self._socket = DaemonServerSocket(port=self._port, encoding=ENCODING)
+            self.is_activated = True
+            addListener(self._socket, self.__accept)
+            
     def deactivate(self):
-        """ stops all connections and the server. """
+        """ stops all connections and the server. The port is free again 
+        once this returns, so a reloaded TimerPlug can bind it.
+        """
+        if self._socket is not None:
+            closeSocket(self._socket)
+            self._socket = None
         SignalPlug.deactivate(self)
         self.killconnections()
         self.killtimers()
-                 
+        
+    def __accept(self, connection):
+        """ Saves each new connection so the timer signals can be sent down 
+        it. Nothing is read from them, they're dropped when they close. 
+        """
+        conn = addConnection(connection.socket, encoding=ENCODING,
+                             onclose=lambda: self.__dropped(conn))
+        if conn is not None: self._connections.append(conn)
+        
+    def __dropped(self, conn):
+        try: self._connections.remove(conn)
+        except ValueError: pass
        
     def run(self):
-        """ Runs when there are timers to watch, and then sends a signal when there is need to."""
-        try:
-            self.is_activated=True
-            while self.is_activated:
-                try:
-                    #make sure all of the connections are saved.
-                    connection = self._socket.accept()
-                    self._connections.append(connection)
-                except timeout: pass
-        except Exception as e:
-            logging.exception(e)
-        finally:
-            self.deactivate()
+        """ Everything is done on the daemon's IOLoop, see activate(). """
+        pass